@@ -4,12 +4,13 @@ import json
 import matplotlib
 from threading import current_thread
 
-from corona import logger
+from corona import logger, profiling
 from corona.analysis import RiskReport
 from corona.analysis.contact_graph import GPSContactGraph, BTContactGraph
 from corona.analysis.default_parameters import params
 from corona.analysis.logger import log_contacts
 from corona.config import __CONFIG__ as config
+from corona.utils import timer
 
 #from profilehooks import profile
 #@profile
@@ -17,7 +18,8 @@ def run_analysis_pipeline(patient_uuid, output_formats=["dict"], daily_summary=T
                           timeFrom=None,
                           timeTo=None,
                           request_id=None,
-                          html_filename_prefix="", include_maps="static", testing=False):
+                          html_filename_prefix="", include_maps="static", testing=False,
+                          profile=None):
     """ Runs the analysis pipeline and returns the risk report.
 
         :param patient_uuid: UUID of the patient to be analysed
@@ -28,6 +30,7 @@ def run_analysis_pipeline(patient_uuid, output_formats=["dict"], daily_summary=T
         :param html_filename_prefix: Only valid if output_format includes "html". A prefix string that for the filename._dist_thresh_
         :param include_maps: Specifies which types of maps to include in the report. Valid options are  None, "static" or "interactive".
         :param testing: Boolean flag - if true reports also contacts that do not satisfy the criteria defined by FHI
+        :param profile: Optional corona.profiling.Profile collecting an execution profile of this run.
     """
 
     if request_id:
@@ -38,6 +41,8 @@ def run_analysis_pipeline(patient_uuid, output_formats=["dict"], daily_summary=T
     calling_thread = current_thread()
     calling_thread_name = calling_thread.name
     calling_thread.name = context_name
+    if profile is not None:
+        profile.start()
     try:
         # Set parameters
         assert set(output_formats).issubset(("dict", "html", "stdout"))
@@ -60,6 +65,9 @@ def run_analysis_pipeline(patient_uuid, output_formats=["dict"], daily_summary=T
         bt_results = bt_contact_graph.contacts_with(patient_uuid)
 
         all_results = bt_results + gps_results
+        profiling.count("gps_candidates", len(gps_contact_graph.uuids))
+        profiling.count("bt_candidates", len(bt_contact_graph.uuids))
+        profiling.count("contacts", len(all_results.contacts))
 
         # Gather device infos of uuids in graph
         device_info = gps_contact_graph.node_device_info.copy()
@@ -80,13 +88,16 @@ def run_analysis_pipeline(patient_uuid, output_formats=["dict"], daily_summary=T
             logger.info(report)
             logger.info("Analysis pipeline finished")
         if "dict" in output_formats:
-            if daily_summary:
-                d = report.to_dict_daily()
-            else:
-                d = report.to_dict()
+            with timer("report", stage="report"):
+                if daily_summary:
+                    d = report.to_dict_daily()
+                else:
+                    d = report.to_dict()
             logger.info("Analysis pipeline finished")
             return d
     finally:
+        if profile is not None:
+            profile.stop()
         calling_thread.name = calling_thread_name
 
 
@@ -6,13 +6,13 @@ from tqdm import tqdm
 import pandas as pd
 
 from corona import logger
-from corona.data import load_azure_data, load_azure_data_bluetooth, load_device_info
+from corona.data import load_trajectory, load_within_bb, load_azure_data_bluetooth, load_device_info
 from corona.analysis.trajectory import TrajectoryParser
 from corona.analysis.contact_list import ContactList
 from corona.analysis.gps_contact import get_gps_contacts_from_trajectories
 from corona.analysis.bt_contact import BluetoothContactDetailsIterator, BluetoothContact
 from corona.analysis.intersection_functions import convolution
-from corona.utils import haversine_distance
+from corona.utils import haversine_distance, timer
 
 class BaseContactGraph(object):
     def __init__(self, query_uuids, params):
@@ -29,7 +29,8 @@ class BaseContactGraph(object):
 
         self._G = nx.Graph()
         self._compute_graph_nodes()
-        self._compute_graph_edges()
+        with timer(f"{self.__class__.__name__} edges", stage="edges"):
+            self._compute_graph_edges()
         # Collect device info for all participant uuids
         self.node_device_info = load_device_info(list(self._G.nodes))
 
@@ -149,9 +150,9 @@ class BTContactGraph(BaseContactGraph):
         dt_threshold = params['gps_dt_threshold']
         dx_threshold = params['gps_dx_threshold']
 
-        query = f"SELECT * FROM getTrajectorySpeed('{uuid}','{params['timeFrom']}','{params['timeTo']}')"
         logger.info(f"BTContactGraph: Calling getTrajectorySpeed() for BT contact.")
-        df = load_azure_data(query, params['outlier_threshold'], dt_threshold=dt_threshold, dx_threshold=dx_threshold).get(uuid, None)
+        df = load_trajectory(uuid, params['timeFrom'], params['timeTo'], params['outlier_threshold'],
+                             dt_threshold=dt_threshold, dx_threshold=dx_threshold).get(uuid, None)
         logger.info(f"BTContactGraph: Parsing trajectory for BT contact")
         trajectory = TrajectoryParser(pd_frame=df,
                                       uuid=uuid,
@@ -220,9 +221,9 @@ class GPSContactGraph(BaseContactGraph):
         dx_threshold = params['gps_dx_threshold']
 
         # Now get the trajectory of the patient
-        query = f"SELECT * FROM getTrajectorySpeed('{query_uuid}','{params['timeFrom']}','{params['timeTo']}')"
         logger.info(f"GPSContactGraph: Calling getTrajectorySpeed() for GPS contact")
-        t_patient = load_azure_data(query, params['outlier_threshold'], dt_threshold=dt_threshold, dx_threshold=dx_threshold).get(query_uuid, [])
+        t_patient = load_trajectory(query_uuid, params['timeFrom'], params['timeTo'], params['outlier_threshold'],
+                                    dt_threshold=dt_threshold, dx_threshold=dx_threshold).get(query_uuid, [])
         logger.info("GPSContactGraph: getTrajectorySpeed() for GPS contact finished")
         minimum_duration = 60
         maximum_bb_diameter1 = 800
@@ -244,9 +245,10 @@ class GPSContactGraph(BaseContactGraph):
             lat_max = t_piece['latitude'].max()
             long_min = t_piece['longitude'].min()
             long_max = t_piece['longitude'].max()
-            query = f"SELECT * FROM getWithinBB ({long_min}, {lat_min},{long_max},{lat_max},'{timeFrom}','{timeTo}') ORDER BY 1,2 ASC"
             # Appends dictionary of format {uuid : pd_frame} to the list
-            temp_trajectories.append(load_azure_data(query, params['outlier_threshold'], dt_threshold=dt_threshold, dx_threshold=dx_threshold))
+            temp_trajectories.append(load_within_bb(long_min, lat_min, long_max, lat_max, timeFrom, timeTo,
+                                                    params['outlier_threshold'],
+                                                    dt_threshold=dt_threshold, dx_threshold=dx_threshold))
 
         # Combine data frames of temporary trajectories
         for temp_trajectories in temp_trajectories:
@@ -15,7 +15,7 @@ import cartopy.crs as ccrs
 from corona import logger
 from corona.analysis.trajectory.viewer import TrajectoryFoliumViewer
 from collections import defaultdict
-from corona.utils import convert_seconds, get_or, duration_of_contact, haversine_distance
+from corona.utils import convert_seconds, get_or, duration_of_contact, haversine_distance, timer
 
 # Thresholds for assigning a risk category to a cumulative contact
 __RISK_CATEGORY_IDENTIFIER__ = ['high','medium','low','no']
@@ -255,10 +255,12 @@ class ContactList(list):
               }
 
         if include_bar_plot:
-            dic['bar_plot'] = base64.b64encode(self.bar_plot()).decode('utf-8')
+            with timer("bar plot", stage="plot"):
+                dic['bar_plot'] = base64.b64encode(self.bar_plot()).decode('utf-8')
 
         if include_hist:
-            res = self.distances_hist()
+            with timer("distance histogram", stage="plot"):
+                res = self.distances_hist()
             if res is not None:
                 dic['hist_plot'] = base64.b64encode(res).decode('utf-8')
 
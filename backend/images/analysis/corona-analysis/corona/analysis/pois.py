@@ -4,7 +4,7 @@ import datetime
 import more_itertools as mit
 import pandas as pd
 
-from corona.utils import union_of_time_stamps, duration_of_contact, convert_seconds
+from corona.utils import union_of_time_stamps, duration_of_contact, convert_seconds, timer
 from corona.analysis.default_parameters import params
 from corona.analysis.trajectory.parser import TrajectoryParser, transports_preprocessing
 from corona.preprocessing.trajectory import extract_trajectories_by_time_intervals, extract_polygons_from_dilated_areas
@@ -50,7 +50,8 @@ class POI(object):
             self._pois = {'N/A' : self.duration}, 0, 0, self.duration
             return {'N/A' : self.duration}, 0, 0, self.duration
 
-        self._pois = self.get_outputs_from_dict()
+        with timer("poi lookup", stage="poi"):
+            self._pois = self.get_outputs_from_dict()
 
         return self._pois
 
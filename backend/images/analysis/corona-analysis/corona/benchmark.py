@@ -0,0 +1,140 @@
+""" Benchmarks of the analysis pipeline on synthetic populations.
+
+For each population size (scale), a population is generated with
+corona.synthetic.generate_population and served by an InMemoryDataSource.
+The full pipeline is then run for a few patients under a corona.profiling.Profile,
+recording wall/CPU time per stage, call counts and memory.
+
+Results are emitted as one json record per line:
+
+- {"record": "population", "scale": ..., ...}: generation time, rows and memory
+- {"record": "run", "scale": ..., "patient": ..., "profile": {...}}: one pipeline run
+- {"record": "summary", "scale": ..., ...}: aggregated runs of one scale
+
+Overpass queries are answered without any points of interest by default,
+so that results do not depend on the network.
+"""
+
+import json
+import statistics
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import timedelta
+
+from corona import logger
+from corona.datasource import InMemoryDataSource, set_data_source
+from corona.map.api import OverpassAPI, set_http_interceptor
+from corona.profiling import Profile, peak_rss_mb
+from corona.synthetic import device_uuids, generate_population
+
+DEFAULT_SCALES = (100, 1000, 10000, 100000)
+
+
+@contextmanager
+def empty_overpass():
+    """ Answers Overpass queries without any points of interest while active """
+
+    def intercept(url, fetch):
+        if url.startswith(OverpassAPI.endpoint):
+            return {"elements": []}
+        return fetch()
+
+    previous = set_http_interceptor(intercept)
+    try:
+        yield
+    finally:
+        set_http_interceptor(previous)
+
+
+def benchmark_scale(scale, days=1, seed=0, patients=3, density=1000, cprofile=False):
+    """ Benchmarks one population size, yielding json-serializable records """
+    # imported here, the pipeline pulls in plotting and map dependencies
+    from corona.analysis.analysis_pipeline import run_analysis_pipeline
+
+    tic = time.perf_counter()
+    gps, bluetooth, device_info = generate_population(scale, days=days, seed=seed, density=density)
+    generate_s = time.perf_counter() - tic
+    start = gps["timefrom"].min().normalize()
+    yield {
+        "record": "population",
+        "scale": scale,
+        "days": days,
+        "seed": seed,
+        "density": density,
+        "generate_s": round(generate_s, 3),
+        "gps_rows": len(gps),
+        "bluetooth_rows": len(bluetooth),
+        "frames_mb": round((gps.memory_usage(deep=True).sum() +
+                            bluetooth.memory_usage(deep=True).sum()) / 2 ** 20, 1),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+    source = InMemoryDataSource(gps=gps, bluetooth=bluetooth, device_info=device_info)
+    del gps, bluetooth
+    previous = set_data_source(source)
+    runs = []
+    try:
+        for patient in device_uuids(scale, seed)[:patients]:
+            profile = Profile(cprofile_sample_rate=1 if cprofile else 0)
+            status = "success"
+            contacts = None
+            try:
+                result = run_analysis_pipeline(patient, timeFrom=start.to_pydatetime(),
+                                               timeTo=(start + timedelta(days=days)).to_pydatetime(),
+                                               include_maps=None, profile=profile)
+                contacts = len(result)
+            except Exception:
+                logger.exception(f"Benchmark run failed for {patient}")
+                status = "error"
+            run = {
+                "record": "run",
+                "scale": scale,
+                "patient": patient,
+                "status": status,
+                "contacts": contacts,
+                "profile": profile.to_dict(),
+            }
+            runs.append(run)
+            yield run
+    finally:
+        set_data_source(previous)
+
+    walls = [run["profile"]["wall_s"] for run in runs]
+    stages = sorted({stage for run in runs for stage in run["profile"]["stages"]})
+    yield {
+        "record": "summary",
+        "scale": scale,
+        "runs": len(runs),
+        "errors": sum(run["status"] != "success" for run in runs),
+        "wall_s_median": round(statistics.median(walls), 3) if walls else None,
+        "wall_s_max": round(max(walls), 3) if walls else None,
+        "stage_wall_s_median": {
+            stage: round(statistics.median(run["profile"]["stages"].get(stage, {}).get("wall_s", 0)
+                                           for run in runs), 3)
+            for stage in stages
+        },
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def run_benchmark(scales=DEFAULT_SCALES, days=1, seed=0, patients=3, density=1000, cprofile=False,
+                  stub_overpass=True, output=None):
+    """ Runs the benchmark for each scale, writing json lines to output (a file object).
+
+    Returns all records.
+    """
+    records = []
+
+    def emit(record):
+        records.append(record)
+        if output is not None:
+            output.write(json.dumps(record, sort_keys=True) + "\n")
+            output.flush()
+
+    with (empty_overpass() if stub_overpass else nullcontext()):
+        for scale in scales:
+            for record in benchmark_scale(scale, days=days, seed=seed, patients=patients,
+                                          density=density, cprofile=cprofile):
+                emit(record)
+    return records
+
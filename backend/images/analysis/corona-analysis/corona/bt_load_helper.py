@@ -1,20 +1,20 @@
 import pandas as pd
 import time
 from datetime import datetime
-from corona import logger
+from corona import logger, profiling
 from corona.utils import retry, timer
 
 
 min_duration = 150
 #### group rssi measurments bewteen two devices into contacts
 @retry(Exception)
-def get_observed_contacts(db, device,start_date,end_date,grouping_th):
+def get_observed_contacts(source, device,start_date,end_date,grouping_th):
     contacts = {}
-    cursor = db.cursor()
-    with timer("db query getBluetoothPairing"):
-        cursor.execute("""select * from  getBluetoothPairing(?,?,?) order by pairedtime""",device,start_date,end_date)
-    row = cursor.fetchone()
-    while row:
+    with timer(f"{source.name} query getBluetoothPairing", stage="sql_load"):
+        pairings = source.get_bluetooth_pairing(device,start_date,end_date)
+    profiling.count("sql_calls")
+    profiling.count("sql_rows", len(pairings))
+    for row in pairings.itertuples(index=False):
         pair = row.paireddeviceid if device != row.paireddeviceid else row.uuid
         rssi = row.rssi
         ts_hr = row.pairedtime
@@ -58,8 +58,6 @@ def get_observed_contacts(db, device,start_date,end_date,grouping_th):
              contacts[device][pair][1]['start_ts_hr'] = ts_hr
              contacts[device][pair][1]['rssi'].append(rssi)
              contacts[device][pair][1]['platform']=row.pair_platform
-        row = cursor.fetchone()
-    cursor.close()
     return contacts
 
 
@@ -102,7 +100,7 @@ def desc_contacts(contacts,ios_vc,ios_c,ios_f,android_vc,android_c,android_f):
     return contact_stats
 
 ### use measurments from other nearby devices to discover hidden devices - this is important to overcome the ios limitation
-def find_hidden_devices(device,contact_stats,db,start_date,end_date,grouping_th,ios_vc,ios_c,ios_f,android_vc,android_c,android_f):
+def find_hidden_devices(device,contact_stats,source,start_date,end_date,grouping_th,ios_vc,ios_c,ios_f,android_vc,android_c,android_f):
     very_close_contact = contact_stats[contact_stats.vc_length>0]
     overlap_hidden = []
     visited = {}
@@ -111,7 +109,7 @@ def find_hidden_devices(device,contact_stats,db,start_date,end_date,grouping_th,
         if peer_device in visited.keys():
             continue
         visited[peer_device] = 1
-        raw_contacts = get_observed_contacts(db, peer_device,start_date,end_date,grouping_th)
+        raw_contacts = get_observed_contacts(source, peer_device,start_date,end_date,grouping_th)
         peer_contacts = desc_contacts(raw_contacts,ios_vc,ios_c,ios_f,android_vc,android_c,android_f)
         for cont in range(len(peer_contacts)):
             if  peer_contacts.loc[cont,"vc_length"]>0:
@@ -351,10 +349,10 @@ def combine_contacts(contact_stats,hidden_devices):
 
     return all_contacts
 
-def get_contacts(device,start_date,end_date, db, grouping_th=300,ios_vc=-55,ios_c=-65,ios_f=-75,android_vc=-65,android_c=-75,android_f=-85):
-    initial_contacts = get_observed_contacts(db,device,start_date,end_date,grouping_th)
+def get_contacts(device,start_date,end_date, source, grouping_th=300,ios_vc=-55,ios_c=-65,ios_f=-75,android_vc=-65,android_c=-75,android_f=-85):
+    initial_contacts = get_observed_contacts(source,device,start_date,end_date,grouping_th)
     annotated_contacts = desc_contacts(initial_contacts,ios_vc,ios_c,ios_f,android_vc,android_c,android_f)
-    hidden_contacts = find_hidden_devices(device,annotated_contacts,db,start_date,end_date,grouping_th,ios_vc,ios_c,ios_f,android_vc,android_c,android_f)
+    hidden_contacts = find_hidden_devices(device,annotated_contacts,source,start_date,end_date,grouping_th,ios_vc,ios_c,ios_f,android_vc,android_c,android_f)
     contacts = combine_contacts(annotated_contacts,hidden_contacts)
     return contacts
 
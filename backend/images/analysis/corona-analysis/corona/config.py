@@ -22,6 +22,9 @@ __DEFAULT_CONFG = {
     },
     "features": {
         "device_info": False
+    },
+    "data": {
+        "source": "sql"
     }
 }
 
@@ -15,7 +15,8 @@ from corona.map.utils import get_overpass_df_from_list
 from corona.config import __CONFIG__
 from corona.utils import haversine_distance, sparsify_mask, Singleton, retry, timer
 from corona.bt_load_helper import get_contacts, convert_frame
-from corona import logger
+from corona.datasource import get_data_source
+from corona import logger, profiling
 
 _DEFAULT_INCLUDE_ATTRIBUTES = [
     "uuid",
@@ -182,11 +183,11 @@ def load_azure_data_bluetooth(patient_uuid, timeFrom, timeTo, dt_threshold=None)
     data is filter such that 2 conseq events are at least dt_threshold
     apart. NOTE: dt_threshold value is in seconds
     """
-    with timer("db connect"):
-        db = connect_to_azure_database()
-
-    df = get_contacts(patient_uuid, timeFrom, timeTo, db)
-    db.close()
+    source = get_data_source()
+    try:
+        df = get_contacts(patient_uuid, timeFrom, timeTo, source)
+    finally:
+        source.close()
     df = convert_frame(df)
     df = df.sort_values('encounterstarttime')
     df = df.reset_index(drop=True)
@@ -213,6 +214,9 @@ def load_azure_data(query, outlier_threshold=100,
     """ Loads data from the Azure database and returns a dictionary of
     uuids and user events.
 
+    query is a raw SQL query, always run against the database.
+    Use load_trajectory or load_within_bb to query the configured data source.
+
     dt_threshold is None or number. None keeps original data. With number
     data is filter such that 2 conseq events are at least dt_threshold
     apart. NOTE: dt_threshold value is in seconds
@@ -226,14 +230,67 @@ def load_azure_data(query, outlier_threshold=100,
         db = connect_to_azure_database()
 
     db_func = re.search('(FROM|from) (\w*)', query).group(2)
-    with timer(f"db query {db_func}"):
+    stage = "bbox_query" if db_func == "getWithinBB" else "sql_load"
+    with timer(f"db query {db_func}", stage=stage):
         df = pd.read_sql(
             query,
             con=db,
             parse_dates=[ "timeto", "timefrom" ],
         )
     db.close()
+    profiling.count("sql_calls")
+    profiling.count("sql_rows", len(df))
+
+    return gps_frame_to_dict(df, outlier_threshold, include_attributes, dt_threshold, dx_threshold)
+
+
+@retry(Exception)
+def load_trajectory(uuid, timeFrom, timeTo, outlier_threshold=100,
+                    include_attributes=_DEFAULT_INCLUDE_ATTRIBUTES,
+                    dt_threshold=None, dx_threshold=None):
+    """ Loads the GPS events of uuid (getTrajectorySpeed) from the configured
+    data source and returns a dictionary of uuids and user events.
+
+    See load_azure_data for the thresholds.
+    """
+    source = get_data_source()
+    try:
+        with timer(f"{source.name} query getTrajectorySpeed", stage="sql_load"):
+            df = source.get_trajectory_speed(uuid, timeFrom, timeTo)
+    finally:
+        source.close()
+    profiling.count("sql_calls")
+    profiling.count("sql_rows", len(df))
 
+    return gps_frame_to_dict(df, outlier_threshold, include_attributes, dt_threshold, dx_threshold)
+
+
+@retry(Exception)
+def load_within_bb(long_min, lat_min, long_max, lat_max, timeFrom, timeTo, outlier_threshold=100,
+                   include_attributes=_DEFAULT_INCLUDE_ATTRIBUTES,
+                   dt_threshold=None, dx_threshold=None):
+    """ Loads the GPS events of everyone within a bounding box (getWithinBB)
+    from the configured data source and returns a dictionary of uuids and user events.
+
+    See load_azure_data for the thresholds.
+    """
+    source = get_data_source()
+    try:
+        with timer(f"{source.name} query getWithinBB", stage="bbox_query"):
+            df = source.get_within_bb(long_min, lat_min, long_max, lat_max, timeFrom, timeTo)
+    finally:
+        source.close()
+    profiling.count("sql_calls")
+    profiling.count("sql_rows", len(df))
+
+    return gps_frame_to_dict(df, outlier_threshold, include_attributes, dt_threshold, dx_threshold)
+
+
+def gps_frame_to_dict(df, outlier_threshold=100,
+                      include_attributes=_DEFAULT_INCLUDE_ATTRIBUTES,
+                      dt_threshold=None, dx_threshold=None):
+    """ Coarsens and processes a frame of GPS events and returns a dictionary of
+    uuids and user events. """
     df = df.sort_values(by='timefrom')
     df = df.reset_index(drop=True)
 
@@ -547,22 +604,20 @@ def load_device_info(uuids):
 
     device_info = defaultdict(list)
 
-    query_template = "SELECT * FROM getDeviceInformationSingle('%s')"
-
-    with timer("db connect"):
-        db = connect_to_azure_database()
-
-    for uuid in uuids:
-        query = query_template % uuid
-        with timer("db query getDeviceInformationSingle"):
-            frame = pd.read_sql_query(query, con=db)
-
-        # NOTE: it seems there are some different conventions for naming
-        # e.g. ios10.1 and ios101 are (probably) the same thing and we might
-        # want to merge these
-        frame is not None and device_info[uuid].extend(zip(frame['platform'], frame['model'], frame['appversion']))
-
-    db.close()
+    source = get_data_source()
+    try:
+        for uuid in uuids:
+            with timer(f"{source.name} query getDeviceInformationSingle", stage="sql_load"):
+                frame = source.get_device_information(uuid)
+            profiling.count("sql_calls")
+            profiling.count("sql_rows", 0 if frame is None else len(frame))
+
+            # NOTE: it seems there are some different conventions for naming
+            # e.g. ios10.1 and ios101 are (probably) the same thing and we might
+            # want to merge these
+            frame is not None and device_info[uuid].extend(zip(frame['platform'], frame['model'], frame['appversion']))
+    finally:
+        source.close()
     logger.info("Finished loading device info")
 
     return device_info
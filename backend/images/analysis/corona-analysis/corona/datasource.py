@@ -0,0 +1,297 @@
+""" Data sources for the queries used by the analysis pipeline.
+
+The pipeline needs four queries, named after the Azure SQL functions
+implementing them:
+
+- getTrajectorySpeed: GPS events of a single uuid in a time range
+- getWithinBB: GPS events of all uuids within a bounding box and time range
+- getBluetoothPairing: Bluetooth pairings involving a uuid in a time range
+- getDeviceInformationSingle: platform, model and app version of a uuid
+
+A DataSource implements these queries. Three implementations exist:
+
+- SqlDataSource: the Azure SQL database (default)
+- ParquetDataSource: a local Parquet dataset partitioned by day
+- InMemoryDataSource: pandas frames held in memory, for tests
+
+The source is selected in corona.conf:
+
+    [Data]
+    source = sql | parquet | memory
+    path = /path/to/parquet/dataset
+
+All sources return frames with the columns of the corresponding SQL function,
+with times as naive UTC timestamps.
+"""
+
+import os
+from abc import ABC, abstractmethod
+
+import pandas as pd
+
+from corona import logger
+from corona.config import __CONFIG__
+from corona.utils import timer
+
+GPS_COLUMNS = ["uuid", "timefrom", "timeto", "latitude", "longitude", "accuracy", "speed"]
+BLUETOOTH_COLUMNS = ["uuid", "paireddeviceid", "uuid_platform", "pair_platform",
+                     "pairedtime", "pairedtime_ut", "rssi"]
+DEVICE_INFO_COLUMNS = ["uuid", "platform", "model", "appversion"]
+
+
+def _as_naive_utc(t):
+    """ Converts a datetime or string to a naive UTC pd.Timestamp """
+    t = pd.Timestamp(t)
+    if t.tzinfo is not None:
+        t = t.tz_convert("UTC").tz_localize(None)
+    return t
+
+
+class DataSource(ABC):
+    """ Interface for the data queried by the analysis pipeline """
+
+    name = None
+
+    @abstractmethod
+    def get_trajectory_speed(self, uuid, time_from, time_to):
+        """ Returns GPS events for uuid with time_from <= timefrom and timeto <= time_to """
+
+    @abstractmethod
+    def get_within_bb(self, long_min, lat_min, long_max, lat_max, time_from, time_to):
+        """ Returns GPS events for all uuids within the bounding box and time range """
+
+    @abstractmethod
+    def get_bluetooth_pairing(self, uuid, time_from, time_to):
+        """ Returns Bluetooth pairings with uuid on either side, ordered by pairedtime """
+
+    @abstractmethod
+    def get_device_information(self, uuid):
+        """ Returns the device information of uuid """
+
+    def close(self):
+        """ Releases any resources held by the source (e.g. connections) """
+        pass
+
+
+class SqlDataSource(DataSource):
+    """ Queries the Azure SQL database.
+
+    A connection is opened on first use and kept until close() is called.
+    """
+
+    name = "sql"
+
+    def __init__(self):
+        self._db = None
+
+    def _connection(self):
+        if self._db is None:
+            # imported here to avoid requiring pyodbc for offline sources
+            from corona.data import connect_to_azure_database
+            with timer("db connect"):
+                self._db = connect_to_azure_database()
+        return self._db
+
+    def close(self):
+        if self._db is not None:
+            db, self._db = self._db, None
+            db.close()
+
+    def _read_gps(self, query):
+        return pd.read_sql(query, con=self._connection(), parse_dates=["timeto", "timefrom"])
+
+    def get_trajectory_speed(self, uuid, time_from, time_to):
+        return self._read_gps(f"SELECT * FROM getTrajectorySpeed('{uuid}','{time_from}','{time_to}')")
+
+    def get_within_bb(self, long_min, lat_min, long_max, lat_max, time_from, time_to):
+        return self._read_gps(f"SELECT * FROM getWithinBB ({long_min}, {lat_min},{long_max},{lat_max},"
+                              f"'{time_from}','{time_to}') ORDER BY 1,2 ASC")
+
+    def get_bluetooth_pairing(self, uuid, time_from, time_to):
+        return pd.read_sql("select * from  getBluetoothPairing(?,?,?) order by pairedtime",
+                           con=self._connection(), params=[uuid, time_from, time_to])
+
+    def get_device_information(self, uuid):
+        return pd.read_sql_query(f"SELECT * FROM getDeviceInformationSingle('{uuid}')", con=self._connection())
+
+
+class InMemoryDataSource(DataSource):
+    """ Answers queries from pandas frames.
+
+    :param gps: Frame with columns GPS_COLUMNS
+    :param bluetooth: Frame with columns uuid, paireddeviceid, pairedtime and rssi
+    :param device_info: Frame with columns DEVICE_INFO_COLUMNS
+    """
+
+    name = "memory"
+
+    def __init__(self, gps=None, bluetooth=None, device_info=None):
+        self._gps = self._prepare_gps(gps)
+        self._bluetooth = self._prepare_bluetooth(bluetooth)
+        self._device_info = device_info if device_info is not None else pd.DataFrame(columns=DEVICE_INFO_COLUMNS)
+
+    @staticmethod
+    def _prepare_gps(gps):
+        if gps is None:
+            gps = pd.DataFrame(columns=GPS_COLUMNS)
+        gps = gps.copy()
+        for col in ("timefrom", "timeto"):
+            gps[col] = pd.to_datetime(gps[col])
+        return gps
+
+    @staticmethod
+    def _prepare_bluetooth(bluetooth):
+        if bluetooth is None:
+            bluetooth = pd.DataFrame(columns=["uuid", "paireddeviceid", "pairedtime", "rssi"])
+        bluetooth = bluetooth.copy()
+        bluetooth["pairedtime"] = pd.to_datetime(bluetooth["pairedtime"])
+        return bluetooth
+
+    # Subclasses may override these to load only the data relevant for a time range
+    def _gps_frame(self, time_from, time_to):
+        return self._gps
+
+    def _bluetooth_frame(self, time_from, time_to):
+        return self._bluetooth
+
+    def _filter_gps(self, time_from, time_to, mask=None):
+        time_from, time_to = _as_naive_utc(time_from), _as_naive_utc(time_to)
+        gps = self._gps_frame(time_from, time_to)
+        in_range = (gps["timefrom"] >= time_from) & (gps["timeto"] <= time_to)
+        if mask is not None:
+            in_range &= mask(gps)
+        df = gps.loc[in_range, GPS_COLUMNS].reset_index(drop=True)
+        # uuids may be stored as categoricals, return them as strings like the database
+        df["uuid"] = df["uuid"].astype(object)
+        return df
+
+    def get_trajectory_speed(self, uuid, time_from, time_to):
+        return self._filter_gps(time_from, time_to, lambda gps: gps["uuid"] == uuid)
+
+    def get_within_bb(self, long_min, lat_min, long_max, lat_max, time_from, time_to):
+        df = self._filter_gps(
+            time_from, time_to,
+            lambda gps: (gps["longitude"].between(long_min, long_max) &
+                         gps["latitude"].between(lat_min, lat_max)))
+        return df.sort_values(["uuid", "timefrom"]).reset_index(drop=True)
+
+    def _platforms(self):
+        """ uuid -> platform lookup from the device info """
+        return self._device_info.drop_duplicates("uuid").set_index("uuid")["platform"]
+
+    def get_bluetooth_pairing(self, uuid, time_from, time_to):
+        time_from, time_to = _as_naive_utc(time_from), _as_naive_utc(time_to)
+        bt = self._bluetooth_frame(time_from, time_to)
+        df = bt.loc[((bt["uuid"] == uuid) | (bt["paireddeviceid"] == uuid)) &
+                    (bt["pairedtime"] >= time_from) & (bt["pairedtime"] <= time_to) &
+                    (bt["rssi"] < 0)].copy()
+        df["uuid"] = df["uuid"].astype(object)
+        df["paireddeviceid"] = df["paireddeviceid"].astype(object)
+        platforms = self._platforms()
+        df["uuid_platform"] = df["uuid"].map(platforms)
+        # the database assumes ios if the platform of the paired device is unknown
+        df["pair_platform"] = df["paireddeviceid"].map(platforms).fillna("ios")
+        df["pairedtime_ut"] = (df["pairedtime"] - pd.Timestamp("1970-01-01")) // pd.Timedelta("1s")
+        return df.loc[:, BLUETOOTH_COLUMNS].sort_values("pairedtime").reset_index(drop=True)
+
+    def get_device_information(self, uuid):
+        df = self._device_info
+        return df.loc[df["uuid"] == uuid, DEVICE_INFO_COLUMNS].drop_duplicates().reset_index(drop=True)
+
+
+class ParquetDataSource(InMemoryDataSource):
+    """ Answers queries from a local Parquet dataset partitioned by day:
+
+        <path>/gps/date=YYYY-MM-DD/*.parquet
+        <path>/bluetooth/date=YYYY-MM-DD/*.parquet
+        <path>/device_info.parquet
+
+    Only the partitions covering the queried time range are read.
+    Partitions are cached for the lifetime of the source.
+
+    Requires pyarrow (or fastparquet).
+    """
+
+    name = "parquet"
+
+    def __init__(self, path):
+        self.path = path
+        self._partitions = {}
+        device_info_path = os.path.join(path, "device_info.parquet")
+        device_info = pd.read_parquet(device_info_path) if os.path.exists(device_info_path) else None
+        super().__init__(device_info=device_info)
+
+    def _read_partitions(self, table, time_from, time_to, prepare):
+        frames = []
+        for day in pd.date_range(time_from.normalize(), time_to.normalize(), freq="D"):
+            key = (table, day.strftime("%Y-%m-%d"))
+            if key not in self._partitions:
+                partition = os.path.join(self.path, table, f"date={key[1]}")
+                if os.path.isdir(partition):
+                    self._partitions[key] = prepare(pd.read_parquet(partition))
+                else:
+                    self._partitions[key] = None
+            if self._partitions[key] is not None:
+                frames.append(self._partitions[key])
+        if not frames:
+            return prepare(None)
+        return pd.concat(frames, ignore_index=True)
+
+    def _gps_frame(self, time_from, time_to):
+        return self._read_partitions("gps", time_from, time_to, self._prepare_gps)
+
+    def _bluetooth_frame(self, time_from, time_to):
+        return self._read_partitions("bluetooth", time_from, time_to, self._prepare_bluetooth)
+
+
+def write_parquet_dataset(path, gps=None, bluetooth=None, device_info=None):
+    """ Writes frames to a Parquet dataset readable by ParquetDataSource """
+    os.makedirs(path, exist_ok=True)
+    for table, df, time_col in (("gps", gps, "timefrom"), ("bluetooth", bluetooth, "pairedtime")):
+        if df is None or len(df) == 0:
+            continue
+        days = pd.to_datetime(df[time_col]).dt.strftime("%Y-%m-%d")
+        for day, partition in df.groupby(days):
+            partition_dir = os.path.join(path, table, f"date={day}")
+            os.makedirs(partition_dir, exist_ok=True)
+            partition.reset_index(drop=True).to_parquet(os.path.join(partition_dir, "part-0.parquet"), index=False)
+    if device_info is not None:
+        device_info.reset_index(drop=True).to_parquet(os.path.join(path, "device_info.parquet"), index=False)
+
+
+_data_source = None
+
+
+def create_data_source(config=None):
+    """ Creates the data source configured in the [Data] section of corona.conf """
+    if config is None:
+        config = __CONFIG__.data
+    source = config.get("source", "sql")
+    if source == "sql":
+        return SqlDataSource()
+    if source == "parquet":
+        if not config.get("path"):
+            raise ValueError("The parquet data source requires a path in the [Data] section of corona.conf")
+        return ParquetDataSource(config["path"])
+    if source == "memory":
+        return InMemoryDataSource()
+    raise ValueError(f"Unknown data source: {source}")
+
+
+def get_data_source():
+    """ Returns the data source used by the pipeline """
+    global _data_source
+    if _data_source is None:
+        _data_source = create_data_source()
+        logger.info(f"Using {_data_source.name} data source")
+    return _data_source
+
+
+def set_data_source(source):
+    """ Sets the data source used by the pipeline, e.g. an InMemoryDataSource in tests.
+
+    Returns the previous data source.
+    """
+    global _data_source
+    previous, _data_source = _data_source, source
+    return previous
@@ -20,7 +20,7 @@ from requests.packages.urllib3.util.retry import Retry
 
 from collections import defaultdict
 
-from corona import logger, logging
+from corona import logger, logging, profiling
 from corona.map.utils import make_bounding_box
 from corona.utils import haversine_distance
 from corona.config import __CONFIG__
@@ -284,6 +284,18 @@ class RetrySession(requests.Session):
         self.mount("https://", adapter)
 
 
+# Optional hook around OSM requests, called as interceptor(url, fetch) where fetch() performs the request.
+# Used to record and replay responses (see corona.replay).
+_http_interceptor = None
+
+
+def set_http_interceptor(interceptor):
+    """ Sets the hook around OSM requests (None to disable). Returns the previous hook. """
+    global _http_interceptor
+    previous, _http_interceptor = _http_interceptor, interceptor
+    return previous
+
+
 def query_batch(queries: List[str]) -> str:
     batched_query: str = ""
     for i, query in enumerate(queries):
@@ -337,7 +349,12 @@ class OSMBaseAPI:
         # filename: str = os.path.join(self.cachedir, self.__hash(url))
         # if self.caching and os.path.exists(filename):
         #     return self.__load_from_cache(filename)
-        response = self.session.get(url, timeout=self.timeout).json()
+        profiling.count("http_calls")
+        interceptor = _http_interceptor
+        if interceptor is not None:
+            response = interceptor(url, lambda: self.session.get(url, timeout=self.timeout).json())
+        else:
+            response = self.session.get(url, timeout=self.timeout).json()
         # if self.caching:
         #     self.__save_to_cache(filename, response)
         return response
@@ -0,0 +1,135 @@
+""" Optional execution profiles for runs of the analysis pipeline.
+
+A Profile collects a structured breakdown of a single pipeline run:
+
+- wall and CPU time per stage (from corona.utils.timer blocks with a stage)
+- counters (SQL calls and rows, HTTP calls, candidates, ...) via count()
+- peak resident memory of the process
+- optionally, a cProfile summary of the most expensive functions
+
+The output of Profile.to_dict() is plain json with sorted keys and rounded
+numbers, so that profiles of two runs can be compared with a plain diff.
+"""
+
+import cProfile
+import io
+import pstats
+import random
+import resource
+import sys
+import threading
+import time
+from collections import defaultdict
+
+from corona.utils import add_timer_observer, remove_timer_observer
+
+# the profile of the currently running pipeline, if any
+_active_profile = None
+
+
+def count(name, n=1):
+    """ Increment counter `name` by n on the active profile (if any) """
+    profile = _active_profile
+    if profile is not None:
+        profile.count(name, n)
+
+
+def peak_rss_mb():
+    """ Peak resident set size of this process in MB """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, kilobytes elsewhere
+    if sys.platform == "darwin":
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+class Profile(object):
+    """ Execution profile of a single pipeline run.
+
+    :param cprofile_sample_rate: Fraction of runs (0-1) to also run under cProfile.
+    :param cprofile_top: Number of functions to include in the cProfile summary.
+    """
+
+    def __init__(self, cprofile_sample_rate=0, cprofile_top=25):
+        self.cprofile_top = cprofile_top
+        self.cprofiled = cprofile_sample_rate > 0 and random.random() < cprofile_sample_rate
+
+        self._lock = threading.Lock()
+        self._stages = defaultdict(lambda: {"calls": 0, "failed": 0, "wall_s": 0.0, "cpu_s": 0.0})
+        self._counts = defaultdict(int)
+        self._profiler = None
+        self._wall = None
+        self._cpu = None
+        self._peak_rss_mb_start = None
+        self._peak_rss_mb = None
+
+    def count(self, name, n=1):
+        with self._lock:
+            self._counts[name] += n
+
+    def _observe_stage(self, stage, seconds, failed, cpu_seconds):
+        with self._lock:
+            s = self._stages[stage]
+            s["calls"] += 1
+            s["failed"] += int(failed)
+            s["wall_s"] += seconds
+            s["cpu_s"] += cpu_seconds
+
+    def start(self):
+        """ Start collecting. Only one profile can be active at a time. """
+        global _active_profile
+        if _active_profile is not None:
+            raise RuntimeError("Another profile is already active")
+        _active_profile = self
+        add_timer_observer(self._observe_stage)
+        self._peak_rss_mb_start = peak_rss_mb()
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        if self.cprofiled:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    def stop(self):
+        """ Stop collecting """
+        global _active_profile
+        if self._profiler is not None:
+            self._profiler.disable()
+        self._wall = time.perf_counter() - self._wall
+        self._cpu = time.process_time() - self._cpu
+        self._peak_rss_mb = peak_rss_mb()
+        remove_timer_observer(self._observe_stage)
+        if _active_profile is self:
+            _active_profile = None
+
+    def _cprofile_summary(self):
+        """ The top functions by cumulative time as a list of dicts """
+        stats = pstats.Stats(self._profiler, stream=io.StringIO())
+        stats.sort_stats("cumulative")
+        summary = []
+        for func in stats.fcn_list[:self.cprofile_top]:
+            primitive_calls, calls, total_time, cumulative_time, _ = stats.stats[func]
+            filename, line, name = func
+            summary.append({
+                "function": f"{filename}:{line}({name})",
+                "calls": calls,
+                "tottime_s": round(total_time, 3),
+                "cumtime_s": round(cumulative_time, 3),
+            })
+        return summary
+
+    def to_dict(self):
+        """ Returns the profile as a json-serializable dictionary """
+        d = {
+            "wall_s": round(self._wall, 3),
+            "cpu_s": round(self._cpu, 3),
+            "peak_rss_mb": round(self._peak_rss_mb, 1),
+            "peak_rss_mb_at_start": round(self._peak_rss_mb_start, 1),
+            "stages": {
+                stage: {key: round(value, 3) for key, value in sorted(s.items())}
+                for stage, s in sorted(self._stages.items())
+            },
+            "counts": dict(sorted(self._counts.items())),
+        }
+        if self._profiler is not None:
+            d["cprofile"] = self._cprofile_summary()
+        return d
@@ -0,0 +1,288 @@
+""" Recording and differential replay of analysis jobs.
+
+A job is recorded into a local bundle: a directory holding every data source
+query and OSM response of one pipeline run, together with its output.
+
+    <bundle>/manifest.json   patient, analysis period and the recorded queries
+    <bundle>/queries/*.pkl   the frame returned by each data source query
+    <bundle>/http.json       OSM responses by url (relative to the endpoint)
+    <bundle>/output.json     the output of the recorded run
+
+replay_bundle() runs the pipeline of the current code against a bundle,
+without database or network access, and diff_outputs() compares two outputs
+field by field with numeric tolerances. Running replay_bundle() on two code
+versions and diffing the outputs shows whether a change alters the reported contacts.
+
+Queries issued during replay that were not recorded (e.g. after changing how
+trajectories are loaded) are answered by filtering all recorded rows, and are
+listed as misses in the replay result.
+"""
+
+import fnmatch
+import json
+import math
+import os
+import threading
+
+import pandas as pd
+
+from corona import logger
+from corona.datasource import DataSource, InMemoryDataSource, get_data_source, set_data_source
+from corona.map.api import NominatimAPI, OverpassAPI, set_http_interceptor
+
+BUNDLE_VERSION = 1
+# keys ignored by default when diffing: rendered images and the pipeline version
+DEFAULT_IGNORE = ("*_plot", "*/version_info/pipeline")
+
+_QUERY_METHODS = ("get_trajectory_speed", "get_within_bb", "get_bluetooth_pairing", "get_device_information")
+
+
+def _query_key(method, args):
+    return json.dumps([method] + [str(arg) for arg in args])
+
+
+def _relative_url(url):
+    """ Strips the configured OSM endpoints, so that bundles do not depend on them """
+    for endpoint in (OverpassAPI.endpoint, NominatimAPI.endpoint):
+        if endpoint and url.startswith(endpoint):
+            return url[len(endpoint):]
+    return url
+
+
+def _json_default(obj):
+    if isinstance(obj, set):
+        return sorted(obj)
+    return str(obj)
+
+
+def normalize_output(output):
+    """ Converts a pipeline output to plain json types """
+    return json.loads(json.dumps(output, default=_json_default))
+
+
+class RecordingDataSource(DataSource):
+    """ Forwards queries to another data source, keeping each query and its result """
+
+    def __init__(self, source):
+        self.source = source
+        self.name = f"recording {source.name}"
+        self.queries = []
+        self._lock = threading.Lock()
+
+    def _record(self, method, *args):
+        df = getattr(self.source, method)(*args)
+        with self._lock:
+            self.queries.append((method, [str(arg) for arg in args], df.copy()))
+        return df
+
+    def get_trajectory_speed(self, uuid, time_from, time_to):
+        return self._record("get_trajectory_speed", uuid, time_from, time_to)
+
+    def get_within_bb(self, long_min, lat_min, long_max, lat_max, time_from, time_to):
+        return self._record("get_within_bb", long_min, lat_min, long_max, lat_max, time_from, time_to)
+
+    def get_bluetooth_pairing(self, uuid, time_from, time_to):
+        return self._record("get_bluetooth_pairing", uuid, time_from, time_to)
+
+    def get_device_information(self, uuid):
+        return self._record("get_device_information", uuid)
+
+    def close(self):
+        self.source.close()
+
+
+class ReplayDataSource(InMemoryDataSource):
+    """ Answers queries from a recording.
+
+    Recorded queries return exactly the recorded frame. Other queries are
+    answered from all recorded rows like an InMemoryDataSource, and listed in misses.
+    """
+
+    name = "replay"
+
+    def __init__(self, queries):
+        self._recorded = {}
+        frames = {method: [] for method in _QUERY_METHODS}
+        for method, args, df in queries:
+            self._recorded[_query_key(method, args)] = df
+            frames[method].append(df)
+        self.misses = []
+
+        def union(method_frames):
+            if not method_frames:
+                return None
+            return pd.concat(method_frames, ignore_index=True).drop_duplicates(ignore_index=True)
+
+        gps = union(frames["get_trajectory_speed"] + frames["get_within_bb"])
+        bluetooth = union(frames["get_bluetooth_pairing"])
+        if bluetooth is not None:
+            bluetooth = bluetooth[["uuid", "paireddeviceid", "pairedtime", "rssi"]]
+        super().__init__(gps=gps, bluetooth=bluetooth, device_info=union(frames["get_device_information"]))
+
+    def _replay(self, method, *args):
+        df = self._recorded.get(_query_key(method, args))
+        if df is not None:
+            return df.copy()
+        self.misses.append([method] + [str(arg) for arg in args])
+        return getattr(super(), method)(*args)
+
+    def get_trajectory_speed(self, uuid, time_from, time_to):
+        return self._replay("get_trajectory_speed", uuid, time_from, time_to)
+
+    def get_within_bb(self, long_min, lat_min, long_max, lat_max, time_from, time_to):
+        return self._replay("get_within_bb", long_min, lat_min, long_max, lat_max, time_from, time_to)
+
+    def get_bluetooth_pairing(self, uuid, time_from, time_to):
+        return self._replay("get_bluetooth_pairing", uuid, time_from, time_to)
+
+    def get_device_information(self, uuid):
+        return self._replay("get_device_information", uuid)
+
+
+def _run(patient_uuid, time_from, time_to, daily_summary, testing, source, interceptor):
+    # imported here, the pipeline pulls in plotting and map dependencies
+    from corona.analysis.analysis_pipeline import run_analysis_pipeline
+    from corona.analysis.default_parameters import params
+
+    previous_source = set_data_source(source)
+    previous_interceptor = set_http_interceptor(interceptor)
+    try:
+        output = run_analysis_pipeline(patient_uuid, timeFrom=time_from, timeTo=time_to,
+                                       daily_summary=daily_summary, include_maps=None, testing=testing)
+    finally:
+        set_http_interceptor(previous_interceptor)
+        set_data_source(previous_source)
+    return normalize_output(output), params["timeFrom"], params["timeTo"]
+
+
+def record_bundle(path, patient_uuid, timeFrom=None, timeTo=None, daily_summary=True, testing=False):
+    """ Runs the pipeline against the configured data source and OSM endpoints,
+    recording its inputs and output into a bundle at path.
+
+    :return: The output of the run
+    """
+    source = RecordingDataSource(get_data_source())
+    responses = {}
+    lock = threading.Lock()
+
+    def record_response(url, fetch):
+        response = fetch()
+        with lock:
+            responses[_relative_url(url)] = response
+        return response
+
+    output, time_from, time_to = _run(patient_uuid, timeFrom, timeTo, daily_summary, testing,
+                                      source, record_response)
+
+    os.makedirs(os.path.join(path, "queries"), exist_ok=True)
+    queries = []
+    for i, (method, args, df) in enumerate(source.queries):
+        filename = os.path.join("queries", f"{i:04d}.pkl")
+        df.to_pickle(os.path.join(path, filename))
+        queries.append({"method": method, "args": args, "file": filename})
+    manifest = {
+        "version": BUNDLE_VERSION,
+        "patient_uuid": patient_uuid,
+        "time_from": time_from.isoformat(),
+        "time_to": time_to.isoformat(),
+        "daily_summary": daily_summary,
+        "testing": testing,
+        "queries": queries,
+    }
+    for filename, data in (("manifest.json", manifest), ("http.json", responses), ("output.json", output)):
+        with open(os.path.join(path, filename), "w") as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+    logger.info(f"Recorded {len(queries)} queries and {len(responses)} OSM responses to {path}")
+    return output
+
+
+def load_bundle(path):
+    """ Loads a bundle as (manifest, queries, http responses, recorded output) """
+    with open(os.path.join(path, "manifest.json")) as f:
+        manifest = json.load(f)
+    if manifest["version"] != BUNDLE_VERSION:
+        raise ValueError(f"Unsupported bundle version {manifest['version']} in {path}")
+    queries = [(q["method"], q["args"], pd.read_pickle(os.path.join(path, q["file"])))
+               for q in manifest["queries"]]
+    with open(os.path.join(path, "http.json")) as f:
+        responses = json.load(f)
+    with open(os.path.join(path, "output.json")) as f:
+        output = json.load(f)
+    return manifest, queries, responses, output
+
+
+def replay_bundle(path):
+    """ Runs the pipeline of the current code against a bundle, offline.
+
+    :return: Dictionary with the output, the recorded output and the data source and OSM misses
+    """
+    manifest, queries, responses, recorded_output = load_bundle(path)
+    source = ReplayDataSource(queries)
+    http_misses = []
+
+    def replay_response(url, fetch):
+        relative_url = _relative_url(url)
+        if relative_url not in responses:
+            http_misses.append(relative_url)
+            raise KeyError(f"No recorded response for {relative_url}")
+        return responses[relative_url]
+
+    output, _, _ = _run(manifest["patient_uuid"], pd.Timestamp(manifest["time_from"]).to_pydatetime(),
+                        pd.Timestamp(manifest["time_to"]).to_pydatetime(), manifest["daily_summary"],
+                        manifest["testing"], source, replay_response)
+    if source.misses or http_misses:
+        logger.warning(f"Replay of {path} issued {len(source.misses)} unrecorded queries "
+                       f"and {len(http_misses)} unrecorded OSM requests")
+    return {
+        "output": output,
+        "recorded_output": recorded_output,
+        "query_misses": source.misses,
+        "http_misses": http_misses,
+    }
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def diff_outputs(a, b, rtol=1e-6, atol=1e-9, ignore=DEFAULT_IGNORE, _path=""):
+    """ Compares two pipeline outputs field by field.
+
+    :param a: First output (as returned by normalize_output)
+    :param b: Second output
+    :param rtol: Relative tolerance for numbers
+    :param atol: Absolute tolerance for numbers
+    :param ignore: fnmatch patterns of paths ("<uuid>/daily/<day>/...") that are not compared
+    :return: List of differences, each a dictionary with path, kind ("missing", "added", "type" or "value"), a and b
+    """
+    if _path and any(fnmatch.fnmatchcase(_path, pattern) for pattern in ignore):
+        return []
+    if isinstance(a, dict) and isinstance(b, dict):
+        differences = []
+        for key in sorted(set(a) | set(b), key=str):
+            path = f"{_path}/{key}" if _path else str(key)
+            if key not in b:
+                if not any(fnmatch.fnmatchcase(path, pattern) for pattern in ignore):
+                    differences.append({"path": path, "kind": "missing", "a": a[key], "b": None})
+            elif key not in a:
+                if not any(fnmatch.fnmatchcase(path, pattern) for pattern in ignore):
+                    differences.append({"path": path, "kind": "added", "a": None, "b": b[key]})
+            else:
+                differences += diff_outputs(a[key], b[key], rtol, atol, ignore, path)
+        return differences
+    if isinstance(a, list) and isinstance(b, list):
+        if len(a) != len(b):
+            return [{"path": _path, "kind": "value", "a": a, "b": b}]
+        differences = []
+        for i, (item_a, item_b) in enumerate(zip(a, b)):
+            differences += diff_outputs(item_a, item_b, rtol, atol, ignore, f"{_path}/{i}")
+        return differences
+    if _is_number(a) and _is_number(b):
+        if math.isclose(a, b, rel_tol=rtol, abs_tol=atol) or (math.isnan(a) and math.isnan(b)):
+            return []
+        return [{"path": _path, "kind": "value", "a": a, "b": b}]
+    if type(a) != type(b):
+        return [{"path": _path, "kind": "type", "a": a, "b": b}]
+    if a != b:
+        return [{"path": _path, "kind": "value", "a": a, "b": b}]
+    return []
@@ -0,0 +1,179 @@
+""" Deterministic synthetic populations for testing and benchmarking.
+
+generate_population() creates GPS and Bluetooth data for a population of devices
+following a daily home -> work -> home routine:
+
+- homes are spread uniformly over a square area sized by the requested density
+- devices share a limited number of workplaces, so that they meet each other
+- devices leave home in the morning, travel (walking or by vehicle) to work,
+  stay there for the day, and travel back home in the evening
+- GPS positions are sampled sparsely when stationary and densely in transit,
+  with log-normal accuracy, matching position noise and random gaps
+- colleagues present at the same workplace at the same time exchange Bluetooth pairings
+
+The same arguments always produce the same data.
+The frames can be used directly by corona.datasource.InMemoryDataSource,
+or written to disk with corona.datasource.write_parquet_dataset.
+"""
+
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+# meters per degree latitude (and longitude at the equator)
+_METERS_PER_DEGREE = 111320.0
+# centre of the generated area (Oslo)
+_CENTER = (59.91, 10.75)
+
+_PLATFORMS = ["android", "ios"]
+_MODELS = {"android": ["Pixel 3", "Galaxy S9", "Moto G7"], "ios": ["iPhone8,1", "iPhone11,8", "iPhone12,1"]}
+
+
+def device_uuids(n_devices, seed=0):
+    """ The uuids of the devices in a population, as 32 character hex strings """
+    return [f"{seed:08x}{i:024x}" for i in range(n_devices)]
+
+
+def _meters_to_degrees(lat, dy, dx):
+    """ Converts offsets in meters to offsets in degrees around latitude lat """
+    return dy / _METERS_PER_DEGREE, dx / (_METERS_PER_DEGREE * np.cos(np.radians(lat)))
+
+
+def generate_population(n_devices, days=1, seed=0, density=1000, start=datetime(2020, 4, 6),
+                        people_per_workplace=25, stationary_interval=600, transit_samples=15,
+                        gap_probability=0.05, bt_interval=300, bt_neighbours=1):
+    """ Generates a synthetic population.
+
+    :param n_devices: Number of devices
+    :param days: Number of days to generate, starting at start
+    :param seed: Random seed, the output is fully determined by the arguments
+    :param density: Devices per square kilometer, controls how often devices meet
+    :param start: Start of the first day (naive UTC)
+    :param people_per_workplace: Average number of devices sharing a workplace
+    :param stationary_interval: Seconds between GPS samples when stationary
+    :param transit_samples: Number of GPS samples per trip
+    :param gap_probability: Probability that an hour of GPS data is missing for a device
+    :param bt_interval: Seconds between Bluetooth pairings of colleagues
+    :param bt_neighbours: Number of colleagues each device is paired with at work
+    :return: gps, bluetooth and device_info data frames
+    """
+    rng = np.random.default_rng(seed)
+    uuids = device_uuids(n_devices, seed)
+    n = n_devices
+
+    # Places
+    side = np.sqrt(n / density) * 1000  # meters
+    lat0, lon0 = _CENTER
+    home_dy, home_dx = rng.uniform(-side / 2, side / 2, size=(2, n))
+    n_workplaces = max(1, n // people_per_workplace)
+    work_dy, work_dx = rng.uniform(-side / 2, side / 2, size=(2, n_workplaces))
+    workplace = rng.integers(0, n_workplaces, size=n)
+    # desks within a workplace are a few meters apart
+    desk_dy, desk_dx = rng.normal(0, 10, size=(2, n))
+    home = np.array(_meters_to_degrees(lat0, home_dy, home_dx)) + np.array([[lat0], [lon0]])
+    work = np.array(_meters_to_degrees(lat0, work_dy[workplace] + desk_dy, work_dx[workplace] + desk_dx)) + \
+        np.array([[lat0], [lon0]])
+    distance = np.hypot(work_dy[workplace] + desk_dy - home_dy, work_dx[workplace] + desk_dx - home_dx)
+    # walk short distances, drive longer ones
+    speed = np.where(distance < 1500, 1.4, 10.0)
+    transit = np.maximum(distance / speed, 60)
+
+    gps_frames = []
+    bt_frames = []
+    for day in range(days):
+        day_start = pd.Timestamp(start) + pd.Timedelta(days=day)
+        leave_home = rng.normal(8 * 3600, 1800, size=n)
+        arrive_work = leave_home + transit
+        leave_work = arrive_work + rng.normal(8 * 3600, 1800, size=n)
+        arrive_home = leave_work + transit
+
+        # stationary samples on a per-device grid, transit samples spread over each trip
+        offsets = rng.uniform(0, stationary_interval, size=n)
+        grid = np.arange(0, 24 * 3600, stationary_interval)
+        t_still = offsets[:, None] + grid[None, :]
+        still = (t_still < leave_home[:, None]) | (t_still >= arrive_home[:, None]) | \
+            ((t_still >= arrive_work[:, None]) & (t_still < leave_work[:, None]))
+        fractions = (np.arange(transit_samples) + 0.5) / transit_samples
+        t_to_work = leave_home[:, None] + fractions[None, :] * transit[:, None]
+        t_to_home = leave_work[:, None] + fractions[None, :] * transit[:, None]
+
+        idx_still, col_still = np.nonzero(still)
+        t_still = t_still[idx_still, col_still]
+        idx_transit = np.repeat(np.arange(n), 2 * transit_samples)
+        t_transit = np.concatenate([t_to_work, t_to_home], axis=1).ravel()
+        idx = np.concatenate([idx_still, idx_transit])
+        t = np.concatenate([t_still, t_transit])
+        moving = np.concatenate([np.zeros(len(t_still), dtype=bool), np.ones(len(t_transit), dtype=bool)])
+
+        # position along the routine: 0 at home, 1 at work
+        progress = np.clip((t - leave_home[idx]) / transit[idx], 0, 1) - \
+            np.clip((t - leave_work[idx]) / transit[idx], 0, 1)
+        lat = home[0, idx] + progress * (work[0, idx] - home[0, idx])
+        lon = home[1, idx] + progress * (work[1, idx] - home[1, idx])
+
+        # measurement noise matching the reported accuracy
+        accuracy = np.clip(rng.lognormal(np.log(10), 0.7, size=len(t)), 3, 500).round()
+        noise_dy, noise_dx = rng.normal(0, 1, size=(2, len(t))) * accuracy / 2
+        dlat, dlon = _meters_to_degrees(lat0, noise_dy, noise_dx)
+
+        # missing hours of data
+        hour = (t // 3600).astype(int).clip(0, 23)
+        gaps = rng.random(size=(n, 24)) < gap_probability
+        keep = ~gaps[idx, hour]
+
+        timefrom = t.round()
+        # stationary events cover the time until the next sample
+        timeto = np.where(moving, timefrom, timefrom + stationary_interval - 1)
+        gps_frames.append(pd.DataFrame({
+            # categorical to keep large populations in memory
+            "uuid": pd.Categorical.from_codes(idx[keep], categories=uuids),
+            "timefrom": day_start + pd.to_timedelta(timefrom[keep], unit="s"),
+            "timeto": day_start + pd.to_timedelta(timeto[keep], unit="s"),
+            "latitude": lat[keep] + dlat[keep],
+            "longitude": lon[keep] + dlon[keep],
+            "accuracy": accuracy[keep],
+            "speed": np.where(moving, speed[idx], 0.0)[keep],
+        }))
+
+        bt_frames.append(_colleague_pairings(rng, uuids, workplace, arrive_work, leave_work, day_start,
+                                             bt_interval, bt_neighbours))
+
+    gps = pd.concat(gps_frames, ignore_index=True).sort_values(["uuid", "timefrom"], ignore_index=True)
+    bluetooth = pd.concat(bt_frames, ignore_index=True).sort_values("pairedtime", ignore_index=True)
+
+    platform = rng.integers(0, len(_PLATFORMS), size=n)
+    model = rng.integers(0, 3, size=n)
+    device_info = pd.DataFrame({
+        "uuid": uuids,
+        "platform": [_PLATFORMS[p] for p in platform],
+        "model": [_MODELS[_PLATFORMS[p]][m] for p, m in zip(platform, model)],
+        "appversion": "1.0.0",
+    })
+    return gps, bluetooth, device_info
+
+
+def _colleague_pairings(rng, uuids, workplace, arrive_work, leave_work, day_start, bt_interval, bt_neighbours):
+    """ Bluetooth pairings between colleagues at the same workplace at the same time """
+    order = np.lexsort((np.arange(len(workplace)), workplace))
+    frames = []
+    for shift in range(1, bt_neighbours + 1):
+        # pair each device with the device `shift` places later at the same workplace
+        a, b = order[:-shift], order[shift:]
+        same = workplace[a] == workplace[b]
+        a, b = a[same], b[same]
+        begin = np.maximum(arrive_work[a], arrive_work[b])
+        end = np.minimum(leave_work[a], leave_work[b])
+        count = np.maximum(np.floor((end - begin) / bt_interval).astype(int), 0)
+        pair = np.repeat(np.arange(len(a)), count)
+        step = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        t = begin[pair] + step * bt_interval
+        frames.append(pd.DataFrame({
+            "uuid": pd.Categorical.from_codes(a[pair], categories=uuids),
+            "paireddeviceid": pd.Categorical.from_codes(b[pair], categories=uuids),
+            "pairedtime": day_start + pd.to_timedelta(t.round(), unit="s"),
+            "rssi": np.clip(rng.normal(-70, 8, size=len(t)), -110, -30).round(),
+        }))
+    if not frames:
+        return pd.DataFrame(columns=["uuid", "paireddeviceid", "pairedtime", "rssi"])
+    return pd.concat(frames, ignore_index=True)
@@ -180,10 +180,37 @@ def retry(ExceptionCheck, tries=8, delay=3, backoff=2):
     return deco_retry
 
 
+# callables of the form f(stage, seconds, failed, cpu_seconds)
+# notified by timer(stage=...)
+_timer_observers = []
+
+
+def add_timer_observer(observer):
+    """Register a callable to be notified of every timed stage
+
+    observer is called with (stage, seconds, failed, cpu_seconds)
+    for each timer(..., stage=stage) block that finishes.
+    cpu_seconds is process-wide CPU time, including other threads.
+    """
+    if observer not in _timer_observers:
+        _timer_observers.append(observer)
+
+
+def remove_timer_observer(observer):
+    """Stop notifying observer of timed stages"""
+    if observer in _timer_observers:
+        _timer_observers.remove(observer)
+
+
 @contextmanager
-def timer(message):
-    """Context manager for reporting time measurements"""
+def timer(message, stage=None):
+    """Context manager for reporting time measurements
+
+    If stage is given, registered timer observers (e.g. metrics)
+    are notified of the measurement in addition to logging.
+    """
     tic = time.perf_counter()
+    cpu_tic = time.process_time()
     extra = ""
     try:
         yield
@@ -194,3 +221,11 @@ def timer(message):
         toc = time.perf_counter()
         ms = int(1000 * (toc - tic))
         logger.info(f"{message}{extra}: {ms}ms")
+        if stage is not None:
+            for observer in list(_timer_observers):
+                try:
+                    observer(
+                        stage, toc - tic, bool(extra), time.process_time() - cpu_tic
+                    )
+                except Exception:
+                    logger.exception(f"Error in timer observer for {stage}")
@@ -0,0 +1,28 @@
+import argparse, sys
+from corona.benchmark import DEFAULT_SCALES, run_benchmark
+
+
+# Read command line arguments
+parser = argparse.ArgumentParser(description='Benchmark the analysis pipeline on synthetic populations.')
+parser.add_argument('-s', '--scales', default=','.join(str(s) for s in DEFAULT_SCALES),
+                    help='comma separated population sizes (number of devices)')
+parser.add_argument('-d', '--days', type=int, default=1, help='number of days of data')
+parser.add_argument('-p', '--patients', type=int, default=3, help='pipeline runs per population size')
+parser.add_argument('--seed', type=int, default=0, help='random seed of the populations')
+parser.add_argument('--density', type=float, default=1000, help='devices per square kilometer')
+parser.add_argument('--cprofile', action='store_true', help='include a cProfile summary for each run')
+parser.add_argument('--live-overpass', action='store_true',
+                    help='look up points of interest with the configured Overpass API instead of an empty local one')
+parser.add_argument('-o', '--output', help='json lines output file (default: stdout)')
+
+# Run the benchmark
+args = parser.parse_args()
+
+output = open(args.output, 'w') if args.output else sys.stdout
+try:
+    run_benchmark(scales=[int(s) for s in args.scales.split(',')], days=args.days, seed=args.seed,
+                  patients=args.patients, density=args.density, cprofile=args.cprofile,
+                  stub_overpass=not args.live_overpass, output=output)
+finally:
+    if output is not sys.stdout:
+        output.close()
@@ -0,0 +1,60 @@
+import argparse, json, sys
+from corona.replay import DEFAULT_IGNORE, diff_outputs, record_bundle, replay_bundle
+
+
+def load_output(filename):
+    '''Output of a pipeline run, from a replay result or an output.json of a bundle'''
+    with open(filename) as f:
+        data = json.load(f)
+    if "query_misses" in data:
+        return data["output"]
+    return data
+
+
+def print_differences(differences):
+    for d in differences:
+        print(json.dumps(d, sort_keys=True))
+    print(f"{len(differences)} differences", file=sys.stderr)
+    return 1 if differences else 0
+
+
+# Read command line arguments
+parser = argparse.ArgumentParser(description='Record analysis jobs and replay them to compare outputs between code versions.')
+subparsers = parser.add_subparsers(dest='command', required=True)
+
+record = subparsers.add_parser('record', help='run the pipeline for a patient and record its inputs and output')
+record.add_argument('bundle', help='bundle directory')
+record.add_argument('-p', '--patient', required=True, help='patient uuid')
+record.add_argument('--time-from', help='start of the analysis period (ISO format, UTC)')
+record.add_argument('--time-to', help='end of the analysis period (ISO format, UTC)')
+
+replay = subparsers.add_parser('replay', help='run the pipeline against a bundle and compare with the recorded output')
+replay.add_argument('bundle', help='bundle directory')
+replay.add_argument('-o', '--output', help='write the replay result (json) to this file')
+
+diff = subparsers.add_parser('diff', help='compare two outputs (replay results or bundle output.json files)')
+diff.add_argument('a')
+diff.add_argument('b')
+
+for p in (replay, diff):
+    p.add_argument('--rtol', type=float, default=1e-6, help='relative tolerance for numbers')
+    p.add_argument('--atol', type=float, default=1e-9, help='absolute tolerance for numbers')
+    p.add_argument('--ignore', nargs='*', default=list(DEFAULT_IGNORE), help='paths not compared (fnmatch patterns)')
+
+args = parser.parse_args()
+
+if args.command == 'record':
+    from datetime import datetime
+    record_bundle(args.bundle, args.patient,
+                  timeFrom=datetime.fromisoformat(args.time_from) if args.time_from else None,
+                  timeTo=datetime.fromisoformat(args.time_to) if args.time_to else None)
+elif args.command == 'replay':
+    result = replay_bundle(args.bundle)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=1, sort_keys=True)
+    sys.exit(print_differences(diff_outputs(result["recorded_output"], result["output"],
+                                            rtol=args.rtol, atol=args.atol, ignore=args.ignore)))
+else:
+    sys.exit(print_differences(diff_outputs(load_output(args.a), load_output(args.b),
+                                            rtol=args.rtol, atol=args.atol, ignore=args.ignore)))
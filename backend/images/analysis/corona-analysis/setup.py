@@ -6,5 +6,6 @@ setup(name="Smittestopp Analytics Pipeline",
       description="Smittestopp Analytics Pipeline scripts",
       author="Smittestopp Data Analytics Team",
       packages=["corona"],
-      scripts=["scripts/run_analysis_pipeline.py"],
+      scripts=["scripts/run_analysis_pipeline.py", "scripts/benchmark_pipeline.py",
+               "scripts/replay_analysis.py"],
      )
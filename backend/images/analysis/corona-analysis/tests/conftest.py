@@ -1,4 +1,37 @@
 import logging
 import sys
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from corona.map.api import OverpassAPI
 
 logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+
+
+class _EmptyOverpassHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(b'{"elements": []}')
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def local_overpass():
+    """ Serves an Overpass endpoint without any points of interest """
+    server = HTTPServer(("127.0.0.1", 0), _EmptyOverpassHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    endpoint = OverpassAPI.endpoint
+    OverpassAPI.endpoint = f"http://127.0.0.1:{server.server_port}/"
+    try:
+        yield OverpassAPI.endpoint
+    finally:
+        OverpassAPI.endpoint = endpoint
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,119 @@
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pytest
+
+from corona.analysis.analysis_pipeline import run_analysis_pipeline
+from corona.datasource import (
+    DataSource,
+    InMemoryDataSource,
+    ParquetDataSource,
+    create_data_source,
+    set_data_source,
+    write_parquet_dataset,
+)
+
+PATIENT = "a" * 32
+CONTACT = "b" * 32
+STRANGER = "c" * 32
+START = datetime(2020, 4, 10, 12, 0)
+
+
+def make_gps():
+    """Patient and contact walk together for an hour, a stranger is far away"""
+    rows = []
+    for i in range(120):
+        t = START + timedelta(seconds=30 * i)
+        for uuid, lat in ((PATIENT, 59.91), (CONTACT, 59.91001), (STRANGER, 63.43)):
+            rows.append(dict(uuid=uuid, timefrom=t, timeto=t + timedelta(seconds=29),
+                             latitude=lat + i * 1e-6, longitude=10.75, accuracy=5.0, speed=0.0))
+    return pd.DataFrame(rows)
+
+
+def make_bluetooth():
+    return pd.DataFrame([dict(uuid=PATIENT, paireddeviceid=CONTACT,
+                              pairedtime=START + timedelta(seconds=10 * i), rssi=-50)
+                         for i in range(200)])
+
+
+def make_device_info():
+    return pd.DataFrame([
+        dict(uuid=PATIENT, platform="android", model="model-a", appversion="1.0"),
+        dict(uuid=CONTACT, platform="ios", model="model-b", appversion="1.0"),
+    ])
+
+
+def test_data_source_interface():
+    class Incomplete(DataSource):
+        def get_trajectory_speed(self, uuid, time_from, time_to):
+            return pd.DataFrame()
+
+    # sources must implement every query
+    for cls in (DataSource, Incomplete):
+        with pytest.raises(TypeError):
+            cls()
+
+
+@pytest.fixture
+def source():
+    return InMemoryDataSource(gps=make_gps(), bluetooth=make_bluetooth(), device_info=make_device_info())
+
+
+def test_trajectory_speed(source):
+    df = source.get_trajectory_speed(PATIENT, START, START + timedelta(minutes=10))
+    assert set(df.uuid) == {PATIENT}
+    assert len(df) == 20
+    assert df.timefrom.min() >= START
+
+
+def test_within_bb(source):
+    df = source.get_within_bb(10.7, 59.9, 10.8, 59.92, "2020-04-10 12:00:00", "2020-04-10 13:00:00")
+    assert set(df.uuid) == {PATIENT, CONTACT}
+
+
+def test_bluetooth_pairing(source):
+    # tz-aware times are handled as UTC
+    df = source.get_bluetooth_pairing(CONTACT, pd.Timestamp(START, tz="UTC"),
+                                      pd.Timestamp(START + timedelta(minutes=1), tz="UTC"))
+    assert len(df) == 7
+    assert list(df.pair_platform.unique()) == ["ios"]
+    assert list(df.uuid_platform.unique()) == ["android"]
+    assert df.pairedtime_ut.iloc[0] == int(pd.Timestamp(START).timestamp())
+
+
+def test_device_information(source):
+    df = source.get_device_information(CONTACT)
+    assert df.to_dict("records") == [dict(uuid=CONTACT, platform="ios", model="model-b", appversion="1.0")]
+    assert len(source.get_device_information(STRANGER)) == 0
+
+
+def test_parquet_matches_memory(source, tmp_path):
+    pytest.importorskip("pyarrow")
+    write_parquet_dataset(str(tmp_path), gps=make_gps(), bluetooth=make_bluetooth(),
+                          device_info=make_device_info())
+    parquet = create_data_source({"source": "parquet", "path": str(tmp_path)})
+    assert isinstance(parquet, ParquetDataSource)
+
+    time_from, time_to = START - timedelta(days=1), START + timedelta(hours=1)
+    pd.testing.assert_frame_equal(
+        parquet.get_trajectory_speed(PATIENT, time_from, time_to),
+        source.get_trajectory_speed(PATIENT, time_from, time_to),
+        check_dtype=False,
+    )
+    pd.testing.assert_frame_equal(
+        parquet.get_bluetooth_pairing(PATIENT, time_from, time_to),
+        source.get_bluetooth_pairing(PATIENT, time_from, time_to),
+        check_dtype=False,
+    )
+    # days without data are fine
+    assert len(parquet.get_within_bb(0, 0, 90, 90, START + timedelta(days=5), START + timedelta(days=6))) == 0
+
+
+def test_run_pipeline_offline(source, local_overpass):
+    previous = set_data_source(source)
+    try:
+        d = run_analysis_pipeline(PATIENT, timeFrom=START - timedelta(hours=1),
+                                  timeTo=START + timedelta(hours=2), include_maps=None)
+    finally:
+        set_data_source(previous)
+    assert list(d.keys()) == [CONTACT]
@@ -0,0 +1,59 @@
+import json
+import os
+from datetime import timedelta
+
+import pytest
+
+from corona.datasource import InMemoryDataSource, set_data_source
+from corona.replay import diff_outputs, load_bundle, record_bundle, replay_bundle
+from test_datasource import CONTACT, PATIENT, START, make_bluetooth, make_device_info, make_gps
+
+
+@pytest.fixture
+def bundle(tmp_path, local_overpass):
+    previous = set_data_source(InMemoryDataSource(gps=make_gps(), bluetooth=make_bluetooth(),
+                                                  device_info=make_device_info()))
+    try:
+        record_bundle(str(tmp_path), PATIENT, timeFrom=START - timedelta(hours=1),
+                      timeTo=START + timedelta(hours=2))
+    finally:
+        set_data_source(previous)
+    return str(tmp_path)
+
+
+def test_record_and_replay(bundle):
+    manifest, queries, responses, output = load_bundle(bundle)
+    assert manifest["patient_uuid"] == PATIENT
+    assert {method for method, _, _ in queries} >= {"get_trajectory_speed", "get_bluetooth_pairing"}
+    assert list(output.keys()) == [CONTACT]
+
+    # replays offline: no data source or Overpass endpoint is available here
+    result = replay_bundle(bundle)
+    assert result["query_misses"] == []
+    assert result["http_misses"] == []
+    assert diff_outputs(result["recorded_output"], result["output"]) == []
+
+
+def test_replay_detects_changed_inputs(bundle):
+    manifest, queries, _, _ = load_bundle(bundle)
+    # drop the Bluetooth pairings from the recording
+    for query, (method, _, df) in zip(manifest["queries"], queries):
+        if method == "get_bluetooth_pairing":
+            df.iloc[:0].to_pickle(os.path.join(bundle, query["file"]))
+
+    result = replay_bundle(bundle)
+    differences = diff_outputs(result["recorded_output"], result["output"])
+    assert differences
+    assert all(d["path"].startswith(CONTACT) for d in differences)
+
+
+def test_diff_outputs():
+    a = {"x": {"duration": 100.0, "days": 2, "poi": "residential", "bar_plot": "abc", "list": [1, 2]}}
+    assert diff_outputs(a, json.loads(json.dumps(a))) == []
+    b = {"x": {"duration": 100.00001, "days": 2, "poi": "residential", "bar_plot": "xyz", "list": [1, 2],
+               "new": 1}}
+    assert diff_outputs(a, b, rtol=1e-6) == [{"path": "x/new", "kind": "added", "a": None, "b": 1}]
+    assert [d["path"] for d in diff_outputs(a, b, rtol=1e-9)] == ["x/duration", "x/new"]
+    assert [d["path"] for d in diff_outputs(a, b, ignore=())] == ["x/bar_plot", "x/new"]
+    assert diff_outputs({"x": [1, 2]}, {"x": [1, 3]}) == [{"path": "x/1", "kind": "value", "a": 2, "b": 3}]
+    assert diff_outputs({"x": 1}, {"x": "1"})[0]["kind"] == "type"
@@ -0,0 +1,46 @@
+import io
+import json
+
+import pandas as pd
+
+from corona.benchmark import run_benchmark
+from corona.datasource import BLUETOOTH_COLUMNS, GPS_COLUMNS, InMemoryDataSource
+from corona.synthetic import device_uuids, generate_population
+
+
+def test_population_is_deterministic():
+    a = generate_population(50, days=2, seed=1)
+    b = generate_population(50, days=2, seed=1)
+    for df_a, df_b in zip(a, b):
+        pd.testing.assert_frame_equal(df_a, df_b)
+    c = generate_population(50, days=2, seed=2)
+    assert not a[0]["latitude"].equals(c[0]["latitude"])
+
+
+def test_population_matches_data_source_columns():
+    gps, bluetooth, device_info = generate_population(100, seed=0)
+    assert list(gps.columns) == GPS_COLUMNS
+    assert set(gps["uuid"].astype(str)) <= set(device_uuids(100))
+    assert (gps["timeto"] >= gps["timefrom"]).all()
+    assert len(bluetooth) > 0
+    assert set(device_info["uuid"]) == set(device_uuids(100))
+
+    source = InMemoryDataSource(gps=gps, bluetooth=bluetooth, device_info=device_info)
+    patient = bluetooth["uuid"].iloc[0]
+    day = gps["timefrom"].min().normalize()
+    pairings = source.get_bluetooth_pairing(patient, day, day + pd.Timedelta(days=1))
+    assert list(pairings.columns) == BLUETOOTH_COLUMNS
+    assert len(pairings) > 0
+    assert len(source.get_trajectory_speed(patient, day, day + pd.Timedelta(days=1))) > 0
+
+
+def test_benchmark_output():
+    output = io.StringIO()
+    records = run_benchmark(scales=[30], patients=1, output=output)
+    lines = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert lines == json.loads(json.dumps(records))
+    assert [r["record"] for r in lines] == ["population", "run", "summary"]
+    run = lines[1]
+    assert run["status"] == "success"
+    assert run["profile"]["counts"]["gps_candidates"] >= 0
+    assert lines[2]["errors"] == 0
@@ -1,6 +1,8 @@
 import pytest
 import numpy as np
-from corona.utils import sparsify_mask
+from corona import profiling
+from corona.profiling import Profile
+from corona.utils import add_timer_observer, remove_timer_observer, sparsify_mask, timer
 
 
 def test_sparsify():
@@ -19,3 +21,62 @@ def test_sparsify():
     l = np.array([1, 2, 3, 6])
     idx = sparsify_mask(l, 3)
     assert np.all(l[idx] == l[[0, 3]])
+
+
+def test_timer_observer():
+    observed = []
+
+    def observer(stage, seconds, failed, cpu_seconds):
+        observed.append((stage, failed))
+
+    add_timer_observer(observer)
+    try:
+        with timer("no stage"):
+            pass
+        with timer("with stage", stage="sql_load"):
+            pass
+        with pytest.raises(ValueError):
+            with timer("failing stage", stage="edges"):
+                raise ValueError()
+    finally:
+        remove_timer_observer(observer)
+
+    with timer("after removal", stage="sql_load"):
+        pass
+
+    assert observed == [("sql_load", False), ("edges", True)]
+
+
+def test_profile():
+    profile = Profile()
+    profile.start()
+    try:
+        with timer("sql", stage="sql_load"):
+            profiling.count("sql_calls")
+            profiling.count("sql_rows", 10)
+        with timer("sql", stage="sql_load"):
+            profiling.count("sql_calls")
+            profiling.count("sql_rows", 5)
+    finally:
+        profile.stop()
+
+    # not counted after stopping
+    profiling.count("sql_calls")
+
+    d = profile.to_dict()
+    assert d["counts"] == {"sql_calls": 2, "sql_rows": 15}
+    assert list(d["stages"]) == ["sql_load"]
+    assert d["stages"]["sql_load"]["calls"] == 2
+    assert d["stages"]["sql_load"]["failed"] == 0
+    assert d["peak_rss_mb"] > 0
+    assert "cprofile" not in d
+
+
+def test_profile_cprofile():
+    profile = Profile(cprofile_sample_rate=1, cprofile_top=5)
+    profile.start()
+    sum(range(1000))
+    profile.stop()
+    summary = profile.to_dict()["cprofile"]
+    assert 0 < len(summary) <= 5
+    assert set(summary[0]) == {"function", "calls", "tottime_s", "cumtime_s"}
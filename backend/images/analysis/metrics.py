@@ -0,0 +1,74 @@
+"""Prometheus metrics for the analysis worker
+
+Metrics are served on a local http endpoint (METRICS_PORT)
+so they can be scraped from the worker pod.
+
+Per-stage timings are collected by registering an observer
+for corona.utils.timer blocks that specify a stage.
+Lease metrics are defined alongside the queue in rediswq.
+"""
+
+import os
+
+from prometheus_client import Histogram, start_http_server
+from tornado.log import app_log
+
+from corona.utils import add_timer_observer
+
+METRICS_PORT = int(os.environ.get("METRICS_PORT") or 8080)
+
+# analysis jobs can take anywhere from seconds to tens of minutes
+JOB_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, float("inf"))
+STAGE_BUCKETS = (
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+    1,
+    5,
+    10,
+    30,
+    60,
+    120,
+    300,
+    600,
+    float("inf"),
+)
+CANDIDATE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, float("inf"))
+
+job_duration = Histogram(
+    "analysis_job_duration_seconds",
+    "Time to process one analysis job",
+    ["status"],
+    buckets=JOB_BUCKETS,
+)
+stage_duration = Histogram(
+    "analysis_stage_duration_seconds",
+    "Time spent in each stage of the analysis pipeline",
+    ["stage", "status"],
+    buckets=STAGE_BUCKETS,
+)
+candidates_per_job = Histogram(
+    "analysis_candidates_per_job",
+    "Number of contacts reported for one analysis job",
+    buckets=CANDIDATE_BUCKETS,
+)
+queue_wait = Histogram(
+    "analysis_queue_wait_seconds",
+    "Time from job submission until a worker picks it up",
+    buckets=JOB_BUCKETS,
+)
+
+
+def observe_stage(stage, seconds, failed, cpu_seconds):
+    """Timer observer recording pipeline stage durations"""
+    stage_duration.labels(
+        stage=stage, status="failed" if failed else "success"
+    ).observe(seconds)
+
+
+def start_metrics_server(port=METRICS_PORT):
+    """Start serving /metrics and begin collecting pipeline stage timings"""
+    add_timer_observer(observe_stage)
+    app_log.info(f"Serving metrics on port {port}")
+    start_http_server(port)
@@ -12,10 +12,19 @@ import json
 from threading import Thread, Lock
 
 import redis
+from prometheus_client import Counter
 from redlock import Redlock
 
 from tornado.log import app_log
 
+lease_renewals = Counter(
+    "analysis_lease_renewals_total", "Number of times a job lease has been renewed"
+)
+lease_expirations = Counter(
+    "analysis_lease_expirations_total",
+    "Number of expired leases returned to the job queue",
+)
+
 
 class RedisDistributedLock:
     # nemivir, Apache license 2.0
@@ -71,6 +80,7 @@ class Lease:
                 return
             else:
                 self._renew()
+                lease_renewals.inc()
 
     def acquire(self):
         """Acquire and hold lease on our key
@@ -180,6 +190,7 @@ class RedisWQ:
                     # no lease exists, move back to main
                     self._db.lpush(self._main_q_key, item)
                     self._db.lrem(self._processing_q_key, 1, item)
+                    lease_expirations.inc()
 
     def _itemkey(self, item):
         """Returns a string that uniquely identifies an item (bytes)."""
@@ -235,17 +246,30 @@ class RedisWQ:
         lease = self._leases.pop(item)
         lease.release()
 
-    def complete(self, item, result_key, expiry, result):
+    def complete(self, item, result_key, expiry, result, done_key=None):
         """Complete working on the item with 'value'.
 
+        If done_key is given, the item is added to the set of completed
+        items at done_key, and its key is published on the done_key channel,
+        so that readiness of a request can be checked with a single SCARD
+        and waited for without polling.
+        Adding to a set makes this idempotent, if an item is completed twice.
+
         If the lease expired, the item may not have completed, and some
         other worker may have picked it up.  There is no indication
         of what happened.
         """
         # TODO: check for lease expiry to avoid duplicate results?
         # store the result in the result set
-        app_log.info(f"Storing result in {result_key} for {self._itemkey(item)}")
-        self._db.setex(result_key, expiry, result)
+        itemkey = self._itemkey(item)
+        app_log.info(f"Storing result in {result_key} for {itemkey}")
+        pipe = self._db.pipeline(transaction=True)
+        pipe.setex(result_key, expiry, result)
+        if done_key:
+            pipe.sadd(done_key, itemkey)
+            pipe.expire(done_key, expiry)
+            pipe.publish(done_key, itemkey)
+        pipe.execute()
 
         # indicate that we are done processing
         app_log.debug(f"Removing item from processing queue")
@@ -9,6 +9,7 @@ import time
 import traceback
 
 import pyodbc
+import metrics
 import rediswq
 
 from dateutil.parser import parse as parse_date
@@ -17,10 +18,18 @@ from tornado.log import app_log
 
 from corona.data import connect_to_azure_database
 from corona.analysis.analysis_pipeline import run_analysis_pipeline
+from corona.profiling import Profile
+from corona.utils import timer
 
 ANALYSIS_LEASE_SECONDS = int(os.environ.get("ANALYSIS_LEASE_SECONDS") or 120)
 ANALYSIS_DAYS = int(os.environ.get("ANALYSIS_DAYS") or 0)
 PIN_TIME_TO = os.environ.get("PIN_TIME_TO")
+# attach an execution profile to every result
+ANALYSIS_PROFILE = os.environ.get("ANALYSIS_PROFILE", "0") == "1"
+# fraction of profiled runs to also run under cProfile
+ANALYSIS_CPROFILE_SAMPLE_RATE = float(
+    os.environ.get("ANALYSIS_CPROFILE_SAMPLE_RATE") or 0
+)
 if PIN_TIME_TO:
     PIN_TIME_TO = parse_date(PIN_TIME_TO)
 
@@ -33,12 +42,23 @@ def set_to_list(obj):
 
 
 def process_one(q, item):
-    """Process one request off the queue"""
+    """Process one request off the queue
+
+    Returns the status of the job, for metrics
+    """
     task = json.loads(item.decode("utf-8"))
     device_id = task["device_id"]
     request_id = task["request_id"]
     result_key = task["result_key"]
     expiry = task["expiry"]
+    # jobs submitted by older versions of the API have no done key
+    done_key = task.get("done_key")
+
+    # jobs submitted by older versions of the API have no timestamp
+    if task.get("submitted_at"):
+        submitted_at = parse_date(task["submitted_at"])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        metrics.queue_wait.observe(max((now - submitted_at).total_seconds(), 0))
 
     kwargs = {}
 
@@ -59,6 +79,11 @@ def process_one(q, item):
     if task.get("time_to"):
         kwargs["timeTo"] = parse_date(task["time_to"])
 
+    profile = None
+    if ANALYSIS_PROFILE or task.get("profile"):
+        profile = Profile(cprofile_sample_rate=ANALYSIS_CPROFILE_SAMPLE_RATE)
+        kwargs["profile"] = profile
+
     app_log.info(
             json.dumps(
                 {
@@ -75,19 +100,25 @@ def process_one(q, item):
         app_log.exception(f"request_id:{request_id} Database error running analysis on {device_id}")
         # release it to gc, don't complete the result
         q.release(item)
-        return
+        return "released"
     except Exception:
         exc_info = sys.exc_info()
         app_log.exception(f"request_id:{request_id} Failure running analysis on {device_id}")
         result["status"] = "error"
         result["message"] = "".join(traceback.format_exception(*exc_info))
 
+    # stored next to the result, never inside it,
+    # so the result itself is unchanged when profiling
+    if profile is not None:
+        result["profile"] = profile.to_dict()
+
     log_keys = result.keys()
     log_result_keys = []
     if result["status"] == "success":
         # safe-guard, probably not needed
         if "result" in result and isinstance(result["result"], dict):
             log_result_keys = result["result"].keys()
+            metrics.candidates_per_job.observe(len(result["result"]))
         else:
             app_log.info(
                     json.dumps(
@@ -108,7 +139,10 @@ def process_one(q, item):
                     "keys": ", ".join(log_keys),
                     "result-keys": ", ".join(log_result_keys)
                 }))
-    q.complete(item, result_key, expiry, json.dumps(result, default=set_to_list))
+    with timer("serialize result", stage="serialize"):
+        serialized = json.dumps(result, default=set_to_list)
+    q.complete(item, result_key, expiry, serialized, done_key=done_key)
+    return result["status"]
 
 
 def main():
@@ -117,6 +151,7 @@ def main():
     queue_name = os.getenv("REDIS_JOBQUEUE_NAME", "analysis-jobs")
 
     tornado.options.parse_command_line()
+    metrics.start_metrics_server()
     # test azure connection
     app_log.info("Testing database connection...")
     db = connect_to_azure_database()
@@ -137,8 +172,9 @@ def main():
             q.gc()
             continue
         tic = time.perf_counter()
-        process_one(q, item)
+        status = process_one(q, item)
         toc = time.perf_counter()
+        metrics.job_duration.labels(status=status).observe(toc - tic)
         app_log.info(f"Analysis completed in {int(toc-tic)}s")
 
 
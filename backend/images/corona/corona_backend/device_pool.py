@@ -0,0 +1,179 @@
+"""warm pool of provisioned IoTHub devices for registration
+
+Creating a device in IoTHub is rate-limited,
+so during registration spikes provisioning on the request path times out.
+
+Instead, devices are created ahead of time in the background,
+and their ids and keys are stored in the DevicePool table in the database
+(see sql/device_pool_support.sql).
+Registration claims a device from the pool,
+and only creates one itself if the pool is empty, unavailable or slow.
+
+A claimed device is removed from the pool in the same statement,
+so each device is handed out at most once, even across replicas.
+"""
+
+import asyncio
+import os
+import time
+
+from prometheus_client import Counter, Gauge, Histogram
+from tornado.log import app_log
+
+from . import devices, sql
+
+# number of devices to keep in the pool (0: disabled)
+POOL_SIZE = int(os.environ.get("DEVICE_POOL_SIZE") or 0)
+# at most REFILL_BATCH devices are created every REFILL_INTERVAL seconds,
+# leaving room in the IoTHub quota for registrations while the pool is empty
+REFILL_BATCH = int(os.environ.get("DEVICE_POOL_REFILL_BATCH") or 10)
+REFILL_INTERVAL = int(os.environ.get("DEVICE_POOL_REFILL_INTERVAL") or 10)
+# seconds to wait for a device from the pool before creating one instead
+CLAIM_TIMEOUT = float(os.environ.get("DEVICE_POOL_CLAIM_TIMEOUT") or 2)
+
+pool_size = Gauge(
+    "device_pool_size", "Provisioned devices waiting in the registration pool"
+)
+pool_claims = Counter(
+    "device_pool_claims",
+    "Devices requested from the registration pool, by result",
+    ["result"],
+)
+pool_claim_seconds = Histogram(
+    "device_pool_claim_seconds", "Time spent claiming a device from the pool"
+)
+pool_refills = Counter(
+    "device_pool_refills",
+    "Devices provisioned for the registration pool, by status",
+    ["status"],
+)
+
+
+async def claim_device():
+    """Claim a provisioned device from the pool
+
+    Returns (device_id, primary_key),
+    or None if the pool is disabled, empty or unavailable,
+    or doesn't answer within CLAIM_TIMEOUT,
+    in which case the caller should create a device itself.
+    """
+    if not POOL_SIZE:
+        return None
+    tic = time.perf_counter()
+    claim = asyncio.ensure_future(sql.claim_pooled_device())
+    try:
+        # shield: the query can't be cancelled once it is running in its thread
+        claimed = await asyncio.wait_for(asyncio.shield(claim), timeout=CLAIM_TIMEOUT)
+    except asyncio.TimeoutError:
+        pool_claims.labels(result="error").inc()
+        app_log.error(f"Timeout claiming device from pool after {CLAIM_TIMEOUT}s")
+        claim.add_done_callback(_return_late_claim)
+        return None
+    except asyncio.CancelledError:
+        claim.add_done_callback(_return_late_claim)
+        raise
+    except Exception as e:
+        pool_claims.labels(result="error").inc()
+        app_log.error(f"Error claiming device from pool: {e}")
+        return None
+    finally:
+        pool_claim_seconds.observe(time.perf_counter() - tic)
+
+    if claimed is None:
+        pool_claims.labels(result="empty").inc()
+        app_log.warning("Device pool is empty, creating new device")
+        return None
+    pool_claims.labels(result="claimed").inc()
+    pool_size.dec()
+    return claimed
+
+
+def _return_late_claim(claim):
+    """Put a device claimed after its request gave up back in the pool"""
+    if claim.cancelled() or claim.exception() is not None:
+        return
+    claimed = claim.result()
+    if claimed is not None:
+        asyncio.ensure_future(_return_device(*claimed))
+
+
+async def _return_device(device_id, primary_key):
+    try:
+        await sql.add_pooled_device(device_id, primary_key)
+    except Exception as e:
+        app_log.error(f"Failed to return device {device_id} to pool: {e}")
+        # nobody can claim a device that's not in the pool
+        await devices.delete_devices(device_id, raise_on_error=False)
+
+
+async def _add_device():
+    """Create one device in IoTHub and add it to the pool"""
+    try:
+        device = await devices.create_new_device()
+    except Exception:
+        pool_refills.labels(status="failed").inc()
+        raise
+    device_id = device["deviceId"]
+    try:
+        await sql.add_pooled_device(
+            device_id, device["authentication"]["symmetricKey"]["primaryKey"]
+        )
+    except Exception:
+        pool_refills.labels(status="failed").inc()
+        # nobody can claim a device that's not in the pool
+        await devices.delete_devices(device_id, raise_on_error=False)
+        raise
+    pool_refills.labels(status="ok").inc()
+
+
+async def refill(size=None, batch=None):
+    """Top up the pool towards `size` devices, creating at most `batch`
+
+    Replicas refill independently,
+    so the pool may briefly exceed `size` by up to one batch per replica.
+
+    Returns the number of devices added.
+    """
+    if size is None:
+        size = POOL_SIZE
+    if batch is None:
+        batch = REFILL_BATCH
+    current = await sql.get_device_pool_size()
+    pool_size.set(current)
+    missing = min(size - current, batch)
+    if missing <= 0:
+        return 0
+
+    results = await asyncio.gather(
+        *(_add_device() for i in range(missing)), return_exceptions=True
+    )
+    added = 0
+    for result in results:
+        if isinstance(result, Exception):
+            app_log.error(f"Failed to add device to pool: {result}")
+        else:
+            added += 1
+    pool_size.inc(added)
+    app_log.info(f"Added {added}/{missing} devices to pool ({current + added}/{size})")
+    return added
+
+
+async def _refill_periodically(interval):
+    while True:
+        try:
+            await refill()
+        except Exception:
+            app_log.exception("Error refilling device pool")
+        await asyncio.sleep(interval)
+
+
+def keep_pool_filled(interval=REFILL_INTERVAL):
+    """Start refilling the pool in the background
+
+    Does nothing if the pool is disabled.
+    Returns the background task.
+    """
+    if not POOL_SIZE:
+        return None
+    app_log.info(f"Keeping {POOL_SIZE} devices in the registration pool")
+    return asyncio.ensure_future(_refill_periodically(interval))
@@ -19,14 +19,16 @@ import struct
 import time
 import uuid
 from binascii import b2a_hex
+from collections import OrderedDict
 from threading import local
 
 from azure.iot.hub.sastoken import SasToken
-from tornado.httpclient import HTTPRequest
+from prometheus_client import Counter
+from tornado.httpclient import HTTPClientError, HTTPRequest
 from tornado.httputil import url_concat
 from tornado.log import app_log
 
-from .utils import fetch
+from .utils import CachedCredential, fetch, prefetch_pages
 
 before_times = datetime.datetime(
     year=2000, month=1, day=1, tzinfo=datetime.timezone.utc
@@ -47,14 +49,32 @@ for part in iothub_connection_str.strip(";").split(";"):
 
 _local = local()
 
+# lifetime of SAS tokens for IoTHub requests
+SAS_TOKEN_TTL = int(os.environ.get("IOTHUB_SAS_TOKEN_TTL") or 3600)
 
-async def iothub_request(path, *, headers=None, body=None, method="GET", raw=False):
-    """Make an HTTP request to IoTHub ourselves"""
+
+async def _new_sas_token():
     sastoken = SasToken(
         connection_info["hostname"],
         key=connection_info["sharedaccesskey"],
         key_name=connection_info["sharedaccesskeyname"],
+        ttl=SAS_TOKEN_TTL,
     )
+    return str(sastoken), sastoken.expiry_time
+
+
+_sas_token = CachedCredential(
+    _new_sas_token, name="IoTHub SAS token", refresh_before=SAS_TOKEN_TTL // 6
+)
+
+
+iothub_requests = Counter("iothub_requests", "Requests made to IoTHub")
+
+
+async def iothub_request(path, *, headers=None, body=None, method="GET", raw=False):
+    """Make an HTTP request to IoTHub ourselves"""
+    iothub_requests.inc()
+    sastoken = await _sas_token.get()
 
     if isinstance(body, str):
         body = body.encode("utf8")
@@ -64,7 +84,7 @@ async def iothub_request(path, *, headers=None, body=None, method="GET", raw=Fal
         "Content-Type": "application/json; charset=utf-8",
         "Content-Length": "0" if body is None else str(len(body)),
         # see iot.hub.auth.signed_session
-        "Authorization": str(sastoken),
+        "Authorization": sastoken,
     }
     if headers:
         req_headers.update(headers)
@@ -153,28 +173,149 @@ def get_device(device_id):
     return iothub_request(f"/devices/{device_id}")
 
 
-async def lookup_device_keys(device_id):
-    """Lookup primary and secondary keys for the associated device_id
+# device keys are cached for HMAC authentication of requests from the app
+DEVICE_KEY_CACHE_SIZE = int(os.environ.get("DEVICE_KEY_CACHE_SIZE") or 100000)
+# deleting a device only invalidates the cache of the deleting process,
+# so other processes accept a deleted device for up to this long
+DEVICE_KEY_CACHE_TTL = int(os.environ.get("DEVICE_KEY_CACHE_TTL") or 10)
+# unknown devices are remembered for a shorter time
+DEVICE_KEY_NEGATIVE_CACHE_TTL = int(
+    os.environ.get("DEVICE_KEY_NEGATIVE_CACHE_TTL") or 60
+)
 
-    This is used to sign HMACs in requests from the app
-    where we do not authenticate with B2C token.
+device_key_cache_lookups = Counter(
+    "device_key_cache_lookups",
+    "Device key lookups for HMAC authentication, by cache result",
+    ["result"],
+)
+device_key_iothub_requests = Counter(
+    "device_key_iothub_requests",
+    "IoTHub requests for device keys, by status",
+    ["status"],
+)
+
+
+class DeviceKeyCache:
+    """Bounded LRU cache of device keys with expiry
+
+    Concurrent lookups of the same device share a single IoTHub request.
+    Unknown devices (None) are cached for negative_ttl seconds.
+    Errors are not cached.
     """
 
-    device = await get_device(device_id)
+    def __init__(self, load, maxsize, ttl, negative_ttl, clock=time.monotonic):
+        self.load = load
+        self.clock = clock
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # device id -> (expiry, keys), least recently used first
+        self._entries = OrderedDict()
+        # device id -> task loading the keys
+        self._loading = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def get(self, device_id):
+        entry = self._entries.get(device_id)
+        if entry is not None:
+            expiry, keys = entry
+            if expiry > self.clock():
+                self._entries.move_to_end(device_id)
+                device_key_cache_lookups.labels(
+                    result="hit" if keys is not None else "negative_hit"
+                ).inc()
+                return keys
+            del self._entries[device_id]
+
+        task = self._loading.get(device_id)
+        if task is None:
+            device_key_cache_lookups.labels(result="miss").inc()
+            task = self._loading[device_id] = asyncio.ensure_future(
+                self._load(device_id)
+            )
+        else:
+            device_key_cache_lookups.labels(result="wait").inc()
+        # shield: a cancelled request shouldn't cancel the lookup for the others
+        return await asyncio.shield(task)
+
+    async def _load(self, device_id):
+        task = asyncio.current_task()
+        try:
+            keys = await self.load(device_id)
+        finally:
+            if self._loading.get(device_id) is task:
+                self._loading.pop(device_id)
+            else:
+                # invalidated while loading, don't store the result
+                task = None
+        if task is not None:
+            ttl = self.ttl if keys is not None else self.negative_ttl
+            self._entries[device_id] = (self.clock() + ttl, keys)
+            self._entries.move_to_end(device_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return keys
+
+    def invalidate(self, device_id):
+        """Forget the keys of a device, e.g. after it has been deleted"""
+        self._entries.pop(device_id, None)
+        self._loading.pop(device_id, None)
+
+    def clear(self):
+        self._entries.clear()
+        self._loading.clear()
+
+
+async def _load_device_keys(device_id):
+    try:
+        device = await get_device(device_id)
+    except HTTPClientError as e:
+        device_key_iothub_requests.labels(status=str(e.code)).inc()
+        if e.code == 404:
+            return None
+        raise
+    device_key_iothub_requests.labels(status="200").inc()
     if device is None:
         return None
     return device["authentication"]["symmetricKey"]
 
 
+_device_key_cache = DeviceKeyCache(
+    # look up get_device at call time
+    lambda device_id: _load_device_keys(device_id),
+    maxsize=DEVICE_KEY_CACHE_SIZE,
+    ttl=DEVICE_KEY_CACHE_TTL,
+    negative_ttl=DEVICE_KEY_NEGATIVE_CACHE_TTL,
+)
+
+
+async def lookup_device_keys(device_id):
+    """Lookup primary and secondary keys for the associated device_id
+
+    This is used to sign HMACs in requests from the app
+    where we do not authenticate with B2C token.
+
+    Keys are cached for DEVICE_KEY_CACHE_TTL seconds,
+    and unknown devices for DEVICE_KEY_NEGATIVE_CACHE_TTL seconds.
+    Returns None for unknown devices.
+    """
+    return await _device_key_cache.get(device_id)
+
+
 query_string = r"""
 SELECT deviceId, lastActivityTime, connectionState, properties
 FROM devices
 """
 
 
-async def get_devices(*device_ids, limit=None, per_page=10000):
+async def get_devices(*device_ids, limit=None, per_page=10000, readahead=None):
     """Get devices
 
+    Pages are fetched ahead while earlier ones are consumed,
+    up to `readahead` pages (see utils.prefetch_pages).
+
     async generator
     """
     query = query_string
@@ -188,33 +329,46 @@ async def get_devices(*device_ids, limit=None, per_page=10000):
     if limit:
         per_page = min(per_page, limit)
         headers = {"x-ms-max-item-count": str(per_page)}
-    count = 0
-    continuation_token = "..."
-    while continuation_token:
+        if per_page >= limit:
+            # the first page is all we need
+            readahead = 0
+
+    async def fetch_page(continuation_token):
+        page_headers = dict(headers)
+        if continuation_token:
+            page_headers["x-ms-continuation"] = continuation_token
         resp = await iothub_request(
             "/devices/query",
             body=json.dumps({"query": query}),
             method="POST",
-            headers=headers,
+            headers=page_headers,
             raw=True,
         )
-        # TODO: optimization; schedule next fetch before yield?
         results = json.loads(resp.body.decode("utf8"))
+        return results, resp.headers.get("x-ms-continuation")
+
+    count = 0
+    async for results in prefetch_pages(fetch_page, readahead):
         for device in results:
             yield device
             count += 1
             if limit and count >= limit:
                 return
-        continuation_token = resp.headers.get("x-ms-continuation")
-        if continuation_token:
-            headers["x-ms-continuation"] = continuation_token
 
 
-def delete_device(device_id):
-    """Delete one device"""
-    return iothub_request(
-        f"/devices/{device_id}", headers={"If-Match": "*"}, method="DELETE"
-    )
+async def delete_device(device_id):
+    """Delete one device
+
+    Also removes the device from the key cache of this process,
+    after the deletion so that lookups in flight can't cache it again.
+    Other processes will forget it after DEVICE_KEY_CACHE_TTL.
+    """
+    try:
+        return await iothub_request(
+            f"/devices/{device_id}", headers={"If-Match": "*"}, method="DELETE"
+        )
+    finally:
+        _device_key_cache.invalidate(device_id)
 
 
 async def delete_devices(*device_ids, raise_on_error=True):
@@ -39,6 +39,7 @@ type_map = {
     int: "integer",
     list: "list",
     float: "number",
+    bool: "boolean",
     datetime.datetime: "ISO8601 date string",
 }
 
@@ -138,6 +139,55 @@ async def response_from_gps_events(
     return response
 
 
+async def stream_response_from_gps_events(
+    handler, device_ids, phone_number, time_from, time_to, cursor, caller
+):
+    """Stream gps events as newline-delimited JSON
+
+    The first line identifies the user,
+    followed by one line per event.
+    After each chunk of events, a {"cursor": ...} line
+    can be passed back as `cursor` to resume after that chunk.
+    The last line is {"done": true, "count": ...}.
+    """
+    if cursor:
+        try:
+            sql.decode_gps_cursor(cursor)
+        except ValueError:
+            raise web.HTTPError(400, "Invalid cursor")
+
+    app_log.info(
+        f"Request from {caller}, streaming gps events for {len(device_ids)} devices for {utils.mask_phone(phone_number)} from={time_from}, to={time_to}, resuming={bool(cursor)}"
+    )
+    handler.set_header("Content-Type", "application/x-ndjson")
+    handler.write(
+        json.dumps({"phone_number": phone_number, "found_in_system": True}) + "\n"
+    )
+    count = 0
+    events = sql.stream_gps_events(
+        device_ids=device_ids, time_from=time_from, time_to=time_to, cursor=cursor
+    )
+    try:
+        async for chunk, next_cursor in events:
+            count += len(chunk)
+            handler.write(
+                "".join(json.dumps(event) + "\n" for event in chunk)
+                + json.dumps({"cursor": next_cursor})
+                + "\n"
+            )
+            # wait for the chunk to be sent before fetching the next
+            await handler.flush()
+    except sql.PoolTimeout:
+        # raised before the first chunk, so nothing has been sent yet
+        app_log.error("No database connection free for streaming gps events")
+        raise web.HTTPError(503, "Internal temporary server error - please try again")
+    finally:
+        await events.aclose()
+
+    app_log.info(f"Request from {caller}, streamed {count} gps events")
+    handler.write(json.dumps({"done": True, "count": count}) + "\n")
+
+
 class ExternalRequestsHandler(BaseHandler):
     audit_fields = dict()
     schema = {"phone_number": str}
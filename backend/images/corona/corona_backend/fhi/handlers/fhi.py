@@ -1,13 +1,15 @@
 """ Handlers for serving requests by FHI. """
 
+import asyncio
 import datetime
 import json
 import os
 import uuid
+from contextlib import asynccontextmanager
 from functools import lru_cache
 
 import pyodbc
-import redis
+import redis.asyncio
 from dateutil.parser import parse as parse_date
 from tornado import web
 from tornado.log import app_log
@@ -19,20 +21,105 @@ from .base import (
     check_api_key,
     response_from_access_log,
     response_from_gps_events,
+    stream_response_from_gps_events,
 )
 
 LOOKUP_RESULT_EXPIRY = int(os.environ.get("LOOKUP_RESULT_EXPIRY") or 4 * 60 * 60)
 REDIS_HOST = os.environ.get("REDIS_SERVICE_HOST", "localhost")
 REDIS_PASSWORD = os.environ.get("REDIS_PASSWORD")
 REDIS_JOBQUEUE_NAME = os.getenv("REDIS_JOBQUEUE_NAME", "analysis-jobs")
+REDIS_MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS") or 16)
 # result-fetch expiry (default: 4 hours)
 LOOKUP_RESULT_EXPIRY = int(os.environ.get("LOOKUP_RESULT_EXPIRY") or 4 * 60 * 60)
+# longest time a lookup result request may wait for the analysis to complete
+LOOKUP_MAX_WAIT = int(os.environ.get("LOOKUP_MAX_WAIT") or 30)
 
 
 @lru_cache()
 def get_redis():
-    """Caching getter for redis client"""
-    return redis.StrictRedis(host=REDIS_HOST, password=REDIS_PASSWORD)
+    """Caching getter for the asyncio redis client
+
+    The client keeps a pool of up to REDIS_MAX_CONNECTIONS connections
+    """
+    return redis.asyncio.StrictRedis(
+        host=REDIS_HOST, password=REDIS_PASSWORD, max_connections=REDIS_MAX_CONNECTIONS
+    )
+
+
+class CompletionListener:
+    """Wakes up lookup result requests waiting for their analysis jobs
+
+    Workers publish on the done key of a request when completing one of its jobs.
+    A single pubsub connection per process is subscribed to all done keys,
+    so that waiting requests don't each hold a redis connection.
+    """
+
+    pattern = "lookup:*:done"
+
+    def __init__(self):
+        self._waiters = {}
+        self._loop = None
+        self._task = None
+        self._subscribed = None
+
+    def _wake(self, channel):
+        for future in self._waiters.get(channel, ()):
+            if not future.done():
+                future.set_result(None)
+
+    def _wake_all(self):
+        for channel in list(self._waiters):
+            self._wake(channel)
+
+    async def _listen(self):
+        while True:
+            pubsub = get_redis().pubsub()
+            try:
+                await pubsub.psubscribe(self.pattern)
+                async for message in pubsub.listen():
+                    if message["type"] == "psubscribe":
+                        self._subscribed.set()
+                    elif message["type"] == "pmessage":
+                        self._wake(message["channel"].decode("utf8"))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                app_log.exception("Error listening for completed lookups")
+            finally:
+                self._subscribed.clear()
+                await pubsub.close()
+                # completions may be missed while reconnecting,
+                # let all waiters check for themselves
+                self._wake_all()
+            await asyncio.sleep(1)
+
+    @asynccontextmanager
+    async def watch(self, channel, timeout):
+        """Watch for completed jobs on a done key
+
+        Yields a future resolved on the next completion.
+        Completions after entering are not missed,
+        as entering waits for the subscription to be active.
+        Raises asyncio.TimeoutError if that takes longer than timeout.
+        """
+        loop = asyncio.get_event_loop()
+        if self._task is None or self._task.done() or self._loop is not loop:
+            self._loop = loop
+            self._subscribed = asyncio.Event()
+            self._task = asyncio.ensure_future(self._listen())
+        future = loop.create_future()
+        self._waiters.setdefault(channel, set()).add(future)
+        try:
+            await asyncio.wait_for(self._subscribed.wait(), timeout)
+            yield future
+        finally:
+            waiters = self._waiters[channel]
+            waiters.discard(future)
+            if not waiters:
+                del self._waiters[channel]
+
+
+completion_listener = CompletionListener()
 
 
 class FHIHandler(ExternalRequestsHandler):
@@ -71,9 +158,9 @@ class LookupHandler(FHIHandler):
         request_id = str(uuid.uuid4())
         app_log.info(f"Submitting analysis jobs for {mask_number}: {request_id}")
         request_info = f"lookup:{request_id}:info"
-        # create job queue in redis
-
-        db = get_redis()
+        # workers add completed jobs to this set
+        done_key = f"lookup:{request_id}:done"
+        jobs = []
         result_keys = []
 
         async for device_id in graph.device_ids_for_user(user):
@@ -85,12 +172,14 @@ class LookupHandler(FHIHandler):
                 "request_id": request_id,
                 "device_id": device_id,
                 "result_key": result_key,
+                "done_key": done_key,
                 "time_from": utils.isoformat(body.get("time_from")),
                 "time_to": utils.isoformat(body.get("time_to")),
                 "expiry": LOOKUP_RESULT_EXPIRY,
+                # used by the worker to measure time spent waiting in the queue
+                "submitted_at": utils.isoformat(utils.now_at_utc()),
             }
-            db.rpush(REDIS_JOBQUEUE_NAME, json.dumps(job).encode("utf8"))
-            # push device id onto job queue
+            jobs.append(json.dumps(job).encode("utf8"))
         if not device_ids:
             app_log.info(f"Phone number {mask_number} has no devices")
             self.set_status(404)
@@ -99,18 +188,24 @@ class LookupHandler(FHIHandler):
             )
             return
 
-        app_log.info(f"Storing request info for {request_id}")
-        db.set(
-            request_info,
-            json.dumps(
-                {
-                    "phone_number": phone_number,
-                    "result_keys": result_keys,
-                    "device_ids": device_ids,
-                }
-            ),
-            ex=LOOKUP_RESULT_EXPIRY,
-        )
+        app_log.info(f"Storing request info and {len(jobs)} jobs for {request_id}")
+        # push all jobs onto the job queue and store the request info
+        # in a single transaction
+        async with get_redis().pipeline(transaction=True) as pipe:
+            pipe.rpush(REDIS_JOBQUEUE_NAME, *jobs)
+            pipe.set(
+                request_info,
+                json.dumps(
+                    {
+                        "phone_number": phone_number,
+                        "result_keys": result_keys,
+                        "device_ids": device_ids,
+                        "done_key": done_key,
+                    }
+                ),
+                ex=LOOKUP_RESULT_EXPIRY,
+            )
+            await pipe.execute()
 
         self.set_status(202)
         self.write(
@@ -130,22 +225,62 @@ class LookupHandler(FHIHandler):
         )
 
 
-async def fetch_pin(phone_number):
+async def fetch_pins(phone_numbers):
     try:
-        pin_code = await pin.fetch_or_generate_pin(phone_number=phone_number)
+        pin_codes = await pin.fetch_or_generate_pins(phone_numbers=phone_numbers)
     except pyodbc.InterfaceError:
-        app_log.exception("Connection error in pin.fetch_or_generate_pin")
+        app_log.exception("Connection error in pin.fetch_or_generate_pins")
         raise web.HTTPError(503, "Internal temporary server error - please try again")
-    return pin_code
+    return pin_codes
+
+
+async def count_ready(db, info):
+    """Count the completed jobs of a lookup request
+
+    Uses the done set maintained by the workers, a single SCARD.
+    Requests submitted before done sets were introduced
+    check for each of their results instead.
+    """
+    if info.get("done_key"):
+        return await db.scard(info["done_key"])
+    return await db.exists(*info["result_keys"])
+
+
+async def wait_ready(db, info, timeout):
+    """Wait up to timeout seconds for all jobs of a lookup request to complete
+
+    Returns the number of completed jobs
+    """
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    num_jobs = len(info["result_keys"])
+    while True:
+        try:
+            async with completion_listener.watch(
+                info["done_key"], timeout=max(deadline - loop.time(), 0)
+            ) as completed:
+                # check after subscribing, so no completion goes unnoticed
+                num_ready = await count_ready(db, info)
+                timeout = deadline - loop.time()
+                if num_ready >= num_jobs or timeout <= 0:
+                    return num_ready
+                await asyncio.wait_for(completed, timeout)
+        except asyncio.TimeoutError:
+            return await count_ready(db, info)
 
 
 class LookupResultHandler(FHIHandler):
     @web.authenticated
     async def get(self, request_id):
         app_log.info(f"Looking up result for {request_id}")
+        # optionally wait up to `wait` seconds for the analysis to complete
+        try:
+            wait = min(float(self.get_argument("wait", 0)), LOOKUP_MAX_WAIT)
+        except ValueError:
+            raise web.HTTPError(400, "wait must be a number of seconds")
         request_info = f"lookup:{request_id}:info"
         db = get_redis()
-        item = db.get(request_info)
+        item = await db.get(request_info)
         if not item:
             raise web.HTTPError(404, "No such request")
 
@@ -157,7 +292,9 @@ class LookupResultHandler(FHIHandler):
         # without separate auth, this isn't useful
         mask_number = utils.mask_phone(phone_number)
         result_keys = info["result_keys"]
-        num_ready = db.exists(*result_keys)
+        num_ready = await count_ready(db, info)
+        if num_ready < len(result_keys) and wait > 0 and info.get("done_key"):
+            num_ready = await wait_ready(db, info, wait)
         progress = f"{num_ready}/{len(result_keys)}"
         if num_ready < len(info["result_keys"]):
             app_log.info(f"Lookup request {request_id} not ready yet: {progress}")
@@ -172,7 +309,9 @@ class LookupResultHandler(FHIHandler):
         app_log.info(f"Lookup request {request_id} complete: {progress}")
 
         # we are done! Collect and return the report
-        results = [json.loads(item.decode("utf8")) for item in db.mget(*result_keys)]
+        results = [
+            json.loads(item.decode("utf8")) for item in await db.mget(*result_keys)
+        ]
         contacts = []
 
         for result in results:
@@ -184,21 +323,32 @@ class LookupResultHandler(FHIHandler):
                     500,
                     "Error in analysis pipeline. Please report the input parameters to the analysis team.",
                 )
+
+        # resolve the phone numbers of all contacts at once
+        contact_numbers = await graph.phone_numbers_for_device_ids(
+            [
+                device_id
+                for result in results
+                if result["result"]
+                for device_id in result["result"]
+            ]
+        )
+
+        # phone numbers to log access to, in the order they are returned
+        accessed_numbers = []
+        for result in results:
             if not result["result"]:
                 app_log.info(f"Empty result for {result['device_id']}")
                 continue
             device_result = result["result"]
             contact = {}
             for device_id, contact_info in device_result.items():
-                contact_number = await graph.phone_number_for_device_id(device_id)
+                contact_number = contact_numbers.get(device_id)
                 if contact_number:
                     if contact_number == phone_number:
                         app_log.warning(f"Omitting contact with self for {mask_number}")
                     else:
-                        await self.audit_log(phone_numbers=[contact_number])
-                        if pin.PIN_ENABLED:
-                            pin_code = await fetch_pin(phone_number=contact_number)
-                            contact_info["pin_code"] = pin_code
+                        accessed_numbers.append(contact_number)
                         contact[contact_number] = contact_info
                 else:
                     app_log.warning(
@@ -207,6 +357,15 @@ class LookupResultHandler(FHIHandler):
             if contact:
                 contacts.append(contact)
 
+        # log access to all contacts at once, before handing out any pins
+        if accessed_numbers:
+            await self.audit_log(phone_numbers=accessed_numbers)
+        if pin.PIN_ENABLED and accessed_numbers:
+            pin_codes = await fetch_pins(accessed_numbers)
+            for contact in contacts:
+                for contact_number, contact_info in contact.items():
+                    contact_info["pin_code"] = pin_codes[contact_number]
+
         app_log.info(f"Checking {len(device_ids)} devices for activity")
         last_activity = None
         for device_id in device_ids:
@@ -279,6 +438,10 @@ class FHIEgressHandler(FHIHandler):
     """Data egress of a single user
 
     FHI calls this endpoint on behalf of a user.
+
+    With `"stream": true`, all events in the time range are streamed
+    as newline-delimited JSON instead of returned in pages,
+    see stream_response_from_gps_events.
     """
 
     schema = {
@@ -291,6 +454,8 @@ class FHIEgressHandler(FHIHandler):
         "per_page": (int, False),
         "time_from": (datetime.datetime, False),
         "time_to": (datetime.datetime, False),
+        "stream": (bool, False),
+        "cursor": (str, False),
     }
 
     @web.authenticated
@@ -318,6 +483,18 @@ class FHIEgressHandler(FHIHandler):
             legal_means=body.get("legal_means"),
         )
 
+        if body.get("stream"):
+            await stream_response_from_gps_events(
+                self,
+                device_ids=device_ids,
+                phone_number=phone_number,
+                time_from=utils.isoformat(body.get("time_from")),
+                time_to=utils.isoformat(body.get("time_to")),
+                cursor=body.get("cursor"),
+                caller="FHI",
+            )
+            return
+
         response = await response_from_gps_events(
             device_ids=device_ids,
             phone_number=phone_number,
@@ -5,19 +5,22 @@ Microsoft graph / Active Directory API calls
 
 import asyncio
 import datetime
+import hashlib
 import json
 import os
 import time
+from collections import OrderedDict
 from functools import lru_cache, partial
 from urllib.parse import urlencode
 
 import jwt
+from prometheus_client import Counter
 from tornado import ioloop, web
 from tornado.httpclient import HTTPClientError, HTTPRequest
 from tornado.httputil import url_concat
 from tornado.log import app_log
 
-from .utils import fetch, mask_phone
+from .utils import CachedCredential, fetch, mask_phone, prefetch_pages
 
 # AAD-related
 tenant_id = os.environ["AAD_TENANT_ID"]
@@ -47,6 +50,23 @@ PHONE_NUMBER_BLACKLIST_FILE = os.environ.get(
     "PHONE_NUMBER_BLACKLIST_FILE", "/etc/corona/blacklist.json"
 )
 
+graph_url = os.environ.get("GRAPH_URL") or "https://graph.microsoft.com/v1.0"
+
+# JSON batching: graph accepts at most 20 requests per $batch
+GRAPH_BATCH_SIZE = 20
+# number of $batch requests in flight at once
+GRAPH_BATCH_CONCURRENCY = int(os.environ.get("GRAPH_BATCH_CONCURRENCY") or 4)
+# retries of throttled or failed requests within a batch
+GRAPH_BATCH_RETRIES = int(os.environ.get("GRAPH_BATCH_RETRIES") or 3)
+# how long to remember devices without a phone number
+PHONE_NUMBER_CACHE_TTL = int(os.environ.get("PHONE_NUMBER_CACHE_TTL") or 60)
+# how many devices without a phone number to remember
+PHONE_NUMBER_CACHE_SIZE = int(os.environ.get("PHONE_NUMBER_CACHE_SIZE") or 100000)
+# retries of store_device_id after a failed request,
+# waiting STORE_DEVICE_ID_RETRY_WAIT seconds, doubling after each retry
+STORE_DEVICE_ID_RETRIES = int(os.environ.get("STORE_DEVICE_ID_RETRIES") or 3)
+STORE_DEVICE_ID_RETRY_WAIT = float(os.environ.get("STORE_DEVICE_ID_RETRY_WAIT") or 0.5)
+
 
 @lru_cache()
 def get_blacklist(path=PHONE_NUMBER_BLACKLIST_FILE):
@@ -133,41 +153,17 @@ def keep_jwt_keys_updated(interval_seconds=3600, run_first=True):
     return pc
 
 
-_token_cache = {}
+# credentials by (tenant_id, client_id, scope)
+_credentials = {}
 
 _expiry_buffer = 600  # number of seconds before expiry to request a new token
 
 
-async def request_graph_token(
-    tenant_id,
-    client_id,
-    client_secret,
-    scope="https://graph.microsoft.com/.default",
-    clear_cache=False,
-):
-    """Request an access token for the ms graph API
+async def _fetch_graph_token(tenant_id, client_id, client_secret, scope):
+    """Request a new access token
 
-    Cache the result to re-use tokens until they are close to expiring
+    Returns (token, expiry)
     """
-    cache_key = (tenant_id, client_id, scope)
-
-    if clear_cache:
-        _token_cache.pop(cache_key, None)
-
-    cached = _token_cache.get(cache_key)
-    if cached:
-        expiry = cached["expiry"]
-        # don't re-use tokens that are within 10 minutes of expiring
-        seconds_remaining = expiry - time.time()
-        if seconds_remaining >= _expiry_buffer:
-            app_log.debug("Reusing cached token")
-            return cached["token"]
-        else:
-            app_log.info(
-                f"Cached token for {cache_key} is expiring in {int(seconds_remaining)}s, not using it"
-            )
-            _token_cache.pop(cache_key, None)
-
     app_log.info(f"Requesting new token for {scope}")
     token_url = f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
     body_data = dict(
@@ -187,12 +183,36 @@ async def request_graph_token(
     resp_json = json.loads(resp.body.decode("utf-8"))
     token = resp_json["access_token"]
     payload = jwt.decode(token, verify=False)
+    return token, payload["exp"]
 
-    # store in expiring cache
-    _token_cache[cache_key] = {"token": token, "expiry": payload["exp"]}
-    seconds = payload["exp"] - time.time() - _expiry_buffer
-    app_log.info(f"Token acquired, using for {seconds:.0f} seconds")
-    return token
+
+async def request_graph_token(
+    tenant_id,
+    client_id,
+    client_secret,
+    scope="https://graph.microsoft.com/.default",
+    clear_cache=False,
+):
+    """Request an access token for the ms graph API
+
+    Tokens are cached and refreshed in the background
+    when they are within 10 minutes of expiring.
+    Concurrent requests for a new token share one request.
+    """
+    cache_key = (tenant_id, client_id, scope)
+    credential = _credentials.get(cache_key)
+    if credential is None:
+        credential = _credentials[cache_key] = CachedCredential(
+            partial(_fetch_graph_token, tenant_id, client_id, client_secret, scope),
+            name=f"token for {scope}",
+            refresh_before=_expiry_buffer,
+        )
+    if clear_cache:
+        credential.invalidate()
+    return await credential.get()
+
+
+graph_requests = Counter("graph_requests", "Requests made to the Graph API")
 
 
 async def graph_request(
@@ -202,12 +222,13 @@ async def graph_request(
 
     Returns the parsed json response if there was one
     """
+    graph_requests.inc()
     token = await request_graph_token(tenant_id, client_id, client_secret)
     if "://" in path:
         # full url, e.g. nextLink
         url = path
     else:
-        url = f"https://graph.microsoft.com/v1.0{path}"
+        url = f"{graph_url}{path}"
         if params:
             url = url_concat(url, params)
     req_headers = {"Authorization": f"Bearer {token}"}
@@ -233,15 +254,113 @@ async def graph_request(
         return resp_content
 
 
-async def paged_graph_request(path, **kwargs):
-    """Handle pagination in graph results (e.g. full user lists)"""
+async def graph_batch_request(requests):
+    """Make up to GRAPH_BATCH_SIZE requests to the graph API in a single $batch
+
+    requests is a list of dicts with "url" (relative to the API version, e.g. "/groups/...")
+    and optionally "method", "body" and "headers".
+
+    Returns the responses (dicts with "status", "headers" and "body")
+    in the same order as the requests.
+    Requests that are throttled or fail with a server error are retried.
+    """
+    if len(requests) > GRAPH_BATCH_SIZE:
+        raise ValueError(
+            f"At most {GRAPH_BATCH_SIZE} requests per batch, got {len(requests)}"
+        )
+    responses = [None] * len(requests)
+    pending = list(range(len(requests)))
+    for attempt in range(GRAPH_BATCH_RETRIES + 1):
+        batch = []
+        for i in pending:
+            request = {"id": str(i), "method": "GET"}
+            request.update(requests[i])
+            if "body" in request:
+                request.setdefault("headers", {"Content-Type": "application/json"})
+            batch.append(request)
+        resp = await graph_request(
+            "/$batch",
+            method="POST",
+            body=json.dumps({"requests": batch}),
+            unpack_value=False,
+        )
+        retry_after = 0
+        retry = []
+        for response in resp["responses"]:
+            i = int(response["id"])
+            responses[i] = response
+            if response["status"] == 429 or response["status"] >= 500:
+                retry.append(i)
+                headers = response.get("headers") or {}
+                try:
+                    retry_after = max(retry_after, int(headers.get("Retry-After", 1)))
+                except ValueError:
+                    retry_after = max(retry_after, 1)
+        pending = retry
+        if not pending or attempt == GRAPH_BATCH_RETRIES:
+            break
+        app_log.warning(
+            f"Retrying {len(pending)}/{len(requests)} batched requests after {retry_after}s"
+        )
+        await asyncio.sleep(retry_after)
+    return responses
+
+
+async def graph_batch_requests(requests, concurrency=None):
+    """Make any number of requests to the graph API
+
+    Requests are split into $batch requests,
+    with at most `concurrency` batches in flight at once.
+
+    Returns the responses in the same order as the requests.
+    """
+    if concurrency is None:
+        concurrency = GRAPH_BATCH_CONCURRENCY
+    sem = asyncio.Semaphore(concurrency)
+
+    async def do_batch(batch):
+        async with sem:
+            return await graph_batch_request(batch)
+
+    batches = [
+        requests[i : i + GRAPH_BATCH_SIZE]
+        for i in range(0, len(requests), GRAPH_BATCH_SIZE)
+    ]
+    responses = []
+    for batch_responses in await asyncio.gather(*(do_batch(b) for b in batches)):
+        responses.extend(batch_responses)
+    return responses
+
+
+def _check_batch_response(response, description):
+    """Raise if a batched request failed"""
+    if response["status"] >= 400:
+        raise HTTPClientError(
+            response["status"], f"Batched request failed for {description}: {response}"
+        )
+
+
+def _batch_response_value(response, description):
+    """Return the "value" list of a batched response, raising on errors"""
+    _check_batch_response(response, description)
+    return response["body"]["value"]
+
+
+async def paged_graph_request(path, *, readahead=None, **kwargs):
+    """Handle pagination in graph results (e.g. full user lists)
+
+    The page at @odata.nextLink is fetched while the current page is consumed,
+    up to `readahead` pages ahead (see utils.prefetch_pages).
+    """
     params = kwargs.setdefault("params", {})
     kwargs["unpack_value"] = False
-    next_url = path
-    while next_url:
-        resp = await graph_request(next_url, **kwargs)
-        next_url = resp.get("@odata.nextLink")
-        for item in resp["value"]:
+
+    async def fetch_page(next_url):
+        resp = await graph_request(next_url or path, **kwargs)
+        return resp["value"], resp.get("@odata.nextLink")
+
+    async for page in prefetch_pages(fetch_page, readahead):
+        for item in page:
             yield item
 
 
@@ -331,14 +450,18 @@ async def find_user_by_phone(phone_number, select=None):
     return wrap_user(users[0])
 
 
-async def find_users_by_phone(phone_numbers, select=None, concurrency=10):
+async def find_users_by_phone(phone_numbers, select=None, concurrency=None):
     """Return a list of users (dict) associated with the given phone numbers
 
     Numbers that do not belong to any users will be skipped.
+
+    Concurrent requests are limited by the adaptive limiter in utils.fetch,
+    and to at most `concurrency` lookups, if given.
     """
 
     users = []
-    sem = asyncio.Semaphore(concurrency)
+    # unless concurrency is given, requests are only limited by fetch
+    sem = asyncio.Semaphore(concurrency or max(len(phone_numbers), 1))
 
     async def do_one(number):
         async with sem:
@@ -355,7 +478,7 @@ async def find_users_by_phone(phone_numbers, select=None, concurrency=10):
     return users
 
 
-async def extract_deleted_numbers(phone_numbers, concurrency=10):
+async def extract_deleted_numbers(phone_numbers, concurrency=None):
     """Extract phone numbers from the input that belongs to deleted susers"""
 
     existing_users = await find_users_by_phone(
@@ -371,66 +494,79 @@ async def extract_deleted_numbers(phone_numbers, concurrency=10):
     return deleted_numbers
 
 
-async def store_device_id(user, device_id):
-    """Store device_id in groups
+async def _store_device_id(user, device_id, state):
+    """One attempt of store_device_id
 
-    Group name == device id
-    user group membership list == phone number device id history
+    Checks the current state before each write,
+    so it can be repeated after a partial failure.
     """
-    user = wrap_user(user)
-    app_log.info(f"Storing device id {device_id[:8]}... on user {user['logName']}")
     user_id = user["id"]
+    user_ref = f"https://graph.microsoft.com/v1.0/users/{user_id}"
 
-    # store 'latest' device id on custom attr
-    await graph_request(
-        f"/users/{user_id}",
-        method="PATCH",
-        body=json.dumps({extension_attr_name("deviceId"): device_id}),
-        headers={"Content-Type": "application/json"},
+    # independent requests in one $batch:
+    # store 'latest' device id on custom attr,
+    # and look up the device group with its members
+    user_response, group_response = await graph_batch_request(
+        [
+            {
+                "url": f"/users/{user_id}",
+                "method": "PATCH",
+                "body": {extension_attr_name("deviceId"): device_id},
+            },
+            {
+                "url": url_concat(
+                    "/groups",
+                    {
+                        "$select": "id,displayName",
+                        "$filter": f"displayName eq '{device_id}'",
+                        "$expand": "members($select=id)",
+                    },
+                )
+            },
+        ]
     )
+    _check_batch_response(user_response, f"device id of {user['logName']}")
+    groups = _batch_response_value(group_response, f"group {device_id}")
+
+    if len(groups) > 1:
+        groups = await _remove_duplicate_groups(user, device_id, groups)
 
     # use groups to preserve device history
-    groups = await graph_request(
-        "/groups",
-        params={
-            "$select": "id,displayName",
-            "$filter": (f"displayName eq '{device_id}'"),
-        },
-    )
     if groups:
-        if len(groups) > 1:
-            raise ValueError(
-                f"Multiple groups matching device id {device_id}! Matches: {groups}"
-            )
+        group = groups[0]
         app_log.info(
             f"Found matching group for {device_id[:8]}..., checking membership"
         )
-        members = await graph_request(
-            f"/groups/{groups[0]['id']}/members", params={"$select": "id,displayName"}
-        )
-        for member in members:
-            if member["id"] == user_id:
-                app_log.info(
-                    f"{user['logName'][:5]}... already member of group {device_id}"
-                )
-                return
+        members = group.get("members") or []
+        if any(member["id"] == user_id for member in members):
+            app_log.info(
+                f"{user['logName'][:5]}... already member of group {device_id}"
+            )
+            return
         if members:
             app_log.warning(
                 f"Registering new owner of device {device_id} ({len(members)} past owners)"
             )
         app_log.info(f"Adding user {user['logName']} to group {device_id}")
-        await graph_request(
-            f"/groups/{groups[0]['id']}/members/$ref",
-            method="POST",
-            body=json.dumps(
-                {"@odata.id": f"https://graph.microsoft.com/v1.0/users/{user['id']}"}
-            ),
-            headers={"Content-Type": "application/json"},
-        )
-
+        try:
+            await graph_request(
+                f"/groups/{group['id']}/members/$ref",
+                method="POST",
+                body=json.dumps({"@odata.id": user_ref}),
+                headers={"Content-Type": "application/json"},
+            )
+        except HTTPClientError as e:
+            # added by a previous attempt, or not in the expanded members
+            if not (
+                e.code == 400
+                and e.response is not None
+                and b"already exist" in (e.response.body or b"")
+            ):
+                raise
         return
 
     app_log.info(f"Creating device group for {device_id}")
+    state["created_group"] = True
     return await graph_request(
         f"/groups",
         method="POST",
@@ -442,15 +578,92 @@ async def store_device_id(user, device_id):
                 "mailNickname": device_id,
                 "displayName": device_id,
                 "description": f"Group storing association for device {device_id}",
-                "members@odata.bind": [
-                    f"https://graph.microsoft.com/v1.0/users/{user['id']}"
-                ],
+                "members@odata.bind": [user_ref],
             }
         ),
         headers={"Content-Type": "application/json"},
     )
 
 
+async def _remove_duplicate_groups(user, device_id, groups):
+    """Remove extra groups for a device id, created by retried requests
+
+    Returns the remaining group, in a list.
+    Raises if any of the groups has another member.
+    """
+    member_ids = {
+        member["id"] for group in groups for member in group.get("members") or []
+    }
+    if member_ids - {user["id"]}:
+        raise ValueError(
+            f"Multiple groups matching device id {device_id}! Matches: {groups}"
+        )
+    app_log.warning(f"Removing {len(groups) - 1} duplicate groups for {device_id}")
+    # keep a group the user is already a member of
+    groups = sorted(groups, key=lambda group: not group.get("members"))
+    await asyncio.gather(*(delete_group(group) for group in groups[1:]))
+    return groups[:1]
+
+
+async def _undo_store_device_id(user, device_id, state):
+    """Undo the partial result of a failed store_device_id"""
+    attr = extension_attr_name("deviceId")
+    futures = [
+        graph_request(
+            f"/users/{user['id']}",
+            method="PATCH",
+            body=json.dumps({attr: user.get(attr)}),
+            headers={"Content-Type": "application/json"},
+        )
+    ]
+    if state.get("created_group"):
+        futures.append(delete_device_group(device_id))
+    for result in await asyncio.gather(*futures, return_exceptions=True):
+        if isinstance(result, Exception):
+            app_log.error(f"Error undoing device id {device_id[:8]}...: {result}")
+
+
+def _retry_store_device_id(error):
+    """Whether a failed store_device_id should be retried"""
+    if isinstance(error, TimeoutError):
+        return True
+    return isinstance(error, HTTPClientError) and (
+        error.code == 429 or error.code >= 500
+    )
+
+
+async def store_device_id(user, device_id):
+    """Store device_id in groups
+
+    Group name == device id
+    user group membership list == phone number device id history
+
+    Storing the device id on the user and looking up the group
+    don't depend on each other, and are made in a single $batch.
+    Only adding the user to the group, or creating it, waits for the lookup.
+
+    Failed attempts are retried up to STORE_DEVICE_ID_RETRIES times.
+    If it still fails, the device id stored on the user is restored
+    and a group created for the device is deleted,
+    so the user isn't left half-registered.
+    """
+    user = wrap_user(user)
+    app_log.info(f"Storing device id {device_id[:8]}... on user {user['logName']}")
+    state = {}
+    for attempt in range(STORE_DEVICE_ID_RETRIES + 1):
+        try:
+            return await _store_device_id(user, device_id, state)
+        except Exception as e:
+            if attempt == STORE_DEVICE_ID_RETRIES or not _retry_store_device_id(e):
+                await _undo_store_device_id(user, device_id, state)
+                raise
+            wait = STORE_DEVICE_ID_RETRY_WAIT * 2 ** attempt
+            app_log.warning(
+                f"Error storing device id {device_id[:8]}..., retrying in {wait}s: {e}"
+            )
+            await asyncio.sleep(wait)
+
+
 def store_consent_revoked(user):
     """Store consent revoked in our extension attribute on user"""
     user = wrap_user(user)
@@ -666,6 +879,102 @@ async def phone_number_for_device_id(device_id):
         return user["displayName"]
 
 
+# device id -> expiry timestamp, for devices without a phone number,
+# least recently used first
+_no_phone_number_cache = OrderedDict()
+
+
+async def phone_numbers_for_device_ids(device_ids):
+    """Return a dict of phone numbers by device id, given many device ids
+
+    Equivalent to phone_number_for_device_id for each device id,
+    but resolved with batched graph requests.
+    The phone number is None for devices without an owner,
+    or whose owner has revoked consent.
+
+    Devices without a phone number are remembered for PHONE_NUMBER_CACHE_TTL
+    seconds, keeping at most PHONE_NUMBER_CACHE_SIZE devices.
+    Phone numbers are always looked up,
+    so that none is returned after consent is revoked or the owner changes.
+    """
+    now = time.monotonic()
+    phone_numbers = {}
+    to_lookup = []
+    for device_id in dict.fromkeys(device_ids):
+        expiry = _no_phone_number_cache.get(device_id)
+        if expiry is not None:
+            if expiry > now:
+                _no_phone_number_cache.move_to_end(device_id)
+                phone_numbers[device_id] = None
+                continue
+            del _no_phone_number_cache[device_id]
+        to_lookup.append(device_id)
+    if not to_lookup:
+        return phone_numbers
+
+    app_log.info(
+        f"Looking up phone numbers for {len(to_lookup)} devices"
+        f" ({len(phone_numbers)} cached)"
+    )
+    # first, the group for each device
+    group_responses = await graph_batch_requests(
+        [
+            {
+                "url": url_concat(
+                    "/groups",
+                    {
+                        "$select": "id,displayName",
+                        "$filter": f"displayName eq '{device_id}'",
+                    },
+                )
+            }
+            for device_id in to_lookup
+        ]
+    )
+    groups = {}
+    for device_id, response in zip(to_lookup, group_responses):
+        device_groups = _batch_response_value(response, f"device {device_id}")
+        if device_groups:
+            groups[device_id] = device_groups[0]
+        else:
+            app_log.warning(f"No group for device {device_id}")
+            phone_numbers[device_id] = None
+
+    # then, the owner of each group
+    revoked = extension_attr_name("consentRevoked")
+    with_groups = list(groups)
+    member_responses = await graph_batch_requests(
+        [
+            {
+                "url": url_concat(
+                    f"/groups/{groups[device_id]['id']}/members",
+                    {"$select": f"id,displayName,{revoked}"},
+                )
+            }
+            for device_id in with_groups
+        ]
+    )
+    for device_id, response in zip(with_groups, member_responses):
+        members = _batch_response_value(response, f"device {device_id}")
+        phone_number = None
+        if not members:
+            app_log.warning(f"No owner for device {device_id}")
+        elif members[0].get(revoked):
+            app_log.error(f"Refusing to return phone number with revoked consent")
+        else:
+            phone_number = members[0]["displayName"]
+        phone_numbers[device_id] = phone_number
+
+    expiry = time.monotonic() + PHONE_NUMBER_CACHE_TTL
+    for device_id in to_lookup:
+        if phone_numbers[device_id] is None:
+            _no_phone_number_cache[device_id] = expiry
+            _no_phone_number_cache.move_to_end(device_id)
+    while len(_no_phone_number_cache) > PHONE_NUMBER_CACHE_SIZE:
+        _no_phone_number_cache.popitem(last=False)
+    return phone_numbers
+
+
 async def process_user_deletion(user):
     """Process a user for deletion, including deletion of devices from IoTHub"""
     # local import because most graph operations don't require IOTHub access
@@ -730,8 +1039,11 @@ async def list_deleted_users(select=None, filter=None):
         yield wrap_user(user)
 
 
-async def list_groups(select=None, filter=None):
-    """yield a list of all groups"""
+async def list_groups(select=None, filter=None, expand=None):
+    """yield a list of all groups
+
+    expand may be used to include e.g. members in each group
+    """
     if select is None:
         attr_names = ",".join(
             extension_attr_name(attr["name"])
@@ -742,6 +1054,8 @@ async def list_groups(select=None, filter=None):
     params = {"$select": select, "$top": "999"}
     if filter:
         params["$filter"] = filter
+    if expand:
+        params["$expand"] = expand
     async for group in paged_graph_request(
         "/groups", params=params,
     ):
@@ -751,6 +1065,39 @@ async def list_groups(select=None, filter=None):
 phone_number_claims = ["signInNames.phoneNumber", "act_phone_number", "signinname"]
 
 
+JWT_CACHE_SIZE = int(os.environ.get("JWT_CACHE_SIZE") or 10000)
+
+# sha256(token) -> (exp, kid, public key, verified payload), least recently used first
+_verified_tokens = OrderedDict()
+
+
+def verify_token(token):
+    """Verify a B2C jwt and return its payload
+
+    Verified payloads are cached until the token expires
+    or its signing key is no longer in the key set, whichever comes first.
+    Raises if the token is invalid.
+    """
+    token_hash = hashlib.sha256(token.encode("utf8")).digest()
+    cached = _verified_tokens.get(token_hash)
+    if cached is not None:
+        exp, kid, public_key, payload = cached
+        if exp > time.time() and _PUBLIC_KEYS.get(kid) is public_key:
+            _verified_tokens.move_to_end(token_hash)
+            return dict(payload)
+        del _verified_tokens[token_hash]
+
+    kid = jwt.get_unverified_header(token)["kid"]
+    public_key = _PUBLIC_KEYS[kid]
+    payload = jwt.decode(token, public_key, algorithms=["RS256"], audience=audience)
+    exp = payload.get("exp")
+    if isinstance(exp, (int, float)):
+        _verified_tokens[token_hash] = (exp, kid, public_key, dict(payload))
+        while len(_verified_tokens) > JWT_CACHE_SIZE:
+            _verified_tokens.popitem(last=False)
+    return payload
+
+
 def get_user_token(handler, claims=None, phone_number_claim="sign", public_key=None):
     """B2C JWT-token authorization for tornado applications
 
@@ -767,9 +1114,7 @@ def get_user_token(handler, claims=None, phone_number_claim="sign", public_key=N
         raise web.HTTPError(403, "Malformed auth header")
     token = rest[0]
     try:
-        kid = jwt.get_unverified_header(token)["kid"]
-        public_key = _PUBLIC_KEYS[kid]
-        payload = jwt.decode(token, public_key, algorithms=["RS256"], audience=audience)
+        payload = verify_token(token)
         for key, value in claims.items():
             if key not in payload:
                 raise ValueError(f"Need claim {key}")
@@ -15,7 +15,7 @@ from opencensus.ext.azure import metrics_exporter
 from tornado import web
 from tornado.log import app_log
 
-from corona_backend import devices, graph, handlers
+from corona_backend import device_pool, devices, graph, handlers
 from corona_backend import middleware as mw
 from corona_backend import pin, sql
 from corona_backend.graph import phone_number_for_device_id
@@ -90,32 +90,38 @@ class RegisterDeviceHandler(B2CHandler):
                 f"Phone number {masked_number} is already associated with device id {existing_device_id}. Registering new device."
             )
 
-        device_future = asyncio.ensure_future(devices.create_new_device())
-        tic = time.perf_counter()
-        try:
-            await asyncio.wait_for(device_future, timeout=PROVISIONING_TIMEOUT)
-        except asyncio.TimeoutError:
-            self.settings["consecutive_failures"] += 1
-            app_log.error(
-                "Timeout registering device ({consecutive_failures}/{consecutive_failure_limit} before abort)".format(
-                    **self.settings
-                )
-            )
-            if (
-                self.settings["consecutive_failures"]
-                >= self.settings["consecutive_failure_limit"]
-            ):
-                app_log.critical("Aborting due to consecutive failure limit!")
-                loop = asyncio.get_event_loop()
-                loop.call_later(2, loop.stop)
-            raise web.HTTPError(500, "Timeout registering device")
+        # use a device provisioned ahead of time, if there is one
+        pooled = await device_pool.claim_device()
+        if pooled is not None:
+            device_id, device_key = pooled
+            app_log.info(f"Claimed device {device_id} from pool")
         else:
-            self.settings["consecutive_failures"] = 0
-            toc = time.perf_counter()
-            app_log.info(f"Registered device in {int(1000 * (toc-tic))}ms")
-        device = await device_future
-        device_id = device["deviceId"]
-        device_key = device["authentication"]["symmetricKey"]["primaryKey"]
+            device_future = asyncio.ensure_future(devices.create_new_device())
+            tic = time.perf_counter()
+            try:
+                await asyncio.wait_for(device_future, timeout=PROVISIONING_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.settings["consecutive_failures"] += 1
+                app_log.error(
+                    "Timeout registering device ({consecutive_failures}/{consecutive_failure_limit} before abort)".format(
+                        **self.settings
+                    )
+                )
+                if (
+                    self.settings["consecutive_failures"]
+                    >= self.settings["consecutive_failure_limit"]
+                ):
+                    app_log.critical("Aborting due to consecutive failure limit!")
+                    loop = asyncio.get_event_loop()
+                    loop.call_later(2, loop.stop)
+                raise web.HTTPError(500, "Timeout registering device")
+            else:
+                self.settings["consecutive_failures"] = 0
+                toc = time.perf_counter()
+                app_log.info(f"Registered device in {int(1000 * (toc-tic))}ms")
+            device = await device_future
+            device_id = device["deviceId"]
+            device_key = device["authentication"]["symmetricKey"]["primaryKey"]
         iothub_hostname = devices.iothub_hostname
 
         # store device id on user in AD
@@ -263,6 +269,7 @@ def main(port):
     # initialize AD extension attributes
     loop.run_sync(graph.ensure_custom_attrs_exist)
     graph.keep_jwt_keys_updated()
+    device_pool.keep_pool_filled()
     handlers.start_app(
         endpoints(),
         port,
@@ -7,6 +7,9 @@ import random
 import string
 from datetime import timedelta
 
+import pyodbc
+from tornado.log import app_log
+
 from corona_backend import utils
 from corona_backend.sql import with_db
 
@@ -15,12 +18,56 @@ ascii_letters_and_digits = string.ascii_letters + string.digits
 # opt-in to pin codes via environment variable
 PIN_ENABLED = os.environ.get("PIN_ENABLED", "0") == "1"
 
+# phone numbers per query when fetching pins in bulk
+# (sql server allows at most 2100 parameters in a query)
+PIN_BATCH_SIZE = int(os.environ.get("PIN_BATCH_SIZE") or 1000)
+
+_insert_pin_code_query = r"{CALL dbo.insertPinCode(?,?,?)}"
+
 
 @with_db()
 def store_pin_code(db, phone_number, pin_code, timestamp):
-    db.execute(
-        r"{CALL dbo.insertPinCode(?,?,?)}", (phone_number, pin_code, timestamp)
-    ).commit()
+    db.execute(_insert_pin_code_query, (phone_number, pin_code, timestamp)).commit()
+
+
+@with_db()
+def store_pin_codes(db, pin_codes, timestamp):
+    """Store many pin codes (a dict of pin codes by phone number) in one transaction
+
+    If that fails, the transaction is rolled back
+    and the pin codes are stored one at a time.
+
+    Returns a dict of errors by phone number for pin codes that could not be stored.
+    """
+    rows = [
+        (phone_number, pin_code, timestamp)
+        for phone_number, pin_code in pin_codes.items()
+    ]
+    cursor = db.cursor()
+    cursor.fast_executemany = True
+    try:
+        cursor.executemany(_insert_pin_code_query, rows)
+        cursor.commit()
+        return {}
+    except pyodbc.InterfaceError:
+        raise
+    except pyodbc.Error as e:
+        app_log.error(
+            f"Error storing {len(rows)} pin codes in bulk, storing one at a time: {e}"
+        )
+        cursor.rollback()
+
+    errors = {}
+    for row in rows:
+        try:
+            db.execute(_insert_pin_code_query, row).commit()
+        except pyodbc.InterfaceError:
+            raise
+        except pyodbc.Error as e:
+            app_log.error(f"Error storing pin code for {utils.mask_phone(row[0])}: {e}")
+            db.rollback()
+            errors[row[0]] = e
+    return errors
 
 
 @with_db()
@@ -33,6 +80,26 @@ def get_latest_pin_code_after_threshold(db, phone_number, threshold):
         return row[0]
 
 
+@with_db()
+def get_latest_pin_codes_after_threshold(db, phone_numbers, threshold):
+    """Bulk get_latest_pin_code_after_threshold
+
+    Returns a dict of pin codes by phone number,
+    without the phone numbers that have no pin code after threshold.
+    """
+    pin_codes = {}
+    for i in range(0, len(phone_numbers), PIN_BATCH_SIZE):
+        batch = phone_numbers[i : i + PIN_BATCH_SIZE]
+        values = ",".join("(?)" for _ in batch)
+        for phone_number, pin_code in db.execute(
+            f"SELECT numbers.msisdn, p.pin FROM (VALUES {values}) AS numbers(msisdn)"
+            r" CROSS APPLY dbo.getPinCodeNewestEntryByThreshold(numbers.msisdn, ?) AS p",
+            (*batch, threshold),
+        ).fetchall():
+            pin_codes[phone_number] = pin_code
+    return pin_codes
+
+
 @with_db()
 def get_pin_codes(db, phone_number):
     pin_codes = []
@@ -74,3 +141,35 @@ async def fetch_or_generate_pin(phone_number, not_older_than=7):
     if pin is None:
         pin = await generate_and_store_pin(phone_number=phone_number)
     return pin
+
+
+async def fetch_or_generate_pins(phone_numbers, not_older_than=7, raise_on_error=True):
+    """Bulk fetch_or_generate_pin
+
+    Fetches the pins of all phone numbers in one query,
+    and stores all newly generated pins in one transaction.
+
+    Returns a dict of pins by phone number.
+    If a pin could not be stored, the first error is raised,
+    or if raise_on_error is False, the error is returned in place of the pin.
+    """
+    phone_numbers = list(dict.fromkeys(phone_numbers))
+    if not phone_numbers:
+        return {}
+
+    threshold = utils.now_at_utc() - timedelta(days=not_older_than)
+    pins = await get_latest_pin_codes_after_threshold(
+        phone_numbers=phone_numbers, threshold=threshold
+    )
+    new_pins = {
+        phone_number: generate_pin()
+        for phone_number in phone_numbers
+        if phone_number not in pins
+    }
+    if new_pins:
+        errors = await store_pin_codes(pin_codes=new_pins, timestamp=utils.now_at_utc())
+        if errors and raise_on_error:
+            raise next(iter(errors.values()))
+        pins.update(new_pins)
+        pins.update(errors)
+    return {phone_number: pins[phone_number] for phone_number in phone_numbers}
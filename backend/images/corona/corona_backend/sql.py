@@ -1,16 +1,22 @@
 """SQL utilities"""
 
 import asyncio
+import base64
 import datetime
+import hashlib
 import json
 import os
 import struct
 import threading
+import time
 from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from functools import partial
 
 import objgraph
 import pyodbc
+from prometheus_client import Counter, Gauge, Histogram
 from tornado.log import app_log
 
 from corona_backend import utils
@@ -99,22 +105,244 @@ async def connect_to_database(**extra_params):
             await asyncio.sleep(2 ** i * CONNECT_FIRST_INTERVAL)
 
 
-db_pools = defaultdict(
-    lambda: ThreadPoolExecutor(int(os.environ.get("DB_THREADS") or 4))
+DB_THREADS = int(os.environ.get("DB_THREADS") or 4)
+
+db_pools = defaultdict(lambda: ThreadPoolExecutor(DB_THREADS))
+
+# maximum number of open connections per set of connection parameters
+# default: one per db thread, plus the dedicated thread for unpooled calls
+SQL_POOL_SIZE = int(os.environ.get("SQL_POOL_SIZE") or DB_THREADS + 1)
+# connections are closed after this many seconds,
+# so that new connections pick up refreshed access tokens
+SQL_POOL_MAX_LIFETIME = int(os.environ.get("SQL_POOL_MAX_LIFETIME") or 1800)
+# connections idle for longer than this are checked before reuse
+SQL_POOL_CHECK_INTERVAL = int(os.environ.get("SQL_POOL_CHECK_INTERVAL") or 30)
+# seconds to wait for a free connection before raising PoolTimeout
+SQL_POOL_TIMEOUT = float(os.environ.get("SQL_POOL_TIMEOUT") or 30)
+# streaming queries hold their connection while waiting for the client,
+# so they get their own connections and threads
+SQL_STREAM_POOL_SIZE = int(os.environ.get("SQL_STREAM_POOL_SIZE") or 4)
+
+sql_pool_wait_seconds = Histogram(
+    "sql_pool_wait_seconds",
+    "Time spent waiting for a database connection from the pool",
+    ["pool"],
 )
+sql_pool_connections = Gauge(
+    "sql_pool_connections",
+    "Open database connections in the pool, by state",
+    ["pool", "state"],
+)
+sql_pool_connects = Counter(
+    "sql_pool_connects", "New database connections opened by the pool", ["pool"],
+)
+sql_pool_discards = Counter(
+    "sql_pool_discards",
+    "Database connections closed by the pool, by reason",
+    ["pool", "reason"],
+)
+sql_pool_timeouts = Counter(
+    "sql_pool_timeouts",
+    "Database connection requests that timed out waiting for the pool",
+    ["pool"],
+)
+sql_queries = Counter("sql_queries", "Database calls made with with_db")
 
 
 _check_connection_query = r"SELECT CASE DATABASEPROPERTYEX( DB_NAME(), 'Updateability') WHEN 'READ_ONLY' THEN 'Y' ELSE 'N' END"
 
 
+class PoolTimeout(TimeoutError):
+    """No database connection became free within the pool's timeout"""
+
+
+class ConnectionPool:
+    """Bounded pool of database connections, shared by threads
+
+    - at most `size` connections are in use at once,
+      threads wait up to `timeout` seconds for a free connection beyond that,
+      then PoolTimeout is raised
+    - connections idle for more than `check_interval` seconds
+      are checked before reuse, broken connections are replaced
+    - connections older than `max_lifetime` seconds are closed
+    - transactions left open by a caller are rolled back
+      when the connection is returned
+    """
+
+    def __init__(
+        self,
+        connect,
+        *,
+        name="default",
+        size=SQL_POOL_SIZE,
+        max_lifetime=SQL_POOL_MAX_LIFETIME,
+        check_interval=SQL_POOL_CHECK_INTERVAL,
+        timeout=SQL_POOL_TIMEOUT,
+        clock=time.monotonic,
+    ):
+        self.connect = connect
+        self.name = name
+        self.size = size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.check_interval = check_interval
+        self.clock = clock
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        # (created, last used, connection), most recently used last
+        self._idle = []
+        self.in_use = 0
+
+    def _update_metrics(self):
+        sql_pool_connections.labels(pool=self.name, state="idle").set(len(self._idle))
+        sql_pool_connections.labels(pool=self.name, state="in_use").set(self.in_use)
+
+    def _discard(self, db, reason):
+        sql_pool_discards.labels(pool=self.name, reason=reason).inc()
+        try:
+            db.close()
+        except Exception as e:
+            app_log.warning(f"Error closing {reason} connection: {e}")
+
+    def _get(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                created, last_used, db = self._idle.pop()
+            now = self.clock()
+            if now - created > self.max_lifetime:
+                self._discard(db, "expired")
+                continue
+            if now - last_used > self.check_interval:
+                try:
+                    db.execute(_check_connection_query).fetchall()
+                except Exception as e:
+                    app_log.error(f"Not reusing closed connection: {e}")
+                    self._discard(db, "broken")
+                    continue
+            return created, db
+
+        with utils.timer("db connect"):
+            db = self.connect()
+        sql_pool_connects.labels(pool=self.name).inc()
+        return self.clock(), db
+
+    def _put(self, created, db):
+        try:
+            # end any transaction left open, e.g. by reads or errors
+            db.rollback()
+        except Exception as e:
+            app_log.error(f"Not reusing broken connection: {e}")
+            self._discard(db, "broken")
+            return
+        now = self.clock()
+        if now - created > self.max_lifetime:
+            self._discard(db, "expired")
+            return
+        with self._lock:
+            self._idle.append((created, now, db))
+
+    @contextmanager
+    def connection(self):
+        """Context manager for borrowing a connection in a thread"""
+        tic = time.perf_counter()
+        acquired = self._slots.acquire(timeout=self.timeout)
+        sql_pool_wait_seconds.labels(pool=self.name).observe(time.perf_counter() - tic)
+        if not acquired:
+            sql_pool_timeouts.labels(pool=self.name).inc()
+            raise PoolTimeout(
+                f"No database connection free in pool {self.name} after {self.timeout}s"
+            )
+        try:
+            created, db = self._get()
+            with self._lock:
+                self.in_use += 1
+                self._update_metrics()
+            try:
+                yield db
+            finally:
+                with self._lock:
+                    self.in_use -= 1
+                self._put(created, db)
+                with self._lock:
+                    self._update_metrics()
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """Close idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self._update_metrics()
+        for created, last_used, db in idle:
+            self._discard(db, "closed")
+
+
+def _open_connection(params):
+    # Check the object counts before pyodbc connection.
+    if DEBUG_OBJGRAPH:
+        app_log.info(
+            f"Checking the object counts before pyodbc connection: {objgraph.growth()}"
+        )
+
+    db = asyncio.run(connect_to_database(**params))
+
+    # Check the object counts after pyodbc connection.
+    # There should be a pyodbc object in memory
+    if DEBUG_OBJGRAPH:
+        app_log.info(
+            f"Checking the object counts after pyodbc connection: {objgraph.growth()}"
+        )
+    return db
+
+
+connection_pools = {}
+
+
+def get_connection_pool(*, streaming=False, **params):
+    """Get the connection pool for a set of connect_to_database parameters
+
+    streaming: get the separate pool for with_db_stream
+    """
+    pool_key = json.dumps(params, sort_keys=True)
+    name = ",".join(f"{key}={value}" for key, value in sorted(params.items()))
+    name = name or "default"
+    size = SQL_POOL_SIZE
+    if streaming:
+        pool_key = f"stream:{pool_key}"
+        name = f"stream:{name}"
+        size = SQL_STREAM_POOL_SIZE
+    if pool_key not in connection_pools:
+        connection_pools[pool_key] = ConnectionPool(
+            partial(_open_connection, params),
+            name=name,
+            size=size,
+            timeout=SQL_POOL_TIMEOUT,
+        )
+    return connection_pools[pool_key]
+
+
+def close_connection_pools():
+    """Close idle connections in all pools
+
+    e.g. after changing the credentials used by connect_to_database
+    """
+    for pool in connection_pools.values():
+        pool.close()
+
+
 def with_db(*, persistent=False, pooled=True, **params):
     """Decorator for calling a function in a background thread
 
+    The function is called with a database connection
+    from the pool for the given parameters.
+
     Arguments passed to with_db are passed along to connect_to_database
-    """
-    if persistent and not params.get("ApplicationIntent", "").lower() == "readonly":
-        raise ValueError("persistent connections only allowed read-only")
 
+    persistent is accepted for backward-compatibility,
+    all connections are reused.
+    """
     if pooled:
         pool_key = json.dumps(params, sort_keys=True)
     else:
@@ -123,84 +351,82 @@ def with_db(*, persistent=False, pooled=True, **params):
         if pool_key not in db_pools:
             db_pools[pool_key] = ThreadPoolExecutor(1)
     db_pool = db_pools[pool_key]
+    connection_pool = get_connection_pool(**params)
 
     def decorator(f):
         async def async_with_db(*args, **kwargs):
             def in_thread():
-                db = None
-                if persistent:
-                    try:
-                        db = async_with_db.local.db
-                    except AttributeError:
-                        pass
-                    else:
-                        try:
-                            db.execute(_check_connection_query).fetchall()
-                        except Exception as e:
-                            app_log.error(f"Not reusing closed connection: {e}")
-                            del async_with_db.local.db
-                            db = None
-
-                if db is None:
-                    with utils.timer("db connect"):
-                        # Check the object counts before pyodbc connection.
-                        if DEBUG_OBJGRAPH:
-                            app_log.info(
-                                f"Checking the object counts before pyodbc connection: {objgraph.growth()}"
-                            )
-
-                        db = asyncio.run(connect_to_database(**params))
-
-                        # Check the object counts after pyodbc connection.
-                        # There should be a pyodbc object in memory
-                        if DEBUG_OBJGRAPH:
-                            app_log.info(
-                                f"Checking the object counts after pyodbc connection: {objgraph.growth()}"
-                            )
-
-                    if persistent:
-                        async_with_db.local.db = db
-
-                with utils.timer(f"db query {f.__name__}"):
-                    try:
+                sql_queries.inc()
+                with connection_pool.connection() as db:
+                    with utils.timer(f"db query {f.__name__}"):
                         return f(db, *args, **kwargs)
-                    finally:
-                        if not persistent:
-                            # Check the object counts before pyodbc connection is closed.
-                            # Check if the pyodbc object still exists in memory
-                            if DEBUG_OBJGRAPH:
-                                app_log.info(
-                                    f"Checking the object counts before pyodbc connection closes: {objgraph.growth()}"
-                                )
-
-                            db.close()
-
-                            # Check the object counts after pyodbc connection is closed.
-                            # Check if the pyodbc object is removed from memory
-                            if DEBUG_OBJGRAPH:
-                                app_log.info(
-                                    f"Checking the object counts after pyodbc connection closes: {objgraph.growth()}"
-                                )
 
             with utils.timer(f"async db query {f.__name__}"):
                 return await asyncio.wrap_future(db_pool.submit(in_thread))
 
-        # attach method to close connections when persisten
-        def close_in_thread():
-            try:
-                db = async_with_db.local.db
-            except AttributeError:
-                pass
-            else:
-                db.close()
-                del async_with_db.local.db
+        # attach method to close idle connections
+        async_with_db.close = connection_pool.close
+        async_with_db.connection_pool = connection_pool
+
+        return async_with_db
+
+    return decorator
 
-        def close():
-            for i in range(2 * len(db_pool)):
-                db_pool.submit(close_in_thread).result()
 
-        async_with_db.local = threading.local()
-        async_with_db.close = close
+_stream_done = object()
+
+
+def with_db_stream(**params):
+    """Decorator for streaming the items of a generator from a background thread
+
+    Like with_db, but for generator functions.
+    The decorated function is an async generator,
+    each item is produced in a db thread.
+
+    The connection is held until the generator is exhausted or closed,
+    including while the consumer waits, e.g. for a slow client.
+    Streams use their own connection pool and threads (SQL_STREAM_POOL_SIZE),
+    so they can't take connections or threads from with_db calls.
+    Raises PoolTimeout if no stream connection is free within SQL_POOL_TIMEOUT.
+    """
+    pool_key = "stream:" + json.dumps(params, sort_keys=True)
+    if pool_key not in db_pools:
+        db_pools[pool_key] = ThreadPoolExecutor(SQL_STREAM_POOL_SIZE)
+    db_pool = db_pools[pool_key]
+    connection_pool = get_connection_pool(streaming=True, **params)
+
+    def decorator(f):
+        async def async_with_db(*args, **kwargs):
+            stack = ExitStack()
+
+            def start():
+                db = stack.enter_context(connection_pool.connection())
+                return f(db, *args, **kwargs)
+
+            def next_item(gen):
+                try:
+                    return next(gen)
+                except StopIteration:
+                    return _stream_done
+
+            def close(gen):
+                try:
+                    if gen is not None:
+                        gen.close()
+                finally:
+                    stack.close()
+
+            gen = None
+            try:
+                gen = await asyncio.wrap_future(db_pool.submit(start))
+                while True:
+                    with utils.timer(f"db stream {f.__name__}"):
+                        item = await asyncio.wrap_future(db_pool.submit(next_item, gen))
+                    if item is _stream_done:
+                        break
+                    yield item
+            finally:
+                await asyncio.wrap_future(db_pool.submit(close, gen))
 
         return async_with_db
 
@@ -217,6 +443,9 @@ def cast_nullable_float(n):
     return float(n)
 
 
+_applog_insert_query = r"{CALL dbo.applogInsert (?,?,?,?,?,?,?)}"
+
+
 @with_db()
 def log_access(
     db,
@@ -229,22 +458,44 @@ def log_access(
     organization,
     legal_means,
 ):
-    """Log a single data access event to one or more phone numbers"""
+    """Log a single data access event to one or more phone numbers
+
+    All entries are inserted in a single round trip and transaction.
+    If that fails, the transaction is rolled back
+    and the entries are inserted one at a time.
+    """
     if isinstance(phone_numbers, str):
         phone_numbers = [phone_numbers]
-    for phone_number in phone_numbers:
-        cursor = db.execute(
-            r"{CALL dbo.applogInsert (?,?,?,?,?,?,?)}",
-            (
-                timestamp,
-                phone_number,
-                person_name,
-                person_id,
-                person_organization,
-                organization,
-                legal_means,
-            ),
+    rows = [
+        (
+            timestamp,
+            phone_number,
+            person_name,
+            person_id,
+            person_organization,
+            organization,
+            legal_means,
         )
+        for phone_number in phone_numbers
+    ]
+    if len(rows) > 1:
+        cursor = db.cursor()
+        cursor.fast_executemany = True
+        try:
+            cursor.executemany(_applog_insert_query, rows)
+            cursor.commit()
+            return
+        except pyodbc.InterfaceError:
+            # connection errors won't be fixed by retrying on the same connection
+            raise
+        except pyodbc.Error as e:
+            app_log.error(
+                f"Error logging access to {len(rows)} numbers in bulk, logging one at a time: {e}"
+            )
+            cursor.rollback()
+
+    for row in rows:
+        cursor = db.execute(_applog_insert_query, row)
         cursor.commit()
 
 
@@ -315,25 +566,9 @@ def get_access_log(
     return events, total
 
 
-@with_db(ApplicationIntent="ReadOnly")
-def get_gps_events(
-    db, device_ids, page_number=1, per_page=30, time_from=None, time_to=None
-):
-    """Retrieve gps events from the database for one or more devices
-
-    Returns gps events as a list of dicts
-    """
-    if isinstance(device_ids, str):
-        device_ids = [device_ids]
-
-    if time_from is None:
-        time_from = utils.now_at_utc() - datetime.timedelta(days=90)
-    if time_to is None:
-        time_to = utils.now_at_utc() + datetime.timedelta(hours=1)
-
-    events = []
-    total = 0
-    for (
+def _gps_event(row):
+    """Convert a row from getdatabyUUIDList to a gps event dict"""
+    (
         plaform,
         osversion,
         appversion,
@@ -348,27 +583,146 @@ def get_gps_events(
         altitude,
         altitude_accuracy,
         total,
-    ) in db.execute(
+    ) = row
+    # from schema, *all* fields are nullable
+    # so make sure that any casting handles None
+    return {
+        "time_from": utils.isoformat(time_from),
+        "time_to": utils.isoformat(time_to),
+        "latitude": cast_nullable_float(latitude),
+        "longitude": cast_nullable_float(longitude),
+        "accuracy": accuracy,
+        "speed": speed,
+        "speed_accuracy": speed_accuracy,
+        "altitude": altitude,
+        "altitude_accuracy": altitude_accuracy,
+    }
+
+
+def _default_gps_range(time_from, time_to):
+    if time_from is None:
+        time_from = utils.now_at_utc() - datetime.timedelta(days=90)
+    if time_to is None:
+        time_to = utils.now_at_utc() + datetime.timedelta(hours=1)
+    return time_from, time_to
+
+
+@with_db(ApplicationIntent="ReadOnly")
+def get_gps_events(
+    db, device_ids, page_number=1, per_page=30, time_from=None, time_to=None
+):
+    """Retrieve gps events from the database for one or more devices
+
+    Returns gps events as a list of dicts
+    """
+    if isinstance(device_ids, str):
+        device_ids = [device_ids]
+
+    time_from, time_to = _default_gps_range(time_from, time_to)
+
+    events = []
+    total = 0
+    for row in db.execute(
         "{CALL getdatabyUUIDList (?,?,?,?,?)}",
         (",".join(device_ids), time_from, time_to, page_number, per_page),
     ).fetchall():
-        # from schema, *all* fields are nullable
-        # so make sure that any casting handles None
-        event = {
-            "time_from": utils.isoformat(time_from),
-            "time_to": utils.isoformat(time_to),
-            "latitude": cast_nullable_float(latitude),
-            "longitude": cast_nullable_float(longitude),
-            "accuracy": accuracy,
-            "speed": speed,
-            "speed_accuracy": speed_accuracy,
-            "altitude": altitude,
-            "altitude_accuracy": altitude_accuracy,
-        }
-        events.append(event)
+        total = row[-1]
+        events.append(_gps_event(row))
     return events, total
 
 
+GPS_STREAM_CHUNK_SIZE = int(os.environ.get("GPS_STREAM_CHUNK_SIZE") or 1000)
+# getdatabyUUIDList is paged, fetch everything as a single page
+_all_rows = 2 ** 31 - 1
+
+
+def _row_hash(row):
+    # the last column is the window total, which changes as events arrive,
+    # so only the event's own columns identify it
+    return hashlib.sha1(repr(tuple(row[:-1])).encode("utf8")).hexdigest()[:16]
+
+
+def encode_gps_cursor(time_from, row_hashes):
+    """Encode the position in a gps event stream as an opaque token
+
+    Rows are ordered by descending time_from,
+    so the position is the time_from of the last row sent,
+    and the rows with that time_from that have already been sent.
+    """
+    cursor = {"time_from": time_from.isoformat(), "sent": sorted(row_hashes)}
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode("utf8")).decode("ascii")
+
+
+def decode_gps_cursor(token):
+    """Decode a token from encode_gps_cursor
+
+    Returns (time_from, row hashes). Raises ValueError for invalid tokens.
+    """
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+        return (
+            datetime.datetime.fromisoformat(cursor["time_from"]),
+            set(cursor["sent"]),
+        )
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {token}") from e
+
+
+@with_db_stream(ApplicationIntent="ReadOnly")
+def stream_gps_events(
+    db,
+    device_ids,
+    time_from=None,
+    time_to=None,
+    cursor=None,
+    chunk_size=GPS_STREAM_CHUNK_SIZE,
+):
+    """Stream gps events from the database for one or more devices
+
+    Rows are fetched from the result set as they are consumed,
+    so memory use does not depend on the size of the time range.
+
+    cursor: token from a previous stream of the same query to resume from.
+    The query starts at the cursor's time_from,
+    so resuming late in a large range doesn't repeat the rows already sent.
+
+    Yields (events, cursor) for each chunk of up to chunk_size events,
+    where cursor is the token for resuming after this chunk.
+    """
+    if isinstance(device_ids, str):
+        device_ids = [device_ids]
+
+    time_from, time_to = _default_gps_range(time_from, time_to)
+    if cursor:
+        last_time_from, sent = decode_gps_cursor(cursor)
+    else:
+        last_time_from, sent = None, set()
+
+    # rows from last_time_from (inclusive, for ties) onward
+    result = db.execute(
+        "{CALL getdatabyUUIDList (?,?,?,?,?,?)}",
+        (",".join(device_ids), time_from, time_to, 1, _all_rows, last_time_from),
+    )
+    while True:
+        rows = result.fetchmany(chunk_size)
+        if not rows:
+            break
+        events = []
+        for row in rows:
+            row_time_from = row[4]
+            row_hash = _row_hash(row)
+            if row_time_from == last_time_from and row_hash in sent:
+                # sent before resuming
+                continue
+            if row_time_from != last_time_from:
+                last_time_from = row_time_from
+                sent = set()
+            sent.add(row_hash)
+            events.append(_gps_event(row))
+        if events:
+            yield events, encode_gps_cursor(last_time_from, sent)
+
+
 @with_db()
 def request_contact_ids(
     db, device_id, *, count=10,
@@ -389,6 +743,35 @@ def request_contact_ids(
     return contact_ids
 
 
+@with_db()
+def add_pooled_device(db, device_id, primary_key):
+    """Add a provisioned IoTHub device to the pool of devices for registration"""
+    cursor = db.execute(r"{CALL dbo.addPooledDevice(?, ?)}", (device_id, primary_key))
+    cursor.commit()
+
+
+@with_db()
+def claim_pooled_device(db):
+    """Claim the oldest device in the pool
+
+    The device is removed from the pool as it is claimed,
+    so concurrent claims never get the same device.
+
+    Returns (device_id, primary_key), or None if the pool is empty.
+    """
+    cursor = db.execute(r"{CALL dbo.claimPooledDevice}")
+    row = cursor.fetchone()
+    cursor.commit()
+    if row:
+        return row[0], row[1]
+
+
+@with_db()
+def get_device_pool_size(db):
+    """Return the number of devices in the pool"""
+    return db.execute(r"SELECT poolsize FROM dbo.getDevicePoolSize()").fetchone()[0]
+
+
 @with_db()
 def upsert_birth_year(db, values):
     cursor = db.cursor()
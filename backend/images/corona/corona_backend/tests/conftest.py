@@ -13,7 +13,7 @@ from _pytest.monkeypatch import MonkeyPatch
 from tornado import ioloop
 from tornado.platform.asyncio import AsyncIOMainLoop
 
-from corona_backend import devices, testsql
+from corona_backend import devices, sql, testsql
 from corona_backend.fhi.handlers.helsenorge import HelseNorgeHandler
 
 from . import mocks
@@ -66,6 +66,17 @@ def make_async_generator(f):
     return inner
 
 
+@pytest.fixture(autouse=True)
+def close_connection_pools():
+    """Don't share pooled database connections between tests
+
+    Tests switch database users and mock connections
+    """
+    sql.close_connection_pools()
+    yield
+    sql.close_connection_pools()
+
+
 @pytest.fixture(scope="module")
 def monkeymodule():
     """Makes monkey patching possible in module scope"""
@@ -253,6 +264,21 @@ def user_for_device_mock():
         yield mock
 
 
+@pytest.fixture()
+def phone_numbers_for_device_ids_mock():
+    mock = Mock(
+        return_value={
+            "result_key_1": "+0012341234",
+            "result_key_2": "+0012341235",
+            "result_key_3": "+0012341236",
+        }
+    )
+    with patch(
+        "corona_backend.graph.phone_numbers_for_device_ids", new=make_async(mock)
+    ):
+        yield mock
+
+
 @pytest.fixture()
 def get_device_mock():
     mock = Mock(
@@ -429,8 +455,10 @@ def get_device_mock_auth():
     def m(device_id):
         return {TEST_DEVICE_ID: mock_data_1, "deviceId2": mock_data_2}.get(device_id)
 
+    devices._device_key_cache.clear()
     with patch("corona_backend.devices.get_device", new=make_async(m)):
         yield m
+    devices._device_key_cache.clear()
 
 
 @pytest.fixture
@@ -1,19 +1,24 @@
+import asyncio
+import json
+from urllib.parse import parse_qs, urlparse
+
+from tornado import web
+from tornado.httputil import url_concat
+
+
 class LookupHandlerRedisMock(object):
 
     expected_rpush_args = [
         (
             "analysis-jobs",
-            b"""{"request_id": "1234", "device_id": "device_id1", "result_key": "lookup:1234:result:device_id1", "time_from": null, "time_to": null, "expiry": 14400}""",
-        ),
-        (
-            "analysis-jobs",
-            b'{"request_id": "1234", "device_id": "device_id2", "result_key": "lookup:1234:result:device_id2", "time_from": null, "time_to": null, "expiry": 14400}',
+            b"""{"request_id": "1234", "device_id": "device_id1", "result_key": "lookup:1234:result:device_id1", "done_key": "lookup:1234:done", "time_from": null, "time_to": null, "expiry": 14400, "submitted_at": "2018-03-12T10:12:45Z"}""",
+            b'{"request_id": "1234", "device_id": "device_id2", "result_key": "lookup:1234:result:device_id2", "done_key": "lookup:1234:done", "time_from": null, "time_to": null, "expiry": 14400, "submitted_at": "2018-03-12T10:12:45Z"}',
         ),
     ]
     expected_set_args = [
         (
             "lookup:1234:info",
-            '{"phone_number": "+0012341234", "result_keys": ["lookup:1234:result:device_id1", "lookup:1234:result:device_id2"], "device_ids": ["device_id1", "device_id2"]}',
+            '{"phone_number": "+0012341234", "result_keys": ["lookup:1234:result:device_id1", "lookup:1234:result:device_id2"], "device_ids": ["device_id1", "device_id2"], "done_key": "lookup:1234:done"}',
         )
     ]
     expected_set_kwargs = [{"ex": 14400}]
@@ -21,6 +26,18 @@ class LookupHandlerRedisMock(object):
     def __init__(self):
         self._n_rpush_calls = 0
         self._n_set_calls = 0
+        self._n_execute_calls = 0
+
+    def pipeline(self, transaction=True):
+        # jobs and request info are stored in one transaction
+        assert transaction
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
 
     def rpush(self, *args, **kwargs):
         assert args == self.expected_rpush_args[self._n_rpush_calls]
@@ -30,6 +47,12 @@ class LookupHandlerRedisMock(object):
     def set(self, *args, **kwargs):
         assert args == self.expected_set_args[self._n_set_calls]
         assert kwargs == self.expected_set_kwargs[self._n_set_calls]
+        self._n_set_calls += 1
+
+    async def execute(self):
+        assert self._n_rpush_calls == len(self.expected_rpush_args)
+        assert self._n_set_calls == len(self.expected_set_args)
+        self._n_execute_calls += 1
 
 
 class LookupResultsHandlerRedisMock(object):
@@ -84,21 +107,21 @@ class LookupResultsHandlerRedisMock(object):
         self._n_mget_calls = 0
         self._n_get_calls = 0
 
-    def exists(self, *args, **kwargs):
+    async def exists(self, *args, **kwargs):
         assert args == self.expected_exists_args[self._n_exists_calls]
         assert kwargs == {}
         output = self.exits_return_values[self._n_exists_calls]
         self._n_exists_calls += 1
         return output
 
-    def get(self, *args, **kwargs):
+    async def get(self, *args, **kwargs):
         assert args == self.expected_get_args[self._n_get_calls]
         assert kwargs == {}
         output = self.get_return_values[self._n_get_calls]
         self._n_get_calls += 1
         return output
 
-    def mget(self, *args, **kwargs):
+    async def mget(self, *args, **kwargs):
         assert args == self.expected_mget_args[self._n_mget_calls]
         assert kwargs == {}
         output = self.mget_return_values[self._n_mget_calls]
@@ -110,7 +133,7 @@ class LookupResultsHandlerRedisNoResultMock(object):
     def __init__(self):
         pass
 
-    def get(self, *args, **kwargs):
+    async def get(self, *args, **kwargs):
         return None
 
 
@@ -118,7 +141,7 @@ class LookupResultsHandlerRedisAnalyisInProgressMock(object):
     def __init__(self):
         pass
 
-    def get(self, *args, **kwargs):
+    async def get(self, *args, **kwargs):
         return b"""
         {
             "device_ids":[
@@ -132,7 +155,7 @@ class LookupResultsHandlerRedisAnalyisInProgressMock(object):
             ]
         }"""
 
-    def exists(self, *args, **kwargs):
+    async def exists(self, *args, **kwargs):
         return 1
 
 
@@ -140,7 +163,7 @@ class LookupResultsHandlerRedisAnalyisErrorMock(object):
     def __init__(self):
         pass
 
-    def get(self, *args, **kwargs):
+    async def get(self, *args, **kwargs):
         return b"""
         {
             "device_ids":[
@@ -154,10 +177,10 @@ class LookupResultsHandlerRedisAnalyisErrorMock(object):
             ]
         }"""
 
-    def exists(self, *args, **kwargs):
+    async def exists(self, *args, **kwargs):
         return 2
 
-    def mget(self, *args, **kwargs):
+    async def mget(self, *args, **kwargs):
         return [
             b"""{
                 "status": "error", 
@@ -170,3 +193,204 @@ class LookupResultsHandlerRedisAnalyisErrorMock(object):
                 }
             }"""
         ]
+
+
+class GraphBatchMock(web.RequestHandler):
+    """Local mock of the graph $batch endpoint for device -> phone number lookups
+
+    Counts the requests it receives in `counts`.
+    Devices are owned by `owners` (device id -> phone number).
+    Request ids in `throttle` get a 429 response the first time they are seen.
+    """
+
+    def initialize(self, owners, counts, throttle=()):
+        self.owners = owners
+        self.counts = counts
+        self.throttle = set(throttle)
+
+    def respond(self, request):
+        url = urlparse(request["url"])
+        query = parse_qs(url.query)
+        if url.path == "/groups":
+            device_id = query["$filter"][0].split("'")[1]
+            if device_id not in self.owners:
+                return {"value": []}
+            return {"value": [{"id": f"group-{device_id}", "displayName": device_id}]}
+        if url.path.startswith("/groups/group-") and url.path.endswith("/members"):
+            device_id = url.path.split("/")[2][len("group-") :]
+            return {"value": [{"id": "user", "displayName": self.owners[device_id]}]}
+        raise web.HTTPError(400, f"Unexpected request {request}")
+
+    def post(self):
+        self.counts["batches"] += 1
+        requests = json.loads(self.request.body)["requests"]
+        assert len(requests) <= 20
+        responses = []
+        for request in requests:
+            self.counts["requests"] += 1
+            key = (request["url"], request["id"])
+            if key[0] in self.throttle and key not in self.counts["throttled"]:
+                self.counts["throttled"].add(key)
+                responses.append(
+                    {
+                        "id": request["id"],
+                        "status": 429,
+                        "headers": {"Retry-After": "0"},
+                    }
+                )
+                continue
+            responses.append(
+                {"id": request["id"], "status": 200, "body": self.respond(request)}
+            )
+        # responses may come in any order
+        self.write({"responses": responses[::-1]})
+
+
+class GraphPagingMock(web.RequestHandler):
+    """Local mock of a paged graph listing, e.g. /users
+
+    Serves `n_items` items in pages of `per_page`,
+    linked by @odata.nextLink, each page taking `latency` seconds.
+    """
+
+    def initialize(self, n_items, per_page, latency, counts):
+        self.n_items = n_items
+        self.per_page = per_page
+        self.latency = latency
+        self.counts = counts
+
+    async def get(self):
+        self.counts["pages"] += 1
+        start = int(self.get_argument("$skiptoken", "0"))
+        await asyncio.sleep(self.latency)
+        end = min(start + self.per_page, self.n_items)
+        page = {"value": [{"id": f"user{i}"} for i in range(start, end)]}
+        if end < self.n_items:
+            page["@odata.nextLink"] = url_concat(
+                self.request.full_url().split("?", 1)[0], {"$skiptoken": str(end)}
+            )
+        self.write(page)
+
+
+class GraphDirectoryMock(web.RequestHandler):
+    """Local mock of the graph requests made by store_device_id
+
+    Users and groups are kept in `directory`,
+    {"users": {id: user}, "groups": {id: group}},
+    where groups have a "members" list of user ids.
+
+    Requests are answered directly or within a $batch,
+    each HTTP request taking `latency` seconds.
+    Requests matching a "METHOD /path" in `fail_after` are carried out,
+    but answered with a 500 error the first time,
+    as if the response was lost.
+    """
+
+    def initialize(self, directory, counts, latency=0, fail_after=()):
+        self.directory = directory
+        self.counts = counts
+        self.latency = latency
+        self.fail_after = fail_after
+
+    def respond(self, method, url, body):
+        """Return the (status, body) of one request"""
+        url = urlparse(url)
+        query = parse_qs(url.query)
+        path = url.path.split("/")[1:]
+        groups = self.directory["groups"]
+        users = self.directory["users"]
+
+        if method == "PATCH" and path[0] == "users":
+            users[path[1]].update(body)
+            status, response = 204, None
+        elif method == "GET" and path == ["groups"]:
+            display_name = query["$filter"][0].split("'")[1]
+            response = {"value": []}
+            for group in groups.values():
+                if group["displayName"] == display_name:
+                    response["value"].append(
+                        {
+                            "id": group["id"],
+                            "displayName": group["displayName"],
+                            "members": [{"id": m} for m in group["members"]],
+                        }
+                    )
+            status = 200
+        elif method == "POST" and path == ["groups"]:
+            self.counts["created"] += 1
+            group_id = f"group{self.counts['created']}"
+            group = groups[group_id] = {
+                "id": group_id,
+                "displayName": body["displayName"],
+                "members": [
+                    ref.rsplit("/", 1)[1] for ref in body["members@odata.bind"]
+                ],
+            }
+            status = 201
+            response = {"id": group_id, "displayName": group["displayName"]}
+        elif (
+            method == "POST" and path[0] == "groups" and path[2:] == ["members", "$ref"]
+        ):
+            user_id = body["@odata.id"].rsplit("/", 1)[1]
+            members = groups[path[1]]["members"]
+            if user_id in members:
+                status = 400
+                response = {
+                    "error": {
+                        "message": "One or more added object references already exist"
+                    }
+                }
+            else:
+                members.append(user_id)
+                status, response = 204, None
+        elif method == "DELETE" and path[0] == "groups":
+            groups.pop(path[1])
+            status, response = 204, None
+        else:
+            raise web.HTTPError(400, f"Unexpected request {method} {url}")
+
+        key = f"{method} /{'/'.join(path)}"
+        if key in self.fail_after and key not in self.counts["failed"]:
+            self.counts["failed"].add(key)
+            return 500, {"error": {"message": "response lost"}}
+        return status, response
+
+    async def _handle(self, method, path):
+        await asyncio.sleep(self.latency)
+        self.counts["requests"] += 1
+        body = json.loads(self.request.body) if self.request.body else None
+        if path == "$batch":
+            self.counts["batches"] += 1
+            responses = []
+            for request in body["requests"]:
+                status, response = self.respond(
+                    request["method"], request["url"], request.get("body")
+                )
+                responses.append(
+                    {
+                        "id": request["id"],
+                        "status": status,
+                        "headers": {"Retry-After": "0"},
+                        "body": response,
+                    }
+                )
+            self.write({"responses": responses})
+            return
+        status, response = self.respond(
+            method, "/" + path + "?" + self.request.query, body
+        )
+        self.set_status(status)
+        if response is not None:
+            self.write(response)
+
+    async def get(self, path):
+        await self._handle("GET", path)
+
+    async def post(self, path):
+        await self._handle("POST", path)
+
+    async def patch(self, path):
+        await self._handle("PATCH", path)
+
+    async def delete(self, path):
+        await self._handle("DELETE", path)
@@ -0,0 +1,139 @@
+import asyncio
+import itertools
+from unittest import mock
+
+import pytest
+from prometheus_client import REGISTRY
+
+from corona_backend import device_pool, devices, sql
+
+
+class FakePool:
+    """In-memory stand-in for the DevicePool table and IoTHub"""
+
+    def __init__(self, fail_add=()):
+        self.pooled = []
+        self.iothub = set()
+        self.fail_add = set(fail_add)
+        self.claim_latency = 0
+        self._ids = itertools.count()
+
+    async def create_new_device(self):
+        await asyncio.sleep(0)
+        device_id = f"pooled{next(self._ids)}"
+        self.iothub.add(device_id)
+        return {
+            "deviceId": device_id,
+            "authentication": {"symmetricKey": {"primaryKey": f"key-{device_id}"}},
+        }
+
+    async def delete_devices(self, *device_ids, raise_on_error=True):
+        for device_id in device_ids:
+            self.iothub.discard(device_id)
+
+    async def add_pooled_device(self, device_id, primary_key):
+        await asyncio.sleep(0)
+        if device_id in self.fail_add:
+            raise RuntimeError(f"Failed to add {device_id}")
+        self.pooled.append((device_id, primary_key))
+
+    async def claim_pooled_device(self):
+        await asyncio.sleep(self.claim_latency)
+        if self.pooled:
+            return self.pooled.pop(0)
+
+    async def get_device_pool_size(self):
+        return len(self.pooled)
+
+
+@pytest.fixture
+def pool():
+    pool = FakePool()
+    with mock.patch.multiple(
+        sql,
+        add_pooled_device=pool.add_pooled_device,
+        claim_pooled_device=pool.claim_pooled_device,
+        get_device_pool_size=pool.get_device_pool_size,
+    ), mock.patch.multiple(
+        devices,
+        create_new_device=pool.create_new_device,
+        delete_devices=pool.delete_devices,
+    ), mock.patch.object(
+        device_pool, "POOL_SIZE", 5
+    ):
+        yield pool
+
+
+def claims(result):
+    return (
+        REGISTRY.get_sample_value("device_pool_claims_total", {"result": result}) or 0
+    )
+
+
+async def test_claim_device_disabled(pool):
+    await device_pool.refill()
+    with mock.patch.object(device_pool, "POOL_SIZE", 0):
+        assert await device_pool.claim_device() is None
+    assert len(pool.pooled) == 5
+
+
+async def test_claim_device(pool):
+    await device_pool.refill()
+    before = {result: claims(result) for result in ("claimed", "empty")}
+
+    claimed = await asyncio.gather(*(device_pool.claim_device() for i in range(7)))
+    device_ids = [c[0] for c in claimed if c is not None]
+    # every pooled device is claimed exactly once
+    assert sorted(device_ids) == sorted(pool.iothub)
+    assert len(set(device_ids)) == 5
+    assert claimed.count(None) == 2
+    for device_id, primary_key in filter(None, claimed):
+        assert primary_key == f"key-{device_id}"
+
+    assert claims("claimed") - before["claimed"] == 5
+    assert claims("empty") - before["empty"] == 2
+
+
+async def test_claim_device_error(pool):
+    async def claim_pooled_device():
+        raise RuntimeError("database unavailable")
+
+    before = claims("error")
+    with mock.patch.object(sql, "claim_pooled_device", claim_pooled_device):
+        assert await device_pool.claim_device() is None
+    assert claims("error") - before == 1
+
+
+async def test_claim_device_timeout(pool):
+    await device_pool.refill()
+    pool.claim_latency = 0.05
+    before = claims("error")
+    with mock.patch.object(device_pool, "CLAIM_TIMEOUT", 0.01):
+        assert await device_pool.claim_device() is None
+    assert claims("error") - before == 1
+    await asyncio.sleep(0.1)
+    # the device claimed after giving up is back in the pool
+    assert len(pool.pooled) == 5
+    assert sorted(pool.iothub) == sorted(device_id for device_id, _ in pool.pooled)
+
+
+async def test_refill(pool):
+    assert await device_pool.refill(batch=3) == 3
+    assert len(pool.pooled) == 3
+    # tops up to the pool size
+    assert await device_pool.refill(batch=3) == 2
+    assert await device_pool.refill(batch=3) == 0
+    assert len(pool.pooled) == 5
+
+    await device_pool.claim_device()
+    assert await device_pool.refill(batch=3) == 1
+    assert len(pool.pooled) == 5
+    assert REGISTRY.get_sample_value("device_pool_size") == 5
+
+
+async def test_refill_failure(pool):
+    pool.fail_add = {"pooled1"}
+    assert await device_pool.refill(batch=3) == 2
+    # the device that couldn't be pooled is deleted from IoTHub
+    assert sorted(pool.iothub) == ["pooled0", "pooled2"]
+    assert [device_id for device_id, key in pool.pooled] == ["pooled0", "pooled2"]
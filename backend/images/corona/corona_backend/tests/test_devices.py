@@ -1,6 +1,9 @@
 import asyncio
+import json
 import uuid
+from types import SimpleNamespace
 from typing import Any, Dict
+from unittest import mock
 
 import pytest
 from tornado.httpclient import HTTPError
@@ -92,6 +95,35 @@ async def test_create_and_delete_device():
     assert e.value.code == 404
 
 
+async def test_get_devices_prefetch():
+    n = 25
+    requests = []
+
+    async def iothub_request(path, *, headers=None, body=None, method="GET", raw=False):
+        # local paging mock of the IoTHub device query
+        requests.append(dict(headers))
+        per_page = int(headers.get("x-ms-max-item-count", 10))
+        start = int(headers.get("x-ms-continuation", 0))
+        end = min(start + per_page, n)
+        await asyncio.sleep(0.001)
+        resp_headers = {}
+        if end < n:
+            resp_headers["x-ms-continuation"] = str(end)
+        devices_json = json.dumps([{"deviceId": f"dev{i}"} for i in range(start, end)])
+        return SimpleNamespace(body=devices_json.encode("utf8"), headers=resp_headers)
+
+    with mock.patch.object(devices, "iothub_request", iothub_request):
+        found_devices = await get_devices(readahead=2)
+        assert [d["deviceId"] for d in found_devices] == [f"dev{i}" for i in range(n)]
+        assert [r.get("x-ms-continuation") for r in requests] == [None, "10", "20"]
+
+        requests[:] = []
+        found_devices = await get_devices(per_page=5, limit=5)
+        assert len(found_devices) == 5
+        # the first page is enough, nothing is fetched ahead
+        assert len(requests) == 1
+
+
 async def get_devices(*device_ids, **kwargs):
     """Helper function for get devies that returns
     a list in stead of a generator.
@@ -110,3 +142,115 @@ async def test_iothub_request_get(device):
     )
     for k in DEVICE_KEYS:
         assert device[k] == retrieved_device[k]
+
+
+async def test_device_key_cache():
+    loads = []
+
+    async def load(device_id):
+        loads.append(device_id)
+        await asyncio.sleep(0.01)
+        if device_id == "unknown":
+            return None
+        return {"primaryKey": device_id}
+
+    cache = devices.DeviceKeyCache(load, maxsize=2, ttl=60, negative_ttl=60)
+
+    # concurrent lookups share one load
+    results = await asyncio.gather(*(cache.get("a") for i in range(5)))
+    assert results == [{"primaryKey": "a"}] * 5
+    assert loads == ["a"]
+    assert await cache.get("a") == {"primaryKey": "a"}
+    assert loads == ["a"]
+
+    # unknown devices are cached, too
+    assert await cache.get("unknown") is None
+    assert await cache.get("unknown") is None
+    assert loads == ["a", "unknown"]
+
+    # least recently used entries are evicted
+    await cache.get("a")
+    await cache.get("b")
+    assert len(cache) == 2
+    await cache.get("unknown")
+    assert loads == ["a", "unknown", "b", "unknown"]
+
+    # invalidated entries are loaded again
+    cache.invalidate("b")
+    await cache.get("b")
+    assert loads == ["a", "unknown", "b", "unknown", "b"]
+
+    # invalidation during a load discards its result
+    lookup = asyncio.ensure_future(cache.get("c"))
+    await asyncio.sleep(0)
+    cache.invalidate("c")
+    assert await lookup == {"primaryKey": "c"}
+    await cache.get("c")
+    assert loads[-2:] == ["c", "c"]
+
+
+async def test_device_key_cache_expiry():
+    loads = []
+
+    async def load(device_id):
+        loads.append(device_id)
+        if device_id == "unknown":
+            return None
+        return {"primaryKey": device_id}
+
+    now = 1000
+    cache = devices.DeviceKeyCache(
+        load, maxsize=10, ttl=60, negative_ttl=10, clock=lambda: now
+    )
+    await cache.get("a")
+    await cache.get("unknown")
+    now += 30
+    await cache.get("a")
+    await cache.get("unknown")
+    assert loads == ["a", "unknown", "unknown"]
+    now += 31
+    await cache.get("a")
+    assert loads == ["a", "unknown", "unknown", "a"]
+
+
+async def test_device_key_cache_errors():
+    calls = []
+
+    async def load(device_id):
+        calls.append(device_id)
+        raise HTTPError(500)
+
+    cache = devices.DeviceKeyCache(load, maxsize=10, ttl=60, negative_ttl=60)
+    for i in range(2):
+        with pytest.raises(HTTPError):
+            await cache.get("a")
+    # errors are not cached
+    assert calls == ["a", "a"]
+    assert len(cache) == 0
+
+
+async def test_delete_device_invalidates_key_cache():
+    existing = {"device1"}
+
+    async def get_device(device_id):
+        found = device_id in existing
+        await asyncio.sleep(0.02)
+        if not found:
+            raise HTTPError(404)
+        return {"authentication": {"symmetricKey": {"primaryKey": device_id}}}
+
+    async def iothub_request(path, method="GET", **kwargs):
+        assert method == "DELETE"
+        await asyncio.sleep(0.01)
+        existing.discard(path.rsplit("/", 1)[-1])
+
+    with mock.patch.multiple(
+        devices, get_device=get_device, iothub_request=iothub_request
+    ):
+        # a lookup started during the deletion finishes after it,
+        # and must not cache the deleted device's keys
+        deleted = asyncio.ensure_future(devices.delete_device("device1"))
+        await asyncio.sleep(0)
+        assert await devices.lookup_device_keys("device1") == {"primaryKey": "device1"}
+        await deleted
+        assert await devices.lookup_device_keys("device1") is None
@@ -1,3 +1,4 @@
+import asyncio
 import json
 from datetime import timedelta
 from unittest.mock import call, patch
@@ -9,6 +10,8 @@ from corona_backend import pin, sql, testsql, utils
 from corona_backend.fhi.handlers.base import API_KEY
 from corona_backend.fhi.handlers.endpoints import endpoints
 
+from . import mocks
+
 CONSECUTIVE_FAILURE_LIMIT = 2
 
 
@@ -325,7 +328,7 @@ async def test_lookup_result_happy(
     trucate_tables_after_test,
     redis_lookup_result_mock,
     request_id_mock,
-    user_for_device_mock,
+    phone_numbers_for_device_ids_mock,
     get_device_mock,
     generate_pin_mock,
     pin_enabled,
@@ -372,7 +375,9 @@ async def test_lookup_result_happy(
     assert resp.code == 200
     assert json.loads(resp.body) == expected_resp_body
 
-    user_for_device_mock.assert_has_calls([call("result_key_1"), call("result_key_2")])
+    phone_numbers_for_device_ids_mock.assert_called_once_with(
+        ["result_key_1", "result_key_2", "result_key_3"]
+    )
     get_device_mock.assert_has_calls([call("device_id_1"), call("device_id_2")])
 
     if pin_enabled:
@@ -419,6 +424,116 @@ async def test_lookup_result_handler_analysis_in_progress(
     }
 
 
+async def test_lookup_result_handler_loop_lag(http_client, base_url):
+    """Slow redis responses must not block the event loop"""
+
+    class SlowRedisMock(mocks.LookupResultsHandlerRedisAnalyisInProgressMock):
+        async def get(self, *args, **kwargs):
+            await asyncio.sleep(0.2)
+            return await super().get(*args, **kwargs)
+
+        async def exists(self, *args, **kwargs):
+            await asyncio.sleep(0.2)
+            return await super().exists(*args, **kwargs)
+
+    loop = asyncio.get_event_loop()
+    lags = []
+    done = False
+
+    async def measure_lag(interval=0.01):
+        while not done:
+            tic = loop.time()
+            await asyncio.sleep(interval)
+            lags.append(loop.time() - tic - interval)
+
+    with patch("corona_backend.fhi.handlers.fhi.get_redis", new=SlowRedisMock):
+        lag_task = asyncio.ensure_future(measure_lag())
+        resp = await http_client.fetch(f"{base_url}/lookup/1234", **fhi_get_req)
+        done = True
+        await lag_task
+
+    assert resp.code == 202
+    assert len(lags) > 10
+    assert max(lags) < 0.1
+
+
+async def test_lookup_result_handler_long_poll(http_client, base_url):
+    """Result requests with wait are woken up by completed jobs"""
+
+    class PubSubMock:
+        def __init__(self, messages):
+            self.messages = messages
+
+        async def psubscribe(self, pattern):
+            self.pattern = pattern
+
+        async def listen(self):
+            yield {"type": "psubscribe", "pattern": self.pattern}
+            while True:
+                yield await self.messages.get()
+
+        async def close(self):
+            pass
+
+    class LongPollRedisMock(mocks.LookupResultsHandlerRedisAnalyisErrorMock):
+        def __init__(self):
+            self.done = set()
+            self.messages = asyncio.Queue()
+            self.scard_calls = 0
+
+        async def get(self, *args, **kwargs):
+            info = json.loads(await super().get(*args, **kwargs))
+            info["done_key"] = "lookup:1234:done"
+            return json.dumps(info).encode("utf8")
+
+        async def exists(self, *args, **kwargs):
+            raise AssertionError("readiness should not check each result")
+
+        async def scard(self, key):
+            assert key == "lookup:1234:done"
+            self.scard_calls += 1
+            return len(self.done)
+
+        def pubsub(self):
+            return PubSubMock(self.messages)
+
+        def complete(self, device_id):
+            self.done.add(f"1234:{device_id}")
+            self.messages.put_nowait(
+                {"type": "pmessage", "channel": b"lookup:1234:done"}
+            )
+
+    redis_mock = LongPollRedisMock()
+    loop = asyncio.get_event_loop()
+
+    with patch("corona_backend.fhi.handlers.fhi.get_redis", new=lambda: redis_mock):
+        # one of two jobs completes while waiting
+        loop.call_later(0.1, redis_mock.complete, "device_id_1")
+        tic = loop.time()
+        resp = await http_client.fetch(
+            f"{base_url}/lookup/1234?wait=0.5", **fhi_get_req
+        )
+        assert loop.time() - tic >= 0.5
+        assert resp.code == 202
+        assert json.loads(resp.body) == {
+            "message": "Not finished processing (completed 1/2 tasks)"
+        }
+        # no polling while waiting
+        assert redis_mock.scard_calls <= 4
+
+        # the last job completes, the request returns without waiting it out
+        loop.call_later(0.1, redis_mock.complete, "device_id_2")
+        tic = loop.time()
+        with pytest.raises(tornado.httpclient.HTTPClientError) as e:
+            await http_client.fetch(f"{base_url}/lookup/1234?wait=10", **fhi_get_req)
+        assert loop.time() - tic < 5
+        assert e.value.code == 500
+
+        with pytest.raises(tornado.httpclient.HTTPClientError) as e:
+            await http_client.fetch(f"{base_url}/lookup/1234?wait=soon", **fhi_get_req)
+        assert e.value.code == 400
+
+
 async def test_lookup_result_handler_analysis_error(
     http_client, base_url, redis_lookup_result_analysis_error_mock,
 ):
@@ -541,6 +656,54 @@ async def test_fhi_egress_handler(
     )
 
 
+async def test_fhi_egress_handler_stream(
+    http_client,
+    base_url,
+    db_user_serviceapi,
+    trucate_tables_after_test,
+    now_at_utc_mock,
+    find_user_mock,
+    device_ids_mock,
+):
+    trucate_tables_after_test(
+        ["dbo.applog", "dbo.uuid_id", "dbo.dluserdatastaging", "dbo.gpsevents"]
+    )
+
+    await insert_test_gps_event()
+
+    body = {
+        "phone_number": "+0012341234",
+        "person_name": "Foo Name",
+        "legal_means": "foo",
+        "stream": True,
+    }
+    fhi_post_req["body"] = json.dumps(body)
+    resp = await http_client.fetch(f"{base_url}/fhi-egress", **fhi_post_req)
+    assert resp.code == 200
+    assert resp.headers["Content-Type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in resp.body.decode("utf8").splitlines()]
+    assert lines[0] == {"phone_number": "+0012341234", "found_in_system": True}
+    assert [line["time_from"] for line in lines[1:3]] == [
+        "2018-03-12T10:12:55Z",
+        "2018-03-12T10:12:45Z",
+    ]
+    assert list(lines[3]) == ["cursor"]
+    assert lines[4] == {"done": True, "count": 2}
+
+    # resume after the last chunk
+    body["cursor"] = lines[3]["cursor"]
+    fhi_post_req["body"] = json.dumps(body)
+    resp = await http_client.fetch(f"{base_url}/fhi-egress", **fhi_post_req)
+    lines = [json.loads(line) for line in resp.body.decode("utf8").splitlines()]
+    assert lines[1:] == [{"done": True, "count": 0}]
+
+    body["cursor"] = "invalid"
+    fhi_post_req["body"] = json.dumps(body)
+    with pytest.raises(tornado.httpclient.HTTPClientError) as e:
+        await http_client.fetch(f"{base_url}/fhi-egress", **fhi_post_req)
+    assert e.value.code == 400
+
+
 async def test_deletion(
     http_client, base_url, now_at_utc_mock, db_user_serviceapi, deleted_nums_mock,
 ):
@@ -1,12 +1,15 @@
 import asyncio
 import datetime
+import json
 import os
+import time
 import uuid
 from collections import namedtuple
 from unittest import mock
 from unittest.mock import MagicMock
 
 import pytest
+import tornado.web
 from dateutil.parser import parse as parse_date
 from testfixtures import LogCapture
 
@@ -14,6 +17,9 @@ from corona_backend import graph
 from corona_backend import test as test_utils
 from corona_backend import utils
 
+from . import mocks
+from .conftest import make_async
+
 DeviceUser = namedtuple("DeviceUser", ["group", "user"])
 
 
@@ -473,6 +479,399 @@ async def test_get_user_token():
     capture.uninstall()
 
 
+@pytest.fixture
+def rsa_key():
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    private_key = rsa.generate_private_key(
+        public_exponent=65537, key_size=2048, backend=default_backend()
+    )
+    graph._verified_tokens.clear()
+    with mock.patch.dict(graph._PUBLIC_KEYS, {"test": private_key.public_key()}):
+        yield private_key
+    graph._verified_tokens.clear()
+
+
+def make_token(private_key, ttl=3600, kid="test"):
+    import jwt
+
+    payload = {
+        "aud": graph.audience,
+        "exp": int(time.time()) + ttl,
+        "scp": "Device.Write",
+        "signInNames.phoneNumber": "+00001234",
+    }
+    return jwt.encode(
+        payload, key=private_key, algorithm="RS256", headers={"kid": kid}
+    ).decode("utf8")
+
+
+def test_verify_token_cache(rsa_key):
+    import jwt
+
+    token = make_token(rsa_key)
+    decode = MagicMock(side_effect=jwt.decode)
+    with mock.patch.object(jwt, "decode", decode):
+        payload = graph.verify_token(token)
+        assert payload["signInNames.phoneNumber"] == "+00001234"
+        assert decode.call_count == 1
+        # cached, and callers get their own copy
+        payload["_phonenumber"] = "+00001234"
+        cached = graph.verify_token(token)
+        assert "_phonenumber" not in cached
+        assert cached == {k: v for k, v in payload.items() if k != "_phonenumber"}
+        assert decode.call_count == 1
+
+        # key rotated
+        graph._PUBLIC_KEYS["test"] = rsa_key.public_key()
+        graph.verify_token(token)
+        assert decode.call_count == 2
+        graph._PUBLIC_KEYS.pop("test")
+        with pytest.raises(KeyError):
+            graph.verify_token(token)
+
+        # expired
+        graph._PUBLIC_KEYS["test"] = rsa_key.public_key()
+        graph.verify_token(token)
+        assert decode.call_count == 3
+        later = time.time() + 7200
+        with mock.patch.object(graph.time, "time", lambda: later):
+            graph.verify_token(token)
+        assert decode.call_count == 4
+
+    # invalid tokens are not cached
+    with pytest.raises(jwt.InvalidTokenError):
+        graph.verify_token(token[:-4] + "AAAA")
+    with pytest.raises(jwt.ExpiredSignatureError):
+        graph.verify_token(make_token(rsa_key, ttl=-60))
+    assert len(graph._verified_tokens) == 1
+
+
+def test_verify_token_repeated(rsa_key):
+    """Repeated requests with the same tokens only decode each token once"""
+    import jwt
+
+    # distinct tokens
+    tokens = [make_token(rsa_key, ttl=3600 + i) for i in range(5)]
+    decode = MagicMock(side_effect=jwt.decode)
+    with mock.patch.object(jwt, "decode", decode):
+        for i in range(200):
+            graph.verify_token(tokens[i % len(tokens)])
+    assert decode.call_count == len(tokens)
+
+
+@pytest.fixture
+def graph_counts():
+    return {
+        "batches": 0,
+        "requests": 0,
+        "throttled": set(),
+        "pages": 0,
+        "failed": set(),
+        "created": 0,
+    }
+
+
+@pytest.fixture
+def graph_directory():
+    """Users and groups of the local directory mock"""
+    return {
+        "users": {
+            f"user{i}": {"id": f"user{i}", "displayName": f"+00{i:06}"}
+            for i in range(50)
+        },
+        "groups": {},
+    }
+
+
+@pytest.fixture
+def graph_fail_after():
+    """Directory requests to fail once, after carrying them out"""
+    return set()
+
+
+GRAPH_OWNERS = {f"device{i}": f"+00{i:06}" for i in range(45)}
+
+
+@pytest.fixture
+def app(graph_counts, graph_directory, graph_fail_after):
+    return tornado.web.Application(
+        [
+            (
+                r"/\$batch",
+                mocks.GraphBatchMock,
+                dict(
+                    owners=GRAPH_OWNERS,
+                    counts=graph_counts,
+                    throttle={
+                        "/groups/group-device3/members?%24select=id%2CdisplayName%2C"
+                        + graph.extension_attr_name("consentRevoked")
+                    },
+                ),
+            ),
+            (
+                r"/users",
+                mocks.GraphPagingMock,
+                dict(n_items=2000, per_page=100, latency=0.02, counts=graph_counts),
+            ),
+            (
+                r"/directory/(.*)",
+                mocks.GraphDirectoryMock,
+                dict(
+                    directory=graph_directory,
+                    counts=graph_counts,
+                    latency=0.01,
+                    fail_after=graph_fail_after,
+                ),
+            ),
+        ]
+    )
+
+
+@pytest.fixture
+def mock_graph(base_url):
+    with mock.patch.object(graph, "graph_url", base_url), mock.patch.object(
+        graph, "request_graph_token", make_async(lambda *args, **kwargs: "token")
+    ), mock.patch.dict(graph._no_phone_number_cache, clear=True):
+        yield
+
+
+async def test_phone_numbers_for_device_ids(mock_graph, graph_counts):
+    device_ids = list(GRAPH_OWNERS) + ["unknown"]
+    phone_numbers = await graph.phone_numbers_for_device_ids(device_ids)
+    assert phone_numbers == dict(GRAPH_OWNERS, unknown=None)
+    # 46 group lookups and 45 owner lookups in batches of 20,
+    # plus one retry of a throttled lookup
+    assert graph_counts["batches"] == 3 + 3 + 1
+    assert graph_counts["requests"] == 46 + 45 + 1
+    assert len(graph_counts["throttled"]) == 1
+
+    # phone numbers are looked up again, in case the owner changed
+    with mock.patch.dict(GRAPH_OWNERS, device1="+00999999"):
+        phone_numbers = await graph.phone_numbers_for_device_ids(["device1", "device2"])
+    assert phone_numbers == {"device1": "+00999999", "device2": "+00000002"}
+    assert graph_counts["batches"] == 9
+
+    # devices without a phone number are cached
+    phone_numbers = await graph.phone_numbers_for_device_ids(["unknown"])
+    assert phone_numbers == {"unknown": None}
+    assert graph_counts["batches"] == 9
+
+    # expired
+    with mock.patch.object(graph, "PHONE_NUMBER_CACHE_TTL", 0):
+        graph._no_phone_number_cache.clear()
+        await graph.phone_numbers_for_device_ids(["unknown"])
+        await graph.phone_numbers_for_device_ids(["unknown"])
+    assert graph_counts["batches"] == 11
+
+    # least recently used devices are evicted
+    with mock.patch.object(graph, "PHONE_NUMBER_CACHE_SIZE", 2):
+        await graph.phone_numbers_for_device_ids(["unknown1", "unknown2"])
+        await graph.phone_numbers_for_device_ids(["unknown1"])
+        await graph.phone_numbers_for_device_ids(["unknown3"])
+    assert list(graph._no_phone_number_cache) == ["unknown1", "unknown3"]
+
+
+async def test_paged_graph_request_prefetch(mock_graph, graph_counts):
+    """Full scans of paged listings, with and without prefetching pages"""
+
+    async def scan(readahead):
+        ids = []
+        # pages requested ahead of the pages consumed, after each page
+        ahead = []
+        pages_before = graph_counts["pages"]
+        async for user in graph.paged_graph_request(
+            "/users", params={"$select": "id"}, readahead=readahead
+        ):
+            ids.append(user["id"])
+            if len(ids) % 100 == 0:
+                # processing time per page, longer than fetching a page
+                await asyncio.sleep(0.05)
+                consumed = len(ids) // 100
+                ahead.append(graph_counts["pages"] - pages_before - consumed)
+        assert ids == [f"user{i}" for i in range(2000)]
+        assert graph_counts["pages"] - pages_before == 20
+        return ahead
+
+    # the next page is only requested when needed
+    assert set(await scan(readahead=0)) == {0}
+    # pages are requested while processing, up to readahead (+1 being fetched)
+    ahead = await scan(readahead=2)
+    assert max(ahead) >= 2
+    assert max(ahead) <= 2 + 1
+
+
+@pytest.fixture
+def mock_graph_directory(base_url):
+    with mock.patch.object(
+        graph, "graph_url", f"{base_url}/directory"
+    ), mock.patch.object(
+        graph, "request_graph_token", make_async(lambda *args, **kwargs: "token")
+    ), mock.patch.object(
+        graph, "STORE_DEVICE_ID_RETRY_WAIT", 0
+    ):
+        yield
+
+
+def group_members(graph_directory, device_id):
+    return [
+        group["members"]
+        for group in graph_directory["groups"].values()
+        if group["displayName"] == device_id
+    ]
+
+
+async def test_store_device_id_requests(
+    mock_graph_directory, graph_directory, graph_counts
+):
+    device_id_attr = graph.extension_attr_name("deviceId")
+    users = graph_directory["users"]
+
+    group = await graph.store_device_id(dict(users["user1"]), "device1")
+    assert group["displayName"] == "device1"
+    assert users["user1"][device_id_attr] == "device1"
+    assert group_members(graph_directory, "device1") == [["user1"]]
+    # storing the device id and looking up the group are batched,
+    # creating the group waits for the lookup
+    assert graph_counts["requests"] == 2
+    assert graph_counts["batches"] == 1
+
+    # already a member
+    assert await graph.store_device_id(dict(users["user1"]), "device1") is None
+    assert graph_counts["requests"] == 3
+
+    # new owner of the device
+    assert await graph.store_device_id(dict(users["user2"]), "device1") is None
+    assert group_members(graph_directory, "device1") == [["user1", "user2"]]
+    assert users["user2"][device_id_attr] == "device1"
+    assert graph_counts["requests"] == 5
+
+
+@pytest.mark.parametrize(
+    "fail_after",
+    [
+        "PATCH /users/user1",
+        "GET /groups",
+        "POST /groups",
+        "POST /groups/group1/members/$ref",
+    ],
+)
+async def test_store_device_id_retries(
+    mock_graph_directory, graph_directory, graph_counts, graph_fail_after, fail_after
+):
+    if "group1" in fail_after:
+        # existing device group, the user is a new owner
+        await graph.store_device_id(dict(graph_directory["users"]["user2"]), "device1")
+    graph_fail_after.add(fail_after)
+
+    await graph.store_device_id(dict(graph_directory["users"]["user1"]), "device1")
+    assert graph_counts["failed"] == {fail_after}
+    # retried requests aren't repeated, and the group is created once
+    assert graph_counts["created"] == 1
+    members = group_members(graph_directory, "device1")
+    assert len(members) == 1
+    assert "user1" in members[0]
+    assert (
+        graph_directory["users"]["user1"][graph.extension_attr_name("deviceId")]
+        == "device1"
+    )
+
+
+async def test_store_device_id_duplicate_groups(
+    mock_graph_directory, graph_directory, graph_counts
+):
+    groups = graph_directory["groups"]
+    # created twice by an earlier attempt
+    for group_id in ("dup1", "dup2"):
+        groups[group_id] = {"id": group_id, "displayName": "device1", "members": []}
+    groups["dup2"]["members"].append("user1")
+
+    assert (
+        await graph.store_device_id(dict(graph_directory["users"]["user1"]), "device1")
+        is None
+    )
+    assert list(groups) == ["dup2"]
+
+    # other owners
+    groups["dup3"] = {"id": "dup3", "displayName": "device1", "members": ["user2"]}
+    with pytest.raises(ValueError):
+        await graph.store_device_id(dict(graph_directory["users"]["user1"]), "device1")
+
+
+async def test_store_device_id_undo(
+    mock_graph_directory, graph_directory, graph_counts, graph_fail_after
+):
+    device_id_attr = graph.extension_attr_name("deviceId")
+    user = graph_directory["users"]["user1"]
+    user[device_id_attr] = "device0"
+    graph_fail_after.add("POST /groups")
+
+    with mock.patch.object(graph, "STORE_DEVICE_ID_RETRIES", 0):
+        with pytest.raises(tornado.httpclient.HTTPClientError):
+            await graph.store_device_id(dict(user), "device1")
+
+    # the user isn't left half-registered
+    assert graph_counts["created"] == 1
+    assert group_members(graph_directory, "device1") == []
+    assert user[device_id_attr] == "device0"
+
+
+async def store_device_id_sequential(user, device_id):
+    """The requests of store_device_id for a new device, one after another"""
+    await graph.graph_request(
+        f"/users/{user['id']}",
+        method="PATCH",
+        body=json.dumps({graph.extension_attr_name("deviceId"): device_id}),
+        headers={"Content-Type": "application/json"},
+    )
+    groups = await graph.graph_request(
+        "/groups",
+        params={
+            "$select": "id,displayName",
+            "$filter": f"displayName eq '{device_id}'",
+        },
+    )
+    assert groups == []
+    return await graph.graph_request(
+        "/groups",
+        method="POST",
+        body=json.dumps(
+            {
+                "displayName": device_id,
+                "members@odata.bind": [
+                    f"https://graph.microsoft.com/v1.0/users/{user['id']}"
+                ],
+            }
+        ),
+        headers={"Content-Type": "application/json"},
+    )
+
+
+async def test_store_device_id_concurrent(
+    mock_graph_directory, graph_directory, graph_counts
+):
+    """Round trips of concurrent registrations, one after another or batched"""
+    users = list(graph_directory["users"].values())
+
+    async def register(store, prefix):
+        await asyncio.gather(
+            *(store(dict(user), f"{prefix}-{user['id']}") for user in users)
+        )
+
+    await register(store_device_id_sequential, "sequential")
+    assert graph_counts["requests"] == 3 * len(users)
+    assert graph_counts["created"] == len(users)
+
+    # the first two requests share a batch
+    await register(graph.store_device_id, "batched")
+    assert graph_counts["requests"] == 3 * len(users) + 2 * len(users)
+    assert graph_counts["batches"] == len(users)
+    assert graph_counts["created"] == 2 * len(users)
+    for user in users:
+        assert group_members(graph_directory, f"batched-{user['id']}") == [[user["id"]]]
+
+
 async def main():
     phone_number = "+00000000"
     res = await graph.find_user_by_phone(phone_number, select="id")
@@ -13,14 +13,14 @@ from tornado.httpclient import HTTPRequest
 
 import corona_backend.handlers
 import corona_backend.onboarding.app
-from corona_backend import devices, graph
+from corona_backend import device_pool, devices, graph
 from corona_backend import middleware as mw
 from corona_backend import sql
 from corona_backend import test as test_utils
 from corona_backend import testsql, utils
 from corona_backend.handlers import common_endpoints
 
-from .conftest import TEST_DEVICE_ID, TEST_DEVICE_KEY
+from .conftest import TEST_DEVICE_ID, TEST_DEVICE_KEY, make_async
 
 TEST_PHONE_NUMBER = f"+00{random.randint(1,9999):06}"
 TEST_PHONE_NUMBER = "+00001234"
@@ -320,6 +320,61 @@ async def test_register_device_create_new_device_reach_consecutive_failure_limit
     capture.uninstall()
 
 
+@pytest.mark.parametrize("pooled", [True, False])
+async def test_register_device_pool(http_client, base_url, pooled):
+    user = {"id": "user1", "displayName": TEST_PHONE_NUMBER}
+    stored = []
+
+    async def store_device_id(user, device_id):
+        stored.append((user["id"], device_id))
+
+    if pooled:
+        claimed = ("pooled-device", "pooled-key")
+    else:
+        # pool empty, unavailable or too slow
+        claimed = None
+    created = []
+
+    async def create_new_device():
+        created.append("new-device")
+        return {
+            "deviceId": "new-device",
+            "authentication": {"symmetricKey": {"primaryKey": "new-key"}},
+        }
+
+    with mock.patch.object(
+        corona_backend.onboarding.app.RegisterDeviceHandler, "get_current_user"
+    ) as m_auth, mock.patch.object(
+        corona_backend.handlers, "find_user", make_async(lambda phone_number: user)
+    ), mock.patch.object(
+        graph, "store_device_id", store_device_id
+    ), mock.patch.object(
+        device_pool, "claim_device", make_async(lambda: claimed)
+    ), mock.patch.object(
+        devices, "create_new_device", create_new_device
+    ):
+        m_auth.return_value = get_test_payload()
+        response = await http_client.fetch(
+            f"{base_url}/register-device",
+            method="POST",
+            body=b"",
+            headers={"Authorization": f"Bearer {TEST_TOKEN}"},
+        )
+
+    body = json.loads(response.body)
+    if pooled:
+        device_id, device_key = claimed
+        # no device is created while the pool has one
+        assert created == []
+    else:
+        device_id, device_key = "new-device", "new-key"
+        assert created == ["new-device"]
+    assert body["DeviceId"] == device_id
+    assert body["SharedAccessKey"] == device_key
+    assert f"DeviceId={device_id}" in body["ConnectionString"]
+    assert stored == [("user1", device_id)]
+
+
 async def clean_test_user(phone_number=TEST_PHONE_NUMBER):
     try:
         user = await graph.find_user_by_phone(phone_number)
@@ -4,15 +4,16 @@ import json
 import os
 import time
 from datetime import datetime
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
+import pyodbc
 import pytest
 import tornado
 from testfixtures import LogCapture
 
 import corona_backend.onboarding.app
 from corona_backend import middleware as mw
-from corona_backend import pin, testsql
+from corona_backend import pin, sql, testsql
 
 from . import conftest
 from .conftest import TEST_DEVICE_ID, TEST_DEVICE_KEY, make_async
@@ -63,6 +64,38 @@ async def test_fetch_or_generate_pin_outside_threshold(
         )
 
 
+async def test_fetch_or_generate_pins(generate_pin_mock):
+    with testsql.set_db_user(testsql.DB_USER_SERVICE_API):
+        pin_codes = await pin.fetch_or_generate_pins(
+            ["+0013371337", "+0013371338", "+0013371337"]
+        )
+        assert pin_codes == {"+0013371337": "test_pin_1", "+0013371338": "pin_code_1"}
+        stored = await pin.get_pin_codes(phone_number="+0013371338")
+        assert [p["pin_code"] for p in stored] == ["pin_code_1"]
+
+
+async def test_fetch_or_generate_pins_partial_failure(generate_pin_mock):
+    error = pyodbc.IntegrityError("duplicate")
+
+    def execute(query, row):
+        if row[0] == "+0012341235":
+            raise error
+        return MagicMock()
+
+    db = MagicMock()
+    db.cursor.return_value.executemany.side_effect = pyodbc.IntegrityError("bulk")
+    db.execute.side_effect = execute
+    with patch(
+        "corona_backend.pin.get_latest_pin_codes_after_threshold",
+        new=make_async(lambda phone_numbers, threshold: {}),
+    ), patch.object(sql, "connect_to_database", make_async(lambda **kw: db)):
+        pin_codes = await pin.fetch_or_generate_pins(
+            ["+0012341234", "+0012341235"], raise_on_error=False
+        )
+    assert pin_codes == {"+0012341234": "pin_code_1", "+0012341235": error}
+    db.cursor.return_value.rollback.assert_called_once()
+
+
 def pin_request(digest, device_id, timestamp_str):
     return dict(
         method="GET",
@@ -1,9 +1,19 @@
+import asyncio
+import datetime
+import itertools
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from unittest import mock
 
+import pyodbc
 import pytest
+from prometheus_client import REGISTRY
 
-from corona_backend import sql
+from corona_backend import sql, utils
+
+from .conftest import make_async
 
 
 async def test_connect_to_database():
@@ -35,3 +45,320 @@ async def test_connect_to_database_retries():
         with pytest.raises(TestException):
             await sql.connect_to_database()
         assert mock_connect.call_count == sql.CONNECT_RETRIES
+
+
+log_access_kwargs = dict(
+    person_name="For Etternavn",
+    person_id="",
+    person_organization="Some Organization",
+    organization="Norsk Helsenett",
+    legal_means="Some legal means",
+)
+
+
+async def test_log_access_bulk(
+    db_user_serviceapi, setup_testdb, trucate_tables_after_test
+):
+    trucate_tables_after_test(["dbo.applog"])
+    phone_numbers = ["+0012341234", "+0012341235", "+0012341236"]
+    await sql.log_access(
+        timestamp=utils.now_at_utc(), phone_numbers=phone_numbers, **log_access_kwargs
+    )
+    for phone_number in phone_numbers:
+        events, count = await sql.get_access_log(phone_number=phone_number)
+        assert count == 1
+        event = events[0]
+        assert event["phone_number"] == phone_number
+        assert event["person_name"] == log_access_kwargs["person_name"]
+
+
+async def test_log_access_bulk_fallback():
+    db = mock.MagicMock()
+    db.cursor.return_value.executemany.side_effect = pyodbc.ProgrammingError("bulk")
+    timestamp = utils.now_at_utc()
+    with mock.patch.object(sql, "connect_to_database", make_async(lambda **kw: db)):
+        await sql.log_access(
+            timestamp=timestamp, phone_numbers=["+001", "+002"], **log_access_kwargs
+        )
+    db.cursor.return_value.rollback.assert_called_once()
+    row = list(log_access_kwargs.values())
+    assert db.execute.call_args_list == [
+        mock.call(sql._applog_insert_query, (timestamp, "+001", *row)),
+        mock.call(sql._applog_insert_query, (timestamp, "+002", *row)),
+    ]
+
+
+class FakeConnection:
+    """Stand-in for a pyodbc connection"""
+
+    def __init__(self, opened):
+        self.id = len(opened)
+        self.broken = False
+        self.closed = False
+        opened.append(self)
+
+    def execute(self, query, *args):
+        if self.broken or self.closed:
+            raise pyodbc.OperationalError("08S01", "Communication link failure")
+        return mock.MagicMock()
+
+    def rollback(self):
+        if self.broken or self.closed:
+            raise pyodbc.OperationalError("08S01", "Communication link failure")
+
+    def close(self):
+        self.closed = True
+
+
+def test_connection_pool_concurrent():
+    opened = []
+    pool = sql.ConnectionPool(lambda: FakeConnection(opened), name="test", size=3)
+    in_use = []
+    max_in_use = 0
+    lock = threading.Lock()
+
+    def query(i):
+        nonlocal max_in_use
+        with pool.connection() as db:
+            with lock:
+                assert db not in in_use
+                in_use.append(db)
+                max_in_use = max(max_in_use, len(in_use))
+            time.sleep(0.01)
+            with lock:
+                in_use.remove(db)
+        return db.id
+
+    with ThreadPoolExecutor(8) as executor:
+        ids = list(executor.map(query, range(40)))
+    assert max_in_use == 3
+    assert len(opened) == 3
+    assert set(ids) == {0, 1, 2}
+    assert (
+        REGISTRY.get_sample_value("sql_pool_wait_seconds_count", {"pool": "test"}) >= 40
+    )
+    assert (
+        REGISTRY.get_sample_value(
+            "sql_pool_connections", {"pool": "test", "state": "idle"}
+        )
+        == 3
+    )
+
+    pool.close()
+    assert all(db.closed for db in opened)
+
+
+def test_connection_pool_replaces_connections():
+    opened = []
+    now = 0
+    pool = sql.ConnectionPool(
+        lambda: FakeConnection(opened),
+        size=2,
+        max_lifetime=100,
+        check_interval=10,
+        clock=lambda: now,
+    )
+    with pool.connection() as db:
+        assert db.id == 0
+    with pool.connection() as db:
+        assert db.id == 0
+
+    # broken while idle: replaced after the health check
+    opened[0].broken = True
+    now += 11
+    with pool.connection() as db:
+        assert db.id == 1
+    assert opened[0].closed
+
+    # broken while in use: not returned to the pool
+    with pytest.raises(pyodbc.OperationalError):
+        with pool.connection() as db:
+            assert db.id == 1
+            db.broken = True
+            db.execute("SELECT 1")
+    with pool.connection() as db:
+        assert db.id == 2
+
+    # expired
+    now += 101
+    with pool.connection() as db:
+        assert db.id == 3
+    assert opened[2].closed
+
+
+def test_connection_pool_timeout():
+    opened = []
+    pool = sql.ConnectionPool(
+        lambda: FakeConnection(opened), name="test-timeout", size=1, timeout=0.05
+    )
+    with pool.connection():
+        with pytest.raises(sql.PoolTimeout):
+            with pool.connection():
+                pass
+    assert (
+        REGISTRY.get_sample_value("sql_pool_timeouts_total", {"pool": "test-timeout"})
+        == 1
+    )
+    # the connection is free again
+    with pool.connection() as db:
+        assert db.id == 0
+    assert pool.in_use == 0
+
+
+async def test_with_db_pool():
+    opened = []
+
+    @sql.with_db(Test="pool")
+    def query(db):
+        time.sleep(0.01)
+        return db.id
+
+    with mock.patch.object(
+        sql, "connect_to_database", make_async(lambda **kw: FakeConnection(opened))
+    ):
+        ids = await asyncio.gather(*(query() for i in range(20)))
+    assert len(opened) <= sql.SQL_POOL_SIZE
+    assert set(ids) == {db.id for db in opened}
+    query.close()
+    assert all(db.closed for db in opened)
+
+
+def gps_row(t, latitude, total=0):
+    time_from = datetime.datetime(2020, 5, 1) + datetime.timedelta(minutes=t)
+    return (
+        "android",
+        "10",
+        "1.0",
+        "Pixel",
+        time_from,
+        time_from + datetime.timedelta(seconds=1),
+        latitude,
+        10.5,
+        1.0,
+        0.0,
+        1.0,
+        3.0,
+        1.0,
+        total,
+    )
+
+
+async def test_stream_gps_events():
+    # ordered by descending time_from,
+    # with a tie at t=71 across the third and fourth chunk
+    rows = [gps_row(100 - i, 59.0 + i) for i in range(50)]
+    rows.insert(30, gps_row(71, 60.0))
+    opened = []
+    queried = []
+
+    class Connection(FakeConnection):
+        def execute(self, query, params):
+            assert query == "{CALL getdatabyUUIDList (?,?,?,?,?,?)}"
+            assert params[0] == "device1,device2"
+            resume_from = params[5]
+            queried.append(resume_from)
+            result = mock.MagicMock()
+            remaining = iter(
+                row for row in rows if resume_from is None or row[4] <= resume_from
+            )
+            result.fetchmany = lambda n: list(itertools.islice(remaining, n))
+            return result
+
+    async def collect(cursor=None, limit=None):
+        chunks = []
+        events = sql.stream_gps_events(
+            ["device1", "device2"], cursor=cursor, chunk_size=10
+        )
+        try:
+            async for chunk, next_cursor in events:
+                chunks.append((chunk, next_cursor))
+                if len(chunks) == limit:
+                    break
+        finally:
+            await events.aclose()
+        return chunks
+
+    with mock.patch.object(
+        sql, "connect_to_database", make_async(lambda **kw: Connection(opened))
+    ):
+        chunks = await collect()
+        assert [len(chunk) for chunk, _ in chunks] == [10, 10, 10, 10, 10, 1]
+        all_events = [event for chunk, _ in chunks for event in chunk]
+        assert all_events == [sql._gps_event(row) for row in rows]
+
+        # resume after each chunk, including in the middle of the tie
+        for i, (chunk, cursor) in enumerate(chunks):
+            resumed = await collect(cursor=cursor)
+            assert [event for c, _ in resumed for event in c] == all_events[
+                10 * (i + 1) :
+            ]
+            # the query starts at the last time_from sent
+            assert queried[-1] == rows[min(10 * i + 9, len(rows) - 1)][4]
+
+        # resuming still works after the total has changed,
+        # here in the middle of the tie at t=71
+        rows[:] = [row[:-1] + (len(rows) + 10,) for row in rows]
+        resumed = await collect(cursor=chunks[2][1])
+        assert [event for c, _ in resumed for event in c] == all_events[30:]
+
+        # stopping early returns the connection to the pool
+        await collect(limit=1)
+    pool = sql.get_connection_pool(streaming=True, ApplicationIntent="ReadOnly")
+    assert pool.in_use == 0
+    assert len(opened) == 1
+
+    with pytest.raises(ValueError):
+        sql.decode_gps_cursor("not a cursor")
+
+
+async def test_with_db_stream_pool():
+    opened = []
+
+    with mock.patch.multiple(sql, SQL_STREAM_POOL_SIZE=2, SQL_POOL_TIMEOUT=0.1):
+
+        @sql.with_db_stream(Test="stream")
+        def stream(db):
+            yield db.id
+
+        @sql.with_db(Test="stream")
+        def query(db):
+            return db.id
+
+    with mock.patch.object(
+        sql, "connect_to_database", make_async(lambda **kw: FakeConnection(opened))
+    ):
+        # stalled streams hold every stream connection
+        stalled = [stream(), stream()]
+        for events in stalled:
+            await events.__anext__()
+        with pytest.raises(sql.PoolTimeout):
+            await stream().__anext__()
+
+        # without taking connections or threads from with_db
+        assert await asyncio.gather(*(query() for i in range(10)))
+
+        for events in stalled:
+            await events.aclose()
+        async for db_id in stream():
+            assert db_id in {0, 1}
+    assert sql.get_connection_pool(streaming=True, Test="stream").in_use == 0
+    assert sql.get_connection_pool(Test="stream").in_use == 0
+
+
+async def test_device_pool(
+    db_user_registration, setup_testdb, trucate_tables_after_test
+):
+    trucate_tables_after_test(["dbo.DevicePool"])
+    assert await sql.get_device_pool_size() == 0
+    assert await sql.claim_pooled_device() is None
+
+    pooled = [(f"pooled{i}", f"key{i}") for i in range(5)]
+    for device_id, primary_key in pooled:
+        await sql.add_pooled_device(device_id, primary_key)
+    assert await sql.get_device_pool_size() == len(pooled)
+
+    # concurrent claims never get the same device
+    claimed = await asyncio.gather(*(sql.claim_pooled_device() for i in range(7)))
+    assert sorted(filter(None, claimed)) == pooled
+    assert claimed.count(None) == 2
+    assert await sql.get_device_pool_size() == 0
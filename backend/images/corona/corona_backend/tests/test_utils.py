@@ -1,4 +1,11 @@
+import asyncio
+import time
+from collections import deque
+
 import pytest
+from tornado import web
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
 
 from corona_backend import utils
 
@@ -22,3 +29,316 @@ def test_timer():
     message_test = "testmessage"
     with utils.timer(message_test):
         pass
+
+
+class FakeTokenService:
+    """Issues numbered tokens, valid for `ttl` seconds on a fake clock"""
+
+    def __init__(self, ttl=3600):
+        self.now = 1000
+        self.ttl = ttl
+        self.issued = 0
+        self.fail = False
+        self.release = asyncio.Event()
+        self.release.set()
+
+    def clock(self):
+        return self.now
+
+    async def fetch_token(self):
+        await self.release.wait()
+        if self.fail:
+            raise RuntimeError("token service unavailable")
+        self.issued += 1
+        return f"token-{self.issued}", self.now + self.ttl
+
+
+async def test_cached_credential_single_flight():
+    service = FakeTokenService()
+    credential = utils.CachedCredential(
+        service.fetch_token, refresh_before=600, min_validity=60, clock=service.clock
+    )
+    service.release.clear()
+    waiters = [asyncio.ensure_future(credential.get()) for i in range(10)]
+    await asyncio.sleep(0)
+    service.release.set()
+    assert await asyncio.gather(*waiters) == ["token-1"] * 10
+    assert service.issued == 1
+
+    # cached
+    service.now += 3000 - 1
+    assert await credential.get() == "token-1"
+    assert service.issued == 1
+
+    # expired while many requests are waiting: still one refresh
+    service.now += 3600
+    service.release.clear()
+    waiters = [asyncio.ensure_future(credential.get()) for i in range(10)]
+    await asyncio.sleep(0)
+    service.release.set()
+    assert await asyncio.gather(*waiters) == ["token-2"] * 10
+    assert service.issued == 2
+
+    # invalidated tokens are not used
+    credential.invalidate()
+    assert await credential.get() == "token-3"
+
+
+async def test_cached_credential_background_refresh():
+    service = FakeTokenService()
+    credential = utils.CachedCredential(
+        service.fetch_token, refresh_before=600, min_validity=60, clock=service.clock
+    )
+    assert await credential.get() == "token-1"
+
+    # within refresh_before of expiry: the current token is still served
+    # while one refresh runs in the background
+    service.now += 3600 - 300
+    service.release.clear()
+    tokens = await asyncio.gather(*(credential.get() for i in range(10)))
+    assert tokens == ["token-1"] * 10
+    service.release.set()
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    assert service.issued == 2
+    assert await credential.get() == "token-2"
+
+    # failed background refreshes keep the current token until min_validity,
+    # and are retried after retry_interval
+    service.now += 3600 - 300
+    service.fail = True
+    assert await credential.get() == "token-2"
+    await asyncio.sleep(0)
+    assert await credential.get() == "token-2"
+    assert not credential._refreshing
+    service.now += credential.retry_interval
+    service.fail = False
+    assert await credential.get() == "token-2"
+    await asyncio.sleep(0)
+    assert await credential.get() == "token-3"
+
+    # failed refreshes of expired tokens are raised
+    service.now += 3600
+    service.fail = True
+    with pytest.raises(RuntimeError):
+        await credential.get()
+
+
+async def test_adaptive_limiter():
+    limiter = utils.AdaptiveLimiter("test", initial=2, minimum=1, maximum=4)
+    epochs = [await limiter.acquire(), await limiter.acquire()]
+    assert limiter.active == 2
+
+    # full, wait for a slot
+    waiter = asyncio.ensure_future(limiter.acquire())
+    await asyncio.sleep(0)
+    assert not waiter.done()
+    limiter.release(epochs[0])
+    epochs[0] = await waiter
+    # additive increase: +1 per window of requests
+    assert limiter.limit == 2.5
+
+    # multiplicative decrease, once for requests started before the cut
+    limiter.release(epochs[0], throttled=True)
+    assert limiter.limit == 1.25
+    limiter.release(epochs[1], throttled=True)
+    assert limiter.limit == 1.25
+    assert limiter.active == 0
+
+    # Retry-After pauses new requests
+    epoch = await limiter.acquire()
+    limiter.release(epoch, throttled=True, retry_after=0.2)
+    assert limiter.limit == 1
+    tic = time.monotonic()
+    epoch = await limiter.acquire()
+    assert time.monotonic() - tic >= 0.15
+    limiter.release(epoch)
+
+    # waiting for a slot gives up at the deadline
+    epochs = [await limiter.acquire() for i in range(limiter.capacity)]
+    with pytest.raises(TimeoutError):
+        await limiter.acquire(deadline=time.monotonic() + 0.05)
+    for epoch in epochs:
+        limiter.release(epoch)
+    assert limiter.active == 0
+    assert not limiter._waiters
+
+
+class ThrottlingHandler(web.RequestHandler):
+    """Responds with 429 when requests arrive faster than `rate` per second"""
+
+    def initialize(self, state, rate, window=0.1, latency=0.01):
+        self.state = state
+        self.rate = rate
+        self.window = window
+        self.latency = latency
+
+    async def get(self):
+        now = time.monotonic()
+        recent = self.state["recent"]
+        while recent and recent[0] < now - self.window:
+            recent.popleft()
+        if len(recent) >= self.rate * self.window:
+            self.state["throttled"] += 1
+            self.set_status(429)
+            self.set_header("Retry-After", "0.1")
+            return
+        recent.append(now)
+        self.state["active"] += 1
+        self.state["max_active"] = max(self.state["max_active"], self.state["active"])
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.state["active"] -= 1
+        self.state["ok"] += 1
+        self.write("ok")
+
+
+async def test_fetch_adaptive_limit():
+    state = {"recent": deque(), "throttled": 0, "ok": 0, "active": 0, "max_active": 0}
+    app = web.Application([("/", ThrottlingHandler, {"state": state, "rate": 500})])
+    sock, port = bind_unused_port()
+    server = HTTPServer(app)
+    server.add_sockets([sock])
+    url = f"http://127.0.0.1:{port}/"
+    n = 500
+    try:
+        responses = await asyncio.gather(*(utils.fetch(url) for i in range(n)))
+    finally:
+        server.stop()
+
+    assert [r.code for r in responses] == [200] * n
+    assert state["ok"] == n
+    limiter = utils.get_limiter(f"127.0.0.1:{port}")
+    assert limiter.active == 0
+    # the limit grew past its initial value, and was cut when throttled
+    assert state["max_active"] > utils.FETCH_CONCURRENCY_INITIAL
+    assert state["throttled"] > 0
+    # but throttling stays the exception
+    assert state["throttled"] < n // 4
+
+
+class RateLimitOnceHandler(web.RequestHandler):
+    """Responds with 429 without Retry-After to the first request"""
+
+    def initialize(self, state):
+        self.state = state
+
+    async def get(self):
+        self.state["requests"] += 1
+        if self.state["requests"] == 1:
+            self.set_status(429)
+            return
+        await asyncio.sleep(0.01)
+        self.write("ok")
+
+
+async def test_fetch_rate_limit_without_retry_after():
+    state = {"requests": 0}
+    app = web.Application([("/", RateLimitOnceHandler, {"state": state})])
+    sock, port = bind_unused_port()
+    server = HTTPServer(app)
+    server.add_sockets([sock])
+    url = f"http://127.0.0.1:{port}/"
+    tic = time.monotonic()
+    try:
+        responses = await asyncio.gather(*(utils.fetch(url) for i in range(5)))
+    finally:
+        server.stop()
+    assert [r.code for r in responses] == [200] * 5
+    # the host isn't paused, only the throttled request backs off
+    limiter = utils.get_limiter(f"127.0.0.1:{port}")
+    assert limiter.paused_until == 0
+    assert time.monotonic() - tic < 2
+
+
+async def test_fetch_queueing_not_timed():
+    state = {"recent": deque(), "throttled": 0, "ok": 0, "active": 0, "max_active": 0}
+    app = web.Application(
+        [("/", ThrottlingHandler, {"state": state, "rate": 1000, "latency": 0.02})]
+    )
+    sock, port = bind_unused_port()
+    server = HTTPServer(app)
+    server.add_sockets([sock])
+    limiter = utils.get_limiter(f"127.0.0.1:{port}")
+    limiter.limit = limiter.maximum = 2
+    url = f"http://127.0.0.1:{port}/"
+    n = 20
+    try:
+        # 10 rounds of 20ms requests queue for longer than the timeout
+        responses = await asyncio.gather(
+            *(utils.fetch(url, timeout=0.1) for i in range(n))
+        )
+    finally:
+        server.stop()
+    assert [r.code for r in responses] == [200] * n
+    assert state["max_active"] <= 2
+
+
+class FakePages:
+    """Numbered pages of `per_page` items, fetched with `latency`"""
+
+    def __init__(self, n_pages, per_page=3, latency=0, fail_at=None):
+        self.n_pages = n_pages
+        self.per_page = per_page
+        self.latency = latency
+        self.fail_at = fail_at
+        self.fetched = 0
+
+    async def fetch_page(self, continuation):
+        i = continuation or 0
+        await asyncio.sleep(self.latency)
+        if i == self.fail_at:
+            raise RuntimeError(f"failed fetching page {i}")
+        self.fetched += 1
+        page = list(range(i * self.per_page, (i + 1) * self.per_page))
+        return page, (i + 1 if i + 1 < self.n_pages else None)
+
+
+@pytest.mark.parametrize("readahead", [0, 1, 3])
+async def test_prefetch_pages(readahead):
+    pages = FakePages(10)
+    consumed = []
+    async for page in utils.prefetch_pages(pages.fetch_page, readahead):
+        consumed.append(page)
+        # give the background fetch a chance to run ahead
+        await asyncio.sleep(0.01)
+        # waiting, and being fetched (but not yet queued)
+        assert pages.fetched - len(consumed) <= readahead + 1
+    assert [item for page in consumed for item in page] == list(range(30))
+    assert pages.fetched == 10
+
+
+async def test_prefetch_pages_stop_early():
+    pages = FakePages(100, latency=0.001)
+    async for page in utils.prefetch_pages(pages.fetch_page, readahead=2):
+        if page[0] >= 6:
+            break
+    await asyncio.sleep(0.05)
+    # fetching stopped with the consumer
+    assert pages.fetched <= 3 + 2 + 1
+
+
+async def test_prefetch_pages_stop_early_full_queue():
+    pages = FakePages(100)
+    before = asyncio.all_tasks()
+    prefetch = utils.prefetch_pages(pages.fetch_page, readahead=2)
+    await prefetch.__anext__()
+    # the read-ahead queue fills up, and fetching waits for room
+    await asyncio.sleep(0.05)
+    assert pages.fetched == 1 + 2 + 1
+    await prefetch.aclose()
+    await asyncio.sleep(0.01)
+    # the background fetch is cancelled, not left waiting on the queue
+    assert asyncio.all_tasks() == before
+    assert pages.fetched == 4
+
+
+async def test_prefetch_pages_error():
+    pages = FakePages(10, fail_at=2)
+    consumed = []
+    with pytest.raises(RuntimeError, match="page 2"):
+        async for page in utils.prefetch_pages(pages.fetch_page, readahead=2):
+            consumed.append(page)
+    # pages before the failure are still consumed
+    assert len(consumed) == 2
@@ -5,7 +5,7 @@ import docker
 import pyodbc
 from _pytest.monkeypatch import MonkeyPatch
 
-from corona_backend.sql import with_db
+from corona_backend.sql import close_connection_pools, with_db
 
 SQL_SERVER = os.environ["SQL_SERVER"]
 TEST_SQL_CONTAINER = os.environ.get("TEST_SQL_CONTAINER")
@@ -33,10 +33,13 @@ class TestDb(object):
 def set_db_user(user):
     mpatch = MonkeyPatch()
     mpatch.setenv("SQL_USER", user)
+    # don't reuse connections of another user
+    close_connection_pools()
     try:
         yield
     finally:
         mpatch.undo()
+        close_connection_pools()
 
 
 async def truncate_tables(tables):
@@ -8,8 +8,12 @@ import random
 import socket
 import time
 import warnings
+import weakref
+from collections import deque
 from contextlib import contextmanager
+from urllib.parse import urlparse
 
+from prometheus_client import Counter, Gauge
 from tornado import ioloop
 from tornado.httpclient import AsyncHTTPClient, HTTPClientError
 from tornado.log import app_log
@@ -17,17 +21,193 @@ from tornado.simple_httpclient import HTTPTimeoutError
 
 FETCH_TIMEOUT = int(os.environ.get("FETCH_TIMEOUT") or 20)
 
+# adaptive concurrency limits for requests to each host (see AdaptiveLimiter)
+FETCH_CONCURRENCY_INITIAL = int(os.environ.get("FETCH_CONCURRENCY_INITIAL") or 10)
+FETCH_CONCURRENCY_MIN = int(os.environ.get("FETCH_CONCURRENCY_MIN") or 1)
+FETCH_CONCURRENCY_MAX = int(os.environ.get("FETCH_CONCURRENCY_MAX") or 100)
+
+# number of pages of paginated results to fetch ahead of the consumer
+PAGE_READAHEAD = int(os.environ.get("PAGE_READAHEAD") or 2)
+
 # demote azure logger to warning because it logs debug-level data at info-level
 logging.getLogger("azure").setLevel(logging.WARNING)
 
+# connections open at once across all hosts,
+# above the adaptive limits so that tornado doesn't queue requests itself
+FETCH_MAX_CLIENTS = int(os.environ.get("FETCH_MAX_CLIENTS") or 200)
+
 try:
-    AsyncHTTPClient.configure("tornado.curl_httpclient.CurlAsyncHTTPClient")
+    AsyncHTTPClient.configure(
+        "tornado.curl_httpclient.CurlAsyncHTTPClient", max_clients=FETCH_MAX_CLIENTS
+    )
 except ImportError as e:
     warnings.warn(f"Could not load pycurl: {e}\npycurl is recommended for production.")
+    AsyncHTTPClient.configure(None, max_clients=FETCH_MAX_CLIENTS)
+
+
+fetch_concurrency_limit = Gauge(
+    "fetch_concurrency_limit", "Adaptive concurrency limit for requests", ["host"]
+)
+fetch_throttled = Counter(
+    "fetch_throttled", "Requests throttled with 429 or 503 responses", ["host"]
+)
+
+
+class AdaptiveLimiter:
+    """Concurrency limit for requests to one host,
+    adapted to its responses by additive increase, multiplicative decrease (AIMD)
+
+    - each successful request raises the limit by `increase / limit`,
+      i.e. by `increase` for each full window of requests
+    - a throttled request (429, 503) cuts the limit by `decrease`,
+      once per window: throttled requests that started before the last cut
+      don't cut it again
+    - an explicit Retry-After on a throttled request
+      pauses all new requests to the host
+    """
+
+    def __init__(
+        self,
+        host,
+        initial=FETCH_CONCURRENCY_INITIAL,
+        minimum=FETCH_CONCURRENCY_MIN,
+        maximum=FETCH_CONCURRENCY_MAX,
+        increase=1,
+        decrease=0.5,
+    ):
+        self.host = host
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.active = 0
+        # incremented on each cut, to detect throttles from before the cut
+        self.epoch = 0
+        # time.monotonic() until which requests are paused (Retry-After)
+        self.paused_until = 0
+        self._waiters = deque()
+        fetch_concurrency_limit.labels(host).set(self.limit)
+
+    @property
+    def capacity(self):
+        """The current number of requests allowed in flight"""
+        return max(self.minimum, int(self.limit))
+
+    async def acquire(self, deadline=None):
+        """Wait for a request slot
+
+        deadline is a time.monotonic() after which to give up waiting
+        and raise TimeoutError.
+
+        Returns the epoch to pass to release()
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                raise TimeoutError(
+                    f"Timeout waiting for a request slot for {self.host}"
+                )
+            if self.paused_until > now:
+                delay = self.paused_until - now
+                if deadline is not None:
+                    delay = min(delay, deadline - now)
+                await asyncio.sleep(delay)
+                continue
+            if self.active < self.capacity:
+                self.active += 1
+                return self.epoch
+            waiter = loop.create_future()
+            self._waiters.append(waiter)
+            try:
+                if deadline is None:
+                    await waiter
+                else:
+                    await asyncio.wait_for(waiter, max(0, deadline - now))
+            except asyncio.TimeoutError:
+                raise TimeoutError(
+                    f"Timeout waiting for a request slot for {self.host}"
+                ) from None
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # pass the wakeup on
+                    self._wake()
+                raise
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+
+    def release(self, epoch, throttled=False, retry_after=None, succeeded=True):
+        """Release a request slot, adapting the limit to the outcome
+
+        epoch is the value returned by acquire().
+        Requests that neither succeeded nor were throttled
+        (e.g. connection errors) leave the limit unchanged.
+        """
+        self.active -= 1
+        if throttled:
+            fetch_throttled.labels(self.host).inc()
+            if epoch == self.epoch:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+                self.epoch += 1
+                app_log.warning(
+                    f"Throttled by {self.host}, reducing concurrency to {self.capacity}"
+                )
+            if retry_after:
+                self.paused_until = max(
+                    self.paused_until, time.monotonic() + retry_after
+                )
+        elif succeeded:
+            self.limit = min(self.maximum, self.limit + self.increase / self.limit)
+        fetch_concurrency_limit.labels(self.host).set(self.limit)
+        self._wake()
+
+    def _wake(self):
+        """Wake waiters for the free slots"""
+        free = self.capacity - self.active
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+
+# event loop -> {host: AdaptiveLimiter}
+# limiters are per loop because database threads fetch tokens on their own loops
+_limiters = weakref.WeakKeyDictionary()
+
+
+def get_limiter(host):
+    """Get the AdaptiveLimiter for requests to a host"""
+    loop = asyncio.get_event_loop()
+    limiters = _limiters.setdefault(loop, {})
+    if host not in limiters:
+        limiters[host] = AdaptiveLimiter(host)
+    return limiters[host]
+
+
+def _retry_after(response):
+    """Retry-After of a response, in seconds, or None"""
+    if response is None:
+        return None
+    header = response.headers.get("Retry-After")
+    if header is None:
+        return None
+    try:
+        return float(header)
+    except ValueError:
+        app_log.error(f"Failed to handle Retry-After: {header}")
+        return None
 
 
 async def fetch(url_or_req, *args, timeout=FETCH_TIMEOUT, **kwargs):
-    """Fetch with a wrapper to log errors"""
+    """Fetch with a wrapper to log errors
+
+    Requests to each host are limited by its AdaptiveLimiter.
+    Waiting for the first request slot is queueing,
+    and doesn't count towards `timeout`.
+    """
 
     channel = {}
     try:
@@ -38,12 +218,24 @@ async def fetch(url_or_req, *args, timeout=FETCH_TIMEOUT, **kwargs):
         method = kwargs.get("method", "GET")
 
     log_url = f"{method} {url.split('?', 1)[0]}"
-    deadline = time.perf_counter() + timeout
+    limiter = get_limiter(urlparse(url).netloc)
+    first_epoch = await limiter.acquire()
+    deadline = time.monotonic() + timeout
 
     async def retry_connections():
+        nonlocal first_epoch
         app_log.info(f"{log_url}")
+        if first_epoch is not None:
+            epoch, first_epoch = first_epoch, None
+        else:
+            epoch = await limiter.acquire(deadline=deadline)
+        throttled = False
+        retry_after = None
+        succeeded = False
         try:
-            return await AsyncHTTPClient().fetch(url_or_req, *args, **kwargs)
+            resp = await AsyncHTTPClient().fetch(url_or_req, *args, **kwargs)
+            succeeded = True
+            return resp
         except (TimeoutError, HTTPTimeoutError, socket.gaierror) as e:
             app_log.error(f"Socket error fetching {log_url}: {e}")
             return False
@@ -51,22 +243,33 @@ async def fetch(url_or_req, *args, timeout=FETCH_TIMEOUT, **kwargs):
             # retry on server availability errors
             if e.code in {502, 503, 599}:
                 app_log.error(f"Error fetching {log_url}: {e}")
+                if e.code == 503:
+                    throttled = True
+                    retry_after = _retry_after(e.response)
                 return False
             elif e.code == 429:
-                retry_after_header = e.response.headers.get("Retry-After")
-                try:
-                    retry_after = int(retry_after_header)
-                except Exception as e:
-                    app_log.error(f"Failed to handle Retry-After: {retry_after_header}")
-                    retry_after = 30
-                app_log.error(
-                    f"Rate limit fetching {log_url}: {e} retrying after {retry_after}s"
-                )
-                max_sleep = max(0, deadline - time.perf_counter())
-                await asyncio.sleep(min(max_sleep, retry_after))
+                throttled = True
+                retry_after = _retry_after(e.response)
+                # the limiter waits for retry_after before the next request,
+                # without it only this request backs off
+                if retry_after:
+                    app_log.error(
+                        f"Rate limit fetching {log_url}: {e} retrying after {retry_after}s"
+                    )
+                else:
+                    app_log.error(f"Rate limit fetching {log_url}: {e} backing off")
                 return False
             else:
+                # an error response, but not an overloaded host
+                succeeded = True
                 raise
+        finally:
+            if retry_after:
+                # don't pause the host for longer than this request would wait
+                retry_after = min(retry_after, max(0, deadline - time.monotonic()))
+            limiter.release(
+                epoch, throttled=throttled, retry_after=retry_after, succeeded=succeeded
+            )
 
     try:
         return await exponential_backoff(
@@ -88,6 +291,67 @@ async def fetch(url_or_req, *args, timeout=FETCH_TIMEOUT, **kwargs):
         raise
 
 
+async def prefetch_pages(fetch_page, readahead=None):
+    """Iterate over paginated results, fetching pages ahead of the consumer
+
+    fetch_page is an async function called with the continuation
+    of the previous page (None for the first page)
+    and returning `(page, continuation)`.
+    Iteration stops when the continuation is empty.
+
+    Pages are fetched in the background while earlier pages are consumed.
+    At most `readahead` pages wait to be consumed,
+    so memory is bounded by readahead + 2 pages
+    (waiting, being fetched, and being consumed).
+    readahead=0 fetches each page only when it is needed.
+
+    async generator, yields pages
+    """
+    if readahead is None:
+        readahead = PAGE_READAHEAD
+
+    if readahead < 1:
+        continuation = None
+        while True:
+            page, continuation = await fetch_page(continuation)
+            yield page
+            if not continuation:
+                return
+
+    queue = asyncio.Queue(readahead)
+    done = object()
+
+    async def fetch_all():
+        continuation = None
+        try:
+            while True:
+                page, continuation = await fetch_page(continuation)
+                await queue.put((page, None))
+                if not continuation:
+                    break
+        except asyncio.CancelledError:
+            # a subclass of Exception on Python 3.7,
+            # and there may be no consumer left to make room in the queue
+            raise
+        except Exception as e:
+            await queue.put((None, e))
+        else:
+            await queue.put((done, None))
+
+    fetching = asyncio.ensure_future(fetch_all())
+    try:
+        while True:
+            page, error = await queue.get()
+            if error is not None:
+                raise error
+            if page is done:
+                break
+            yield page
+    finally:
+        # stop fetching if the consumer stops early
+        fetching.cancel()
+
+
 def mask_phone(phone_number):
     """Mask a phone number, e.g. +4712345678 -> +47XXXX678
 
@@ -216,3 +480,95 @@ def isoformat(dt):
 
 def now_at_utc():
     return datetime.datetime.now(datetime.timezone.utc)
+
+
+class CachedCredential:
+    """An expiring credential (access token, SAS token), refreshed ahead of time
+
+    `fetch_token` is an async function returning `(token, expiry)`,
+    with expiry in seconds since the epoch.
+
+    - tokens with more than `refresh_before` seconds left are returned as-is
+    - tokens with less time left are still returned,
+      but a refresh is started in the background
+    - tokens with less than `min_validity` seconds left are not used,
+      callers wait for the refresh
+
+    Concurrent refreshes are coalesced into one call to `fetch_token`
+    per event loop (database connections request tokens from worker threads,
+    each with their own loop).
+    After a failed background refresh, the next one is attempted
+    after `retry_interval` seconds.
+    """
+
+    def __init__(
+        self,
+        fetch_token,
+        *,
+        name="token",
+        refresh_before=600,
+        min_validity=60,
+        retry_interval=10,
+        clock=time.time,
+    ):
+        self.fetch_token = fetch_token
+        self.name = name
+        self.refresh_before = refresh_before
+        self.min_validity = min_validity
+        self.retry_interval = retry_interval
+        self.clock = clock
+        self.token = None
+        self.expiry = 0
+        self.refresh_count = 0
+        # event loop -> running refresh
+        self._refreshing = {}
+        self._retry_at = 0
+
+    async def get(self):
+        """Return a valid token, refreshing it if needed"""
+        now = self.clock()
+        remaining = self.expiry - now
+        if self.token is not None and remaining >= self.min_validity:
+            if remaining < self.refresh_before and now >= self._retry_at:
+                # refresh in the background, keep using the current token for now
+                self.refresh()
+            return self.token
+        return await asyncio.shield(self.refresh())
+
+    def refresh(self):
+        """Start a refresh, unless one is already running
+
+        Returns the future of the refresh
+        """
+        loop = asyncio.get_event_loop()
+        refreshing = self._refreshing.get(loop)
+        if refreshing is None:
+            refreshing = self._refreshing[loop] = asyncio.ensure_future(
+                self._refresh(loop)
+            )
+            # failures are logged in _refresh, don't warn about unretrieved errors
+            # of background refreshes
+            refreshing.add_done_callback(lambda f: f.cancelled() or f.exception())
+        return refreshing
+
+    async def _refresh(self, loop):
+        try:
+            token, expiry = await self.fetch_token()
+        except Exception:
+            app_log.exception(f"Failed to refresh {self.name}")
+            self._retry_at = self.clock() + self.retry_interval
+            raise
+        finally:
+            self._refreshing.pop(loop, None)
+        self.token = token
+        self.expiry = expiry
+        self.refresh_count += 1
+        app_log.info(
+            f"Refreshed {self.name}, valid for {expiry - self.clock():.0f} seconds"
+        )
+        return token
+
+    def invalidate(self):
+        """Discard the current token, e.g. after it has been rejected"""
+        self.token = None
+        self.expiry = 0
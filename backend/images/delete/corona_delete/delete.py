@@ -1,18 +1,16 @@
 """Watch the user list for consent revocation and delete user data"""
 
 import asyncio
-import concurrent.futures
 import os
 import time
 from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from functools import lru_cache
-from queue import Queue, Empty
-from threading import Thread
 
 import azure.core.exceptions
 from dateutil.parser import parse as parse_date
+from prometheus_client import REGISTRY
 from tornado.httpclient import HTTPClientError
 from tornado.log import app_log
 from tornado.options import parse_command_line, define, options
@@ -20,10 +18,16 @@ from tornado.options import parse_command_line, define, options
 from corona_backend import devices, graph, sql
 from corona_backend.utils import timer
 from . import storage
+from .journal import DELETED, FAILED, SKIPPED, Journal, open_journal
+from .pipeline import Pipeline, Stage
 
 # number of concurrent deletions outstanding
 # except when processing a backlog, we are actually limited by DB_THREADS making sql delete requests
 CONCURRENCY = int(os.environ.get("CONCURRENCY") or 10)
+# concurrency of each stage of delete_everything, if different from CONCURRENCY
+IOT_CONCURRENCY = int(os.environ.get("IOT_CONCURRENCY") or 0)
+SQL_CONCURRENCY = int(os.environ.get("SQL_CONCURRENCY") or 0)
+GROUP_CONCURRENCY = int(os.environ.get("GROUP_CONCURRENCY") or 0)
 # number of failures to allow before aborting the task
 MAX_FAILURES = int(os.environ.get("MAX_FAILURES") or 1)
 
@@ -37,16 +41,25 @@ UNDELETE_DAYS = int(os.environ.get("UNDELETE_DAYS") or 2)
 REWRITE_DAYS = int(os.environ.get("REWRITE_DAYS") or 2)
 # expiry for data lake files
 DATA_LAKE_DAYS = int(os.environ.get("DATA_LAKE_DAYS") or 30)
+# days after its date that a date-partitioned lake directory may still be written to
+# (data for a day is delivered late by a few hours at most)
+PARTITION_WRITE_DAYS = int(os.environ.get("PARTITION_WRITE_DAYS") or 2)
 
 # idle cutoff for user inactivity
 IDLE_CUTOFF_DAYS = int(os.environ.get("IDLE_CUTOFF_DAYS") or 30)
 IDLE_CUTOFF = datetime.now(timezone.utc) - timedelta(days=IDLE_CUTOFF_DAYS)
 # limit the number of deletions in a given run
 IDLE_DELETE_LIMIT = int(os.environ.get("IDLE_DELETE_LIMIT") or 0)
+# number of inactive devices fetched per query
+INACTIVE_PAGE_SIZE = int(os.environ.get("INACTIVE_PAGE_SIZE") or 1000)
 
 # batch variables for deletions
 DELETE_BATCH_SIZE = int(os.environ.get("DELETE_BATCH_SIZE") or 1)
 DELETE_BATCH_SECONDS = int(os.environ.get("DELETE_BATCH_SECONDS") or 30)
+# number of devices deleted (and committed) per sql call
+DELETE_SQL_CHUNK_SIZE = int(os.environ.get("DELETE_SQL_CHUNK_SIZE") or 100)
+# number of times to retry devices in failed chunks
+DELETE_SQL_RETRIES = int(os.environ.get("DELETE_SQL_RETRIES") or 2)
 
 # the date before which we assume sql data doesn't need to be deleted again
 # because re-running SQL delete is so slow
@@ -179,6 +192,244 @@ async def consume_concurrently(
     log_progress(extra="completed", force=True)
 
 
+def remote_calls():
+    """Total remote calls made so far, by service"""
+    return {
+        service: REGISTRY.get_sample_value(f"{counter}_total") or 0
+        for service, counter in (
+            ("graph", "graph_requests"),
+            ("iothub", "iothub_requests"),
+            ("sql", "sql_queries"),
+        )
+    }
+
+
+def _timestamp(date_str):
+    """Parse a date string to epoch seconds, which take less memory"""
+    return parse_date(date_str).timestamp()
+
+
+def _isoformat(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+
+
+class DirectorySnapshot:
+    """Device groups, their users and IoTHub activity, listed up front
+
+    Used when scanning inactive devices,
+    so that each device is resolved in memory
+    instead of with several remote calls.
+    Devices missing from the snapshot (e.g. registered since it was taken)
+    are looked up remotely.
+
+    The snapshot covers every device,
+    so only the fields used by the scan are kept, in tuples,
+    and groups and users are rebuilt as needed.
+    """
+
+    def __init__(self):
+        # device id: (group id, user id or None, createdDateTime, lastActivityTime)
+        # as timestamps, lastActivityTime is None if not listed in IoTHub
+        self.devices = {}
+        # user id: (displayName, *device ids) for users with consent
+        self.users = {}
+        # users with consent already revoked
+        self.revoked_user_ids = set()
+        # lastActivityTime of IoTHub devices listed before their group
+        self._last_activity = {}
+        self.iothub_devices = 0
+        # devices known to have no SQL activity since IDLE_CUTOFF
+        self.inactive_device_ids = set()
+        self.misses = defaultdict(int)
+
+    def add_group(self, group, user=None):
+        """Add a device group, and its member user if any"""
+        device_id = group["displayName"]
+        user_id = None
+        if user is not None:
+            user_id = user["id"]
+            if user.get(consent_revoked):
+                self.revoked_user_ids.add(user_id)
+            elif user_id in self.users:
+                self.users[user_id] += (device_id,)
+            else:
+                self.users[user_id] = (user.get("displayName"), device_id)
+        self.devices[device_id] = (
+            group["id"],
+            user_id,
+            _timestamp(group["createdDateTime"]),
+            self._last_activity.pop(device_id, None),
+        )
+
+    async def _load_groups(self):
+        async for group in graph.list_groups(
+            select="id,displayName,createdDateTime",
+            expand=f"members($select=id,displayName,{consent_revoked})",
+        ):
+            members = group.get("members")
+            self.add_group(group, members[0] if members else None)
+
+    async def _load_devices(self):
+        async for device in devices.get_devices():
+            self.iothub_devices += 1
+            device_id = device["deviceId"]
+            last_activity = _timestamp(device["lastActivityTime"])
+            entry = self.devices.get(device_id)
+            if entry is None:
+                # group not listed yet
+                self._last_activity[device_id] = last_activity
+            else:
+                self.devices[device_id] = entry[:3] + (last_activity,)
+
+    async def load(self):
+        """List all device groups with their members, and all IoTHub devices"""
+        with timer("Listed device groups and IoTHub devices"):
+            await asyncio.gather(self._load_groups(), self._load_devices())
+        # the rest are IoTHub devices without a group
+        self._last_activity.clear()
+        app_log.info(
+            f"Listed {len(self.devices)} device groups,"
+            f" {len(self.users)} users and {self.iothub_devices} IoTHub devices"
+        )
+
+    def _group(self, device_id):
+        group_id, user_id, created = self.devices[device_id][:3]
+        return {
+            "id": group_id,
+            "displayName": device_id,
+            "createdDateTime": _isoformat(created),
+        }
+
+    async def get_group(self, device_id):
+        if device_id in self.devices:
+            return self._group(device_id)
+        self.misses["group"] += 1
+        return await graph.get_group(device_id)
+
+    async def user_for_device(self, group):
+        """Like graph.user_for_device"""
+        entry = self.devices.get(group["displayName"])
+        if entry is None or entry[0] != group["id"] or entry[1] is None:
+            self.misses["user"] += 1
+            return await graph.user_for_device(group)
+        user_id = entry[1]
+        if user_id in self.revoked_user_ids:
+            app_log.info(f"Consent already revoked for {group['displayName']}")
+            return
+        display_name = self.users[user_id][0]
+        return graph.wrap_user({"id": user_id, "displayName": display_name})
+
+    async def device_groups_for_user(self, user):
+        if user["id"] in self.users:
+            device_ids = self.users[user["id"]][1:]
+            return [self._group(device_id) for device_id in device_ids]
+        self.misses["user_groups"] += 1
+        return [group async for group in graph.device_groups_for_user(user)]
+
+    async def device_last_activity(self, device_id):
+        """Return the lastActivityTime of a device in IoTHub"""
+        entry = self.devices.get(device_id)
+        if entry is not None and entry[3] is not None:
+            return _isoformat(entry[3])
+        self.misses["device"] += 1
+        device = await devices.get_device(device_id)
+        return device["lastActivityTime"]
+
+    def add_inactive(self, device_id):
+        """Record a device found to have no SQL activity since IDLE_CUTOFF
+
+        Only devices of users with other devices are kept,
+        because only those are checked with has_sql_activity,
+        so memory doesn't grow with the number of inactive devices.
+        """
+        entry = self.devices.get(device_id)
+        if entry is None:
+            return
+        user = self.users.get(entry[1])
+        # (displayName, *device ids)
+        if user is not None and len(user) > 2:
+            self.inactive_device_ids.add(device_id)
+
+    async def has_sql_activity(self, device_id):
+        """Whether a device has SQL activity since IDLE_CUTOFF"""
+        if device_id in self.inactive_device_ids:
+            return False
+        self.misses["sql"] += 1
+        return await check_sql_data(device_id, activity_cutoff=IDLE_CUTOFF)
+
+
+class LiveDirectory:
+    """Live lookups with the interface of DirectorySnapshot
+
+    Used to confirm that a user found idle in the snapshot is still idle,
+    e.g. hasn't registered a new device since the snapshot was taken.
+    """
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    async def device_groups_for_user(self, user):
+        return [group async for group in graph.device_groups_for_user(user)]
+
+    async def device_last_activity(self, device_id):
+        device = await devices.get_device(device_id)
+        return device["lastActivityTime"]
+
+    async def has_sql_activity(self, device_id):
+        # SQL inactivity is found during the scan, not in the snapshot
+        return await self.snapshot.has_sql_activity(device_id)
+
+
+async def find_device_activity(directory, user, uuid, counts):
+    """Check the devices of a user with an inactive device for activity
+
+    In case of new device registrations,
+    don't delete data from a user's old phone.
+
+    directory is a DirectorySnapshot or LiveDirectory.
+
+    Returns (active, device_ids)
+    """
+    device_ids = [uuid]
+    for group in await directory.device_groups_for_user(user):
+        device_id = group["displayName"]
+        if device_id != uuid:
+            device_ids.append(device_id)
+        # First check for recent registration (cheap)
+        if parse_date(group["createdDateTime"]) >= IDLE_CUTOFF:
+            app_log.info(f"Recently registered device {device_id}")
+            counts["new"] += 1
+            if device_id == uuid:
+                app_log.warning(
+                    f"WRONG activity: recently registered {device_id} not idle"
+                )
+                counts["wrong"] += 1
+            return True, device_ids
+        try:
+            device_last_activity = await directory.device_last_activity(device_id)
+        except Exception as e:
+            app_log.warning(f"Failed to get device {device_id}: ({e})")
+            counts["iot_err"] += 1
+            pass
+        else:
+            if parse_date(device_last_activity) >= IDLE_CUTOFF:
+                counts["iot"] += 1
+                app_log.info(f"Activity on {device_id} in IoTHub")
+                if device_id == uuid:
+                    app_log.warning(
+                        f"WRONG activity: iothub active {device_id} not idle"
+                    )
+                    counts["wrong"] += 1
+                return True, device_ids
+        if device_id != uuid:
+            # if not registered since cutoff, check for activity in SQL
+            if await directory.has_sql_activity(device_id):
+                counts["sql"] += 1
+                app_log.info(f"Activity on {device_id} in SQL")
+                return True, device_ids
+    return False, device_ids
+
+
 async def find_users_to_delete(limit=None):
     """Find users whose devices should be deleted"""
     async for user in graph.list_users(filter=f"{consent_revoked} eq true"):
@@ -190,13 +441,23 @@ async def find_users_to_delete(limit=None):
                 f"User {user['logName']} without consent revoked shouldn't have been returned by query."
             )
 
-    inactive = await find_inactive_devices()
-    app_log.info(f"Found {len(inactive)} inactive devices")
+    calls_before = remote_calls()
     counts = defaultdict(int)
+    snapshot = DirectorySnapshot()
+    await snapshot.load()
+    # the snapshot isn't updated as users are deleted,
+    # so a user with several inactive devices would be found once per device
+    found_user_ids = set()
+
+    async def stream_inactive():
+        """Feed inactive devices to processing as they are found"""
+        async for uuid, last_activity in find_inactive_devices():
+            snapshot.add_inactive(uuid)
+            yield uuid, last_activity
 
     async def process_one(uuid_activity):
         uuid, last_activity = uuid_activity
-        group = await graph.get_group(uuid)
+        group = await snapshot.get_group(uuid)
         if group is None:
             app_log.info(f"No group for inactive device {uuid}")
             counts["no_group"] += 1
@@ -205,58 +466,28 @@ async def find_users_to_delete(limit=None):
             app_log.info(f"Already marked for deletion: {uuid}")
             counts["deleted"] += 1
             return
-        user = await graph.user_for_device(group)
+        user = await snapshot.user_for_device(group)
         if user is None:
             app_log.info(f"No user for inactive device {uuid}")
             counts["no_user"] += 1
             # FIXME: something went wrong. Mark device id group for deletion?
             return
+        if user["id"] in found_user_ids:
+            app_log.info(f"User {user['logName']} already found inactive")
+            counts["duplicate"] += 1
+            return
 
-        # check other devices on the same user
-        # in case of new device registrations,
-        # don't delete data from a user's old phone
-        other_device_activity = None
-        device_ids = [uuid]
-        async for group in graph.device_groups_for_user(user):
-            device_id = group["displayName"]
-            if device_id != uuid:
-                device_ids.append(device_id)
-            # First check for recent registration (cheap)
-            if parse_date(group["createdDateTime"]) >= IDLE_CUTOFF:
-                app_log.info(f"Recently registered device {device_id}")
-                counts["new"] += 1
-                if device_id == uuid:
-                    app_log.warning(
-                        f"WRONG activity: recently registered {device_id} not idle"
-                    )
-                    counts["wrong"] += 1
-                other_device_activity = True
-                break
-            try:
-                device = await devices.get_device(device_id)
-            except Exception as e:
-                app_log.warning(f"Failed to get device {device_id}: ({e})")
-                counts["iot_err"] += 1
-                pass
-            else:
-                if parse_date(device["lastActivityTime"]) >= IDLE_CUTOFF:
-                    counts["iot"] += 1
-                    app_log.info(f"Activity on {device_id} in IoTHub")
-                    if device_id == uuid:
-                        app_log.warning(
-                            f"WRONG activity: iothub active {device_id} not idle"
-                        )
-                        counts["wrong"] += 1
-                    other_device_activity = True
-                    break
-            if device_id != uuid:
-                # if not registered since cutoff, check for activity in SQL
-                if await check_sql_data(device_id, activity_cutoff=IDLE_CUTOFF):
-                    counts["sql"] += 1
-                    app_log.info(f"Activity on {device_id} in SQL")
-                    other_device_activity = True
-                    break
-        if other_device_activity:
+        active, device_ids = await find_device_activity(snapshot, user, uuid, counts)
+        if not active:
+            # the snapshot may be hours old by now,
+            # so check again live before deleting the user and all their devices
+            active, device_ids = await find_device_activity(
+                LiveDirectory(snapshot), user, uuid, defaultdict(int)
+            )
+            if active:
+                app_log.info(f"User {user['logName']} active since the snapshot")
+                counts["changed"] += 1
+        if active:
             app_log.info(f"{uuid} is associated with other more recent device activity")
             counts["active"] += 1
         else:
@@ -265,16 +496,36 @@ async def find_users_to_delete(limit=None):
             counts["idle"] += 1
             return user
 
+    def log_remote_calls():
+        calls_after = remote_calls()
+        calls = {
+            service: int(calls_after[service] - calls_before[service])
+            for service in calls_before
+        }
+        calls_str = ", ".join(f"{key}={value}" for key, value in calls.items())
+        misses_str = ", ".join(
+            f"{key}={value}" for key, value in sorted(snapshot.misses.items())
+        )
+        app_log.info(
+            f"Remote calls while scanning {counts['total']} inactive devices"
+            f" (including concurrent deletions): {sum(calls.values())} ({calls_str}),"
+            f" snapshot misses: {misses_str or 'none'}"
+        )
+
     yielded = 0
-    async for user in consume_concurrently(
-        inactive, process_one, counts=counts, label="Inactive users"
-    ):
-        if user:
-            yield user
-            yielded += 1
-            if limit and yielded >= limit:
-                app_log.info(f"Reached idle user limit={limit}")
-                return
+    try:
+        async for user in consume_concurrently(
+            stream_inactive(), process_one, counts=counts, label="Inactive users"
+        ):
+            if user and user["id"] not in found_user_ids:
+                found_user_ids.add(user["id"])
+                yield user
+                yielded += 1
+                if limit and yielded >= limit:
+                    app_log.info(f"Reached idle user limit={limit}")
+                    return
+    finally:
+        log_remote_calls()
 
 
 async def find_groups_to_delete():
@@ -301,13 +552,39 @@ async def find_groups_to_delete():
 
 
 @sql.with_db(ApplicationIntent="ReadOnly")
-def find_inactive_devices(db, cutoff=IDLE_CUTOFF):
-    """Check for device ids that need deleting"""
-    app_log.info(f"Checking for devices inactive since {cutoff}")
-    cur = db.execute(r"{CALL getLastActivityBefore(?)}", (cutoff,))
+def find_inactive_devices_page(db, cutoff, after=None, page_size=INACTIVE_PAGE_SIZE):
+    """Get one page of devices inactive since cutoff
+
+    Devices are ordered by device id, starting after the device id `after`.
+    """
+    cur = db.execute(
+        r"{CALL getLastActivityBeforePage(?,?,?)}", (cutoff, after, page_size)
+    )
     return cur.fetchall()
 
 
+async def find_inactive_devices(cutoff=IDLE_CUTOFF, page_size=INACTIVE_PAGE_SIZE):
+    """Check for device ids that need deleting
+
+    Yields (device_id, last_activity) for each device inactive since cutoff,
+    paging through them by device id,
+    so that only one page is held in memory
+    and no connection is held between pages.
+    """
+    app_log.info(f"Checking for devices inactive since {cutoff}")
+    after = None
+    count = 0
+    while True:
+        rows = await find_inactive_devices_page(cutoff, after, page_size)
+        for row in rows:
+            yield row
+        count += len(rows)
+        if len(rows) < page_size:
+            break
+        after = rows[-1][0]
+    app_log.info(f"Found {count} devices inactive since {cutoff}")
+
+
 @sql.with_db(persistent=PERSISTENT_CHECK_DB, ApplicationIntent="ReadOnly")
 def check_sql_data(db, device_id, activity_cutoff=None):
     """Check if there's data to delete"""
@@ -327,41 +604,49 @@ def check_sql_data(db, device_id, activity_cutoff=None):
 
 
 @sql.with_db(pooled=False)
-def delete_sql_data(db, *device_ids):
+def delete_sql_data(db, *device_ids, chunk_size=DELETE_SQL_CHUNK_SIZE):
     """Find and delete data from the sql database
 
-    Returns [True|False] for whether each device actually had data to delete
+    Devices are deleted in chunks of chunk_size,
+    with one call and one commit per chunk.
+
+    Returns the outcome for each device:
+    True or False for whether the device actually had data to delete,
+    or the exception raised if deletion of its chunk failed.
+    Deletion is idempotent, so devices in failed chunks can be retried.
     """
-    device_csv = ",".join(device_ids)
-    app_log.warning(f"Deleting SQL data for {device_csv}")
-    deleted_something = []
-    # TODO: single csv call
-    for device_id in device_ids:
-        # run activity check again because check_sql_data runs against the read replica
-        # which can be out of date relative to master
-        # this appears important for re-run after a short period
-        activity_rows = db.execute(
-            r"{CALL latestActivityForUUID(?)}", (device_id,)
-        ).fetchall()
-        if not activity_rows:
-            app_log.info(f"No SQL activity to delete for {device_id}")
-            deleted_something.append(False)
-            continue
-        last_activity = activity_rows[0][1]
-        if not last_activity:
-            app_log.info(f"No SQL activity to delete for {device_id}")
-            deleted_something.append(False)
+    outcomes = []
+    for start in range(0, len(device_ids), chunk_size):
+        chunk = device_ids[start : start + chunk_size]
+        device_csv = ",".join(chunk)
+        app_log.warning(f"Deleting SQL data for {device_csv}")
+        try:
+            # checks activity again on master, because check_sql_data runs against
+            # the read replica which can be out of date relative to master
+            rows = db.execute(r"{CALL deleteforUUIDList (?)}", (device_csv,)).fetchall()
+            db.commit()
+        except Exception as e:
+            app_log.error(f"Error deleting SQL data for {len(chunk)} devices: {e}")
+            try:
+                db.rollback()
+            except Exception:
+                # broken connection, discarded when returned to the pool
+                pass
+            outcomes.extend([e] * len(chunk))
             continue
-        deleted_something.append(True)
-        cursor = db.execute(r"{CALL deleteforUUID (?)}", (device_id,))
-        cursor.commit()
-    return deleted_something
+        deleted = {row[0] for row in rows}
+        for device_id in chunk:
+            if device_id not in deleted:
+                app_log.info(f"No SQL activity to delete for {device_id}")
+            outcomes.append(device_id in deleted)
+    return outcomes
 
 
 class Deleter:
     """object wrapping batched async deletions
 
-    deletions are run serially in batches in a background thread
+    deletions are run serially in batches by a task on the event loop,
+    which keeps running (and reusing its connection) until stopped
     """
 
     Halt = object()
@@ -372,58 +657,88 @@ class Deleter:
         self.batch_seconds = batch_seconds
         self.batch_size = batch_size
         self.batch = []
-        self.queue = Queue()
-        self.thread = Thread(target=self.consume)
-        self.thread.start()
+        self.queue = asyncio.Queue()
+        self.task = asyncio.ensure_future(self.consume())
 
-    def stop(self, block=False):
-        """Stop the deletion thread
+    def stop(self):
+        """Stop the deletion task
 
-        if block=True, block and wait for the thread to quit
-        else: return awaitable Future for completion of the thread
+        Returns awaitable for completion of the task,
+        after deleting anything still pending
         """
         app_log.warning("Stopping deletion queue")
-        concurrent_future = concurrent.futures.Future()
-        self.queue.put((self.Halt, concurrent_future))
-        if block:
-            self.thread.join()
-        else:
-            return asyncio.wrap_future(concurrent_future)
+        self.queue.put_nowait((self.Halt, None))
+        return self.task
 
     def request_deletion(self, device_id):
-        """Submit a device id for batch deletion"""
+        """Submit a device id for batch deletion
+
+        Returns a Future for the outcome of its deletion
+        """
         app_log.info(f"Requesting db deletion of {device_id}")
 
-        if not self.thread.is_alive():
-            raise RuntimeError("Deletion thread not running!")
+        if self.task.done():
+            raise RuntimeError("Deletion task not running!")
+
+        future = asyncio.get_event_loop().create_future()
+        self.queue.put_nowait((device_id, future))
+        return future
 
-        # wrap thread-safe concurrent Future in awaitable asyncio Future
-        # we will use thread-safe Future internally, caller will await asyncio Future
-        concurrent_future = concurrent.futures.Future()
-        asyncio_future = asyncio.wrap_future(concurrent_future)
-        self.queue.put((device_id, concurrent_future))
-        return asyncio_future
+    async def delete_with_retries(self, device_ids, retries=DELETE_SQL_RETRIES):
+        """Delete a batch of devices from the db
 
-    def consume(self):
-        """Consume the deletion queue in the background"""
+        Devices in failed chunks are retried up to `retries` times,
+        with a new connection.
+
+        Returns the outcome for each device, as returned by delete_sql_data
+        """
+        outcomes = {}
+        pending = list(device_ids)
+        for attempt in range(retries + 1):
+            if attempt:
+                app_log.warning(
+                    f"Retrying deletion of {len(pending)} devices (attempt {attempt + 1})"
+                )
+                await asyncio.sleep(2 ** attempt)
+            try:
+                results = await delete_sql_data(*pending)
+            except Exception as e:
+                app_log.error(f"Error processing deletion: {e}")
+                results = [e] * len(pending)
+            failed = []
+            for device_id, result in zip(pending, results):
+                outcomes[device_id] = result
+                if isinstance(result, Exception):
+                    failed.append(device_id)
+            pending = failed
+            if not pending:
+                break
+        return [outcomes[device_id] for device_id in device_ids]
+
+    async def consume(self):
+        """Consume the deletion queue"""
         self.batch = batch = []
         finished = False
-        finish_future = None
+        # keep waiting on the same get() across idle timeouts,
+        # so that no request is lost to a cancelled get
+        get_future = None
         while not finished:
             should_delete = False
-            try:
-                device_id, future = self.queue.get(timeout=self.batch_seconds)
-            except Empty:
+            if get_future is None:
+                get_future = asyncio.ensure_future(self.queue.get())
+            done, _ = await asyncio.wait([get_future], timeout=self.batch_seconds)
+            if not done:
                 # idle, submit deletion if there's anything to delete
                 should_delete = bool(batch)
             else:
+                device_id, future = get_future.result()
+                get_future = None
                 if device_id is self.Halt:
                     # received halt message, delete anything pending and exit
                     app_log.info(
                         f"Halt of deletion requested, {len(batch)} items to delete"
                     )
                     finished = True
-                    finish_future = future
                     should_delete = bool(batch)
                 else:
                     # deletion requested, add to batch and delete if batch is full
@@ -443,26 +758,24 @@ class Deleter:
                 futures.append(future)
             batch[:] = []
             with timer(f"Deleted {len(device_ids)} devices from the db"):
-                try:
-                    deleted_somethings = asyncio.run(delete_sql_data(*device_ids))
-                except Exception as e:
-                    app_log.error(f"Error processing deletion: {e}")
+                outcomes = await self.delete_with_retries(device_ids)
+            for outcome, future in zip(outcomes, futures):
+                if future.cancelled():
+                    # requester went away
+                    continue
+                if isinstance(outcome, Exception):
                     # propagate errors to awaited Futures
-                    for future in futures:
-                        future.set_exception(e)
+                    future.set_exception(outcome)
                 else:
                     # signal deletions as completed
-                    for deleted_something, future in zip(deleted_somethings, futures):
-                        future.set_result(deleted_something)
+                    future.set_result(outcome)
         app_log.info("Exiting deletion queue")
-        if finish_future:
-            finish_future.set_result(None)
 
 
 @lru_cache()
 def get_deleter():
-    """Get cached global deletion thread"""
-    app_log.info("Creating global deletion thread")
+    """Get cached global deletion task"""
+    app_log.info("Creating global deletion task")
     return Deleter()
 
 
@@ -475,18 +788,51 @@ async def check_and_delete_sql(group):
     return has_sql_data
 
 
-async def delete_everything(concurrency=CONCURRENCY, max_failures=MAX_FAILURES):
-    """Delete everything marked for deletion"""
-    # limit concurrent processing of deletions
-    semaphore = asyncio.Semaphore(concurrency)
+async def delete_everything(
+    concurrency=CONCURRENCY, max_failures=MAX_FAILURES, journal=None
+):
+    """Delete everything marked for deletion
+
+    Devices flow through a pipeline of stages (iot, sql, group),
+    each with its own queue and concurrency,
+    so that each stage works on the next devices
+    while later stages are still busy.
+
+    Progress is recorded in a journal,
+    so that a run resumes where it left off after a crash.
+    """
     now = datetime.now(timezone.utc)
     counts = defaultdict(int)
+    if journal is None:
+        journal = open_journal("delete-everything")
+
+    def journaled(stage):
+        """Record failures of a stage in the journal"""
+
+        def decorator(process):
+            async def process_and_record(item):
+                try:
+                    return await process(item)
+                except Exception as e:
+                    journal.record(item["group"]["displayName"], stage, FAILED, str(e))
+                    raise
+
+            return process_and_record
 
-    async def process_one(group):
+        return decorator
+
+    @journaled("iot")
+    async def delete_iot(item):
+        group = item["group"]
         device_id = group["displayName"]
+
         # delete the device from iothub (this should have already happened)
-        deleted = []
-        if not group.get(iot_deleted_date):
+        if journal.is_done(device_id, "iot"):
+            iot_status = journal.get(device_id, "iot")
+        elif group.get(iot_deleted_date):
+            iot_status = SKIPPED
+            journal.record(device_id, "iot", iot_status)
+        else:
             try:
                 await devices.delete_devices(device_id)
             except HTTPClientError as e:
@@ -497,19 +843,45 @@ async def delete_everything(concurrency=CONCURRENCY, max_failures=MAX_FAILURES):
             else:
                 counts["iot"] += 1
             await graph.mark_iot_deleted(group)
-            deleted.append("iot")
+            iot_status = DELETED
+            journal.record(device_id, "iot", iot_status)
+        if iot_status == DELETED:
+            item["deleted"].append("iot")
+        return item
+
+    @journaled("sql")
+    async def delete_sql(item):
+        group = item["group"]
+        device_id = group["displayName"]
         delete_date = parse_date(group.get(to_delete_date))
 
         # TODO: check stored deletion dates?
         timestamp = isonow()
-        if not (SQL_CUTOFF_DATE and delete_date < SQL_CUTOFF_DATE):
+        if journal.is_done(device_id, "sql"):
+            sql_status = journal.get(device_id, "sql")
+        elif not (SQL_CUTOFF_DATE and delete_date < SQL_CUTOFF_DATE):
             deleted_sql = await check_and_delete_sql(group)
             if deleted_sql:
                 counts["sql"] += 1
-                deleted.append("sql")
             if deleted_sql or not group.get(sql_deleted_date):
                 await graph.set_group_attr(group, sqlDeletedDate=timestamp)
+            sql_status = DELETED if deleted_sql else SKIPPED
+            journal.record(device_id, "sql", sql_status)
+        else:
+            sql_status = SKIPPED
+            journal.record(device_id, "sql", sql_status)
+        if sql_status == DELETED:
+            item["deleted"].append("sql")
+        return item
+
+    @journaled("group")
+    async def delete_device_group(item):
+        group = item["group"]
+        device_id = group["displayName"]
+        deleted = item["deleted"]
+        delete_date = parse_date(group.get(to_delete_date))
 
+        group_status = SKIPPED
         if deleted:
             app_log.info(
                 f"Deleted {','.join(deleted)} for {device_id}, marked for deletion on {delete_date}"
@@ -533,16 +905,59 @@ async def delete_everything(concurrency=CONCURRENCY, max_failures=MAX_FAILURES):
                 counts["group"] += 1
                 app_log.warning(f"Deleting old inactive device {device_id}")
                 await graph.delete_group(group)
-
-    async for _ in consume_concurrently(
-        find_groups_to_delete(),
-        process_one,
+                group_status = DELETED
+        journal.record(device_id, "group", group_status)
+
+    pipeline = Pipeline(
+        [
+            Stage("iot", delete_iot, IOT_CONCURRENCY or concurrency),
+            # sql workers wait for their batch to be deleted,
+            # so there must be enough of them to fill a batch
+            Stage(
+                "sql",
+                delete_sql,
+                SQL_CONCURRENCY or max(concurrency, DELETE_BATCH_SIZE),
+            ),
+            Stage("group", delete_device_group, GROUP_CONCURRENCY or concurrency),
+        ],
         label="Deletion",
-        counts=counts,
-        concurrency=concurrency,
         max_failures=max_failures,
-    ):
-        pass
+        counts=counts,
+        log_interval=LOG_TIME_INTERVAL,
+    )
+
+    try:
+        async with pipeline:
+            async for group in find_groups_to_delete():
+                # the group stage is last, all stages are done
+                if journal.is_done(group["displayName"], "group"):
+                    app_log.info(
+                        f"Already processed {group['displayName']} before restarting"
+                    )
+                    counts["resumed"] += 1
+                    continue
+                await pipeline.submit({"group": group, "deleted": []})
+            await pipeline.join()
+    except BaseException:
+        journal.log_summary("Deletion (incomplete)")
+        journal.close()
+        raise
+    journal.log_summary("Deletion")
+    journal.finish()
+
+
+def partition_date(path_name):
+    """The date of a date-partitioned path (.../YYYY/MM/DD), if it is one"""
+    parts = path_name.rstrip("/").split("/")
+    if len(parts) < 3:
+        return None
+    year, month, day = parts[-3:]
+    if not (len(year) == 4 and len(month) == 2 and len(day) == 2):
+        return None
+    try:
+        return datetime(int(year), int(month), int(day), tzinfo=timezone.utc)
+    except ValueError:
+        return None
 
 
 async def expire_directories(parent_dir, expiry, dry_run=False):
@@ -550,6 +965,10 @@ async def expire_directories(parent_dir, expiry, dry_run=False):
 
     parent_dir is the parent directory name, e.g. 'undelete'
 
+    Ages are taken from the listing of parent_dir,
+    or the dates of date-partitioned subdirectories,
+    so that directory properties are only requested when neither settles it.
+
     expiry is the expiration cutoff as a datetime or
     an integer age in days, counted back from midnight today
     """
@@ -574,21 +993,57 @@ async def expire_directories(parent_dir, expiry, dry_run=False):
         )
         return
 
+    counts = defaultdict(int)
+
+    def last_modified_from_listing(path):
+        """Determine when a path was last modified without a request, if possible
+
+        - the listing includes last_modified, the same value
+          get_directory_properties would return
+        - otherwise, a date-partitioned path (.../YYYY/MM/DD)
+          was last modified at least on its date,
+          and at most PARTITION_WRITE_DAYS later
+
+        Returns (earliest, latest) bounds, which are equal if known exactly,
+        or None if there's nothing to go on.
+        """
+        last_modified = getattr(path, "last_modified", None)
+        if last_modified is not None:
+            if last_modified.tzinfo is None:
+                last_modified = last_modified.replace(tzinfo=timezone.utc)
+            counts["listing"] += 1
+            return last_modified, last_modified
+        day = partition_date(path.name)
+        if day is not None:
+            counts["partition"] += 1
+            return day, day + timedelta(days=PARTITION_WRITE_DAYS)
+
     def process_one(path):
-        dc = fs_client.get_directory_client(path)
-        props = dc.get_directory_properties()
-        if props.last_modified < expiry:
+        bounds = last_modified_from_listing(path)
+        if bounds is None or bounds[0] < expiry <= bounds[1]:
+            # ambiguous, ask the service
+            counts["properties"] += 1
+            props = fs_client.get_directory_client(path.name).get_directory_properties()
+            last_modified = props.last_modified
+        else:
+            # if the latest possible time is before expiry, it's expired,
+            # otherwise the earliest possible time is after expiry
+            last_modified = bounds[1]
+
+        if last_modified < expiry:
+            counts["expired"] += 1
             app_log.info(
-                f"{'(not really) ' * dry_run}Deleting {dc.path_name} from {props.last_modified}"
+                f"{'(not really) ' * dry_run}Deleting {path.name} from {last_modified}"
             )
             if not dry_run:
-                dc.delete_directory()
+                fs_client.get_directory_client(path.name).delete_directory()
         else:
-            app_log.info(f"Not deleting {dc.path_name} from {props.last_modified}")
+            app_log.info(f"Not deleting {path.name} from {last_modified}")
 
     done, pending = set(), set()
     with ThreadPoolExecutor(CONCURRENCY) as pool:
         for path in fs_client.get_paths(parent_dir, recursive=False):
+            counts["total"] += 1
             pending.add(asyncio.wrap_future(pool.submit(process_one, path)))
             done, pending = await asyncio.wait(pending, timeout=0.01)
             if done:
@@ -597,6 +1052,9 @@ async def expire_directories(parent_dir, expiry, dry_run=False):
     if pending:
         await asyncio.gather(*pending)
 
+    counts_str = ", ".join(f"{key}={value}" for key, value in sorted(counts.items()))
+    app_log.info(f"Expired subdirectories in {parent_dir}: {counts_str}")
+
 
 async def delete_raw_data():
     """Delete expired files in the raw data lake
@@ -626,7 +1084,7 @@ async def delete_raw_data():
 
 
 async def delete_idle_users(
-    concurrency=CONCURRENCY, limit=IDLE_DELETE_LIMIT, dry_run=False
+    concurrency=CONCURRENCY, limit=IDLE_DELETE_LIMIT, dry_run=False, journal=None
 ):
     """Find users that should be deleted
 
@@ -646,18 +1104,41 @@ async def delete_idle_users(
       and remove their phone numbers.
       Can be implemented over time in a sampling manner
       if we can make requests for users that will be random samples.
+
+    Deleted users are recorded in a journal,
+    so that a run resumes where it left off after a crash.
     """
 
+    if journal is None:
+        # don't resume real deletions from a dry run, or vice versa
+        journal = Journal() if dry_run else open_journal("idle-users")
+    label = f"Inactive deletions{' (dry run)' * dry_run}"
+
     async def process_one(user):
-        if not dry_run:
+        if journal.is_done(user["id"], "user"):
+            app_log.info(f"Already deleted {user['logName']} before restarting")
+            return
+        if dry_run:
+            journal.record(user["id"], "user", SKIPPED)
+            return
+        try:
             await graph.process_user_deletion(user)
+        except Exception as e:
+            journal.record(user["id"], "user", FAILED, str(e))
+            raise
+        journal.record(user["id"], "user", DELETED)
 
-    async for user in consume_concurrently(
-        find_users_to_delete(limit=limit),
-        process_one,
-        label=f"Inactive deletions{' (dry run)' * dry_run}",
-    ):
-        pass
+    try:
+        async for user in consume_concurrently(
+            find_users_to_delete(limit=limit), process_one, label=label,
+        ):
+            pass
+    except BaseException:
+        journal.log_summary(f"{label} (incomplete)")
+        journal.close()
+        raise
+    journal.log_summary(label)
+    journal.finish()
 
 
 async def main():
@@ -689,7 +1170,7 @@ async def main():
     with timer("Database deletion"):
         await delete_everything(concurrency=CONCURRENCY, max_failures=MAX_FAILURES)
     # wait for batched deletions to complete
-    await deleter.stop(block=False)
+    await deleter.stop()
 
 
 if __name__ == "__main__":
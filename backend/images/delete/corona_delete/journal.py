@@ -0,0 +1,152 @@
+"""checkpoint journal for resumable deletion runs
+
+- record which stages are done for each device (or user)
+- resume a run that crashed or was evicted from its journal
+- summarize deleted, skipped and failed counts per stage
+"""
+
+import json
+import os
+import time
+from collections import defaultdict
+
+from tornado.log import app_log
+
+# directory for journals, one file per kind of run
+# journals are kept in memory only if unset
+JOURNAL_DIR = os.environ.get("DELETION_JOURNAL_DIR") or ""
+
+DELETED = "deleted"
+SKIPPED = "skipped"
+FAILED = "failed"
+
+
+class Journal:
+    """Durable record of the deletion stages completed for each key
+
+    Records are appended as json lines and fsynced,
+    so that they survive the process being killed at any point.
+    A partial last line, written while being killed, is discarded on load.
+
+    Stages are recorded after they complete.
+    If the process is killed between a deletion and its record,
+    the deletion is repeated when resuming, which is safe
+    because all deletions are idempotent.
+
+    Opening a journal resumes its run, until finish() marks the run complete.
+    Opening a completed journal starts a new run,
+    keeping the completed one in {path}.prev.
+    """
+
+    def __init__(self, path=None, fsync=True):
+        self.path = path
+        self.fsync = fsync
+        # (key, stage): latest status
+        self.status = {}
+        self.resumed = False
+        self._file = None
+        if path:
+            self._load()
+            self._file = open(path, "a", encoding="utf8")
+        self._write({"event": "start", "resumed": self.resumed})
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        finished = False
+        good_size = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line.decode("utf8"))
+                except ValueError:
+                    app_log.warning(
+                        f"Discarding partial record at {good_size} in {self.path}"
+                    )
+                    break
+                if not line.endswith(b"\n"):
+                    # a complete json document, but not a complete record
+                    break
+                good_size += len(line)
+                if record.get("event") == "start":
+                    finished = False
+                elif record.get("event") == "finish":
+                    finished = True
+                else:
+                    self.status[(record["key"], record["stage"])] = record["status"]
+        if finished:
+            app_log.info(f"Previous run in {self.path} finished, starting a new run")
+            os.replace(self.path, self.path + ".prev")
+            self.status = {}
+            return
+        if os.path.getsize(self.path) > good_size:
+            # don't append new records to a partial one
+            with open(self.path, "r+b") as f:
+                f.truncate(good_size)
+        self.resumed = True
+        app_log.info(
+            f"Resuming run from {self.path} with {len(self.status)} recorded stages"
+        )
+
+    def _write(self, record):
+        record["time"] = time.time()
+        if self._file is None:
+            return
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def get(self, key, stage):
+        """Return the recorded status of a stage, if any"""
+        return self.status.get((key, stage))
+
+    def is_done(self, key, stage):
+        """Whether a stage has completed, i.e. it was deleted or skipped"""
+        return self.get(key, stage) in {DELETED, SKIPPED}
+
+    def record(self, key, stage, status, message=None):
+        """Record the outcome of a stage"""
+        record = {"key": key, "stage": stage, "status": status}
+        if message:
+            record["message"] = message
+        self._write(record)
+        self.status[(key, stage)] = status
+
+    def summary(self):
+        """Count the latest status of each stage
+
+        Returns {stage: {status: count}}
+        """
+        summary = defaultdict(lambda: defaultdict(int))
+        for (key, stage), status in self.status.items():
+            summary[stage][status] += 1
+        return {stage: dict(counts) for stage, counts in summary.items()}
+
+    def log_summary(self, label):
+        for stage, counts in sorted(self.summary().items()):
+            counts_str = ", ".join(
+                f"{status}={counts.get(status, 0)}"
+                for status in (DELETED, SKIPPED, FAILED)
+            )
+            app_log.info(f"{label} {stage}: {counts_str}")
+
+    def finish(self):
+        """Mark the run as complete"""
+        self._write({"event": "finish", "summary": self.summary()})
+        self.close()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def open_journal(name, journal_dir=None):
+    """Open the journal for a kind of deletion run, e.g. 'delete-everything'"""
+    if journal_dir is None:
+        journal_dir = JOURNAL_DIR
+    if not journal_dir:
+        return Journal()
+    os.makedirs(journal_dir, exist_ok=True)
+    return Journal(os.path.join(journal_dir, f"{name}.jsonl"))
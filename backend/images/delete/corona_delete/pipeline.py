@@ -0,0 +1,244 @@
+"""staged pipelines for deletion runs
+
+- each stage has its own bounded queue and number of workers
+- workers are long-lived, so connections stay warm across items
+- a full queue blocks the stage feeding it,
+  so work never piles up in front of the slowest stage
+- throughput per stage is exported as prometheus metrics and logged
+"""
+
+import asyncio
+import os
+import time
+from collections import defaultdict
+
+from prometheus_client import Counter, Gauge, Histogram
+from tornado.log import app_log
+
+# default queue size for a stage, as a multiple of its concurrency
+QUEUE_FACTOR = int(os.environ.get("PIPELINE_QUEUE_FACTOR") or 2)
+
+stage_items = Counter(
+    "deletion_stage_items",
+    "Items processed by each deletion stage, by outcome",
+    ["pipeline", "stage", "status"],
+)
+stage_seconds = Histogram(
+    "deletion_stage_seconds",
+    "Time spent processing an item in each deletion stage",
+    ["pipeline", "stage"],
+)
+stage_blocked_seconds = Counter(
+    "deletion_stage_blocked_seconds",
+    "Time deletion stage workers spent waiting for room in the next stage",
+    ["pipeline", "stage"],
+)
+stage_queued = Gauge(
+    "deletion_stage_queued",
+    "Items waiting in the queue of each deletion stage",
+    ["pipeline", "stage"],
+)
+
+
+class Stage:
+    """One stage of a Pipeline
+
+    process is an async function called with each item.
+    Its return value is passed to the next stage.
+    If it returns None, the item is complete and skips the remaining stages.
+    """
+
+    def __init__(self, name, process, concurrency, queue_size=None):
+        self.name = name
+        self.process = process
+        self.concurrency = concurrency
+        if queue_size is None:
+            queue_size = concurrency * QUEUE_FACTOR
+        self.queue_size = queue_size
+        self.queue = None
+        # done, failed
+        self.counts = defaultdict(int)
+        # total time spent in process
+        self.busy_seconds = 0
+        # total time spent waiting for the next stage to accept items
+        self.blocked_seconds = 0
+
+    def stats(self, elapsed):
+        """Summary of the stage's throughput over `elapsed` seconds"""
+        return {
+            "done": self.counts["done"],
+            "failed": self.counts["failed"],
+            "queued": self.queue.qsize() if self.queue else 0,
+            "rate": self.counts["done"] / elapsed if elapsed else 0,
+            # fraction of worker time spent processing
+            "busy": self.busy_seconds / (elapsed * self.concurrency) if elapsed else 0,
+            "blocked": self.blocked_seconds,
+        }
+
+
+class Pipeline:
+    """Run items through a sequence of stages
+
+    Each stage runs `concurrency` workers, consuming from its own queue
+    and feeding the queue of the next stage.
+    Workers are started once and run until the pipeline is closed,
+    instead of per item or per batch.
+
+    Queues are bounded, so a slow stage blocks the stages before it
+    and eventually submit(), rather than accumulating work.
+
+    Failures are counted per stage and logged.
+    When max_failures is reached, the pipeline is aborted
+    and the failure is raised from submit() and join().
+    """
+
+    def __init__(
+        self, stages, label="Pipeline", max_failures=1, counts=None, log_interval=30
+    ):
+        self.stages = stages
+        self.label = label
+        self.max_failures = max_failures
+        # extra counts to log with progress
+        if counts is None:
+            counts = defaultdict(int)
+        self.counts = counts
+        self.log_interval = log_interval
+        self.failures = 0
+        self.workers = []
+        self.aborted = None
+        self.tic = None
+
+    def start(self):
+        """Start the workers for all stages"""
+        self.tic = time.perf_counter()
+        self.aborted = asyncio.get_event_loop().create_future()
+        for index, stage in enumerate(self.stages):
+            stage.queue = asyncio.Queue(stage.queue_size)
+            for _ in range(stage.concurrency):
+                self.workers.append(asyncio.ensure_future(self._work(index)))
+        self.workers.append(asyncio.ensure_future(self._log_periodically()))
+
+    def close(self):
+        """Stop all workers, abandoning items still in progress"""
+        for worker in self.workers:
+            worker.cancel()
+        self.workers = []
+        if self.aborted is not None and self.aborted.done():
+            # retrieve the failure, so it's not logged again as never retrieved
+            self.aborted.exception()
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    async def _until_aborted(self, awaitable):
+        """Await an awaitable, unless the pipeline is aborted first"""
+        future = asyncio.ensure_future(awaitable)
+        await asyncio.wait([future, self.aborted], return_when=asyncio.FIRST_COMPLETED)
+        if self.aborted.done():
+            future.cancel()
+            # raises the failure that aborted the pipeline
+            self.aborted.result()
+        return future.result()
+
+    async def submit(self, item):
+        """Submit an item to the first stage
+
+        Waits while the first stage's queue is full.
+        """
+        self.counts["total"] += 1
+        stage = self.stages[0]
+        await self._until_aborted(stage.queue.put(item))
+        stage_queued.labels(self.label, stage.name).set(stage.queue.qsize())
+
+    async def join(self):
+        """Wait for all submitted items to pass through all stages"""
+        # items only move forward, so once a stage's queue is drained,
+        # everything it produced is already in the next stage's queue
+        for stage in self.stages:
+            await self._until_aborted(stage.queue.join())
+        self.log_progress(extra="completed")
+
+    async def _work(self, index):
+        stage = self.stages[index]
+        if index + 1 < len(self.stages):
+            next_stage = self.stages[index + 1]
+        else:
+            next_stage = None
+
+        while True:
+            item = await stage.queue.get()
+            stage_queued.labels(self.label, stage.name).set(stage.queue.qsize())
+            try:
+                tic = time.perf_counter()
+                try:
+                    result = await stage.process(item)
+                except Exception as e:
+                    self._fail(stage, e)
+                    continue
+                finally:
+                    elapsed = time.perf_counter() - tic
+                    stage.busy_seconds += elapsed
+                    stage_seconds.labels(self.label, stage.name).observe(elapsed)
+                stage.counts["done"] += 1
+                stage_items.labels(self.label, stage.name, "done").inc()
+
+                if result is None or next_stage is None:
+                    continue
+                tic = time.perf_counter()
+                await next_stage.queue.put(result)
+                blocked = time.perf_counter() - tic
+                stage.blocked_seconds += blocked
+                stage_blocked_seconds.labels(self.label, stage.name).inc(blocked)
+                stage_queued.labels(self.label, next_stage.name).set(
+                    next_stage.queue.qsize()
+                )
+            finally:
+                stage.queue.task_done()
+
+    def _fail(self, stage, error):
+        stage.counts["failed"] += 1
+        stage_items.labels(self.label, stage.name, "failed").inc()
+        self.failures += 1
+        app_log.error(
+            f"{self.label} {stage.name} failed: {error}",
+            exc_info=(type(error), error, error.__traceback__),
+        )
+        if self.failures >= self.max_failures and not self.aborted.done():
+            self.log_progress(extra="aborting")
+            self.aborted.set_exception(error)
+
+    async def _log_periodically(self):
+        while True:
+            await asyncio.sleep(self.log_interval)
+            self.log_progress()
+
+    def stats(self):
+        """Throughput of each stage so far
+
+        Returns {stage: {done, failed, queued, rate, busy, blocked}},
+        where rate is items per second,
+        busy is the fraction of worker time spent processing items,
+        and blocked is the total seconds workers waited for the next stage.
+        """
+        elapsed = time.perf_counter() - self.tic
+        return {stage.name: stage.stats(elapsed) for stage in self.stages}
+
+    def log_progress(self, *, extra=""):
+        """Log throughput of each stage, and the extra counts"""
+        elapsed = time.perf_counter() - self.tic
+        counts_str = ", ".join(
+            f"{key}={value}" for key, value in sorted(self.counts.items())
+        )
+        app_log.info(
+            f"{self.label} counts{' ' + extra if extra else ''} (elapsed={elapsed:.0f}s): {counts_str}"
+        )
+        for name, stats in self.stats().items():
+            app_log.info(
+                f"{self.label} {name}: done={stats['done']} failed={stats['failed']}"
+                f" queued={stats['queued']} ({stats['rate']:.1f} it/s,"
+                f" busy={stats['busy']:.0%}, blocked={stats['blocked']:.0f}s)"
+            )
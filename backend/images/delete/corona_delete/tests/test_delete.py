@@ -12,6 +12,7 @@ from unittest.mock import MagicMock
 import objgraph
 import pytest
 from testfixtures import LogCapture
+from tornado.httpclient import HTTPError
 
 from corona_backend import graph
 from corona_backend import test as test_utils
@@ -174,24 +175,90 @@ async def test_find_groups_to_delete_without_timestamp(user):
 def test_delete_sql_data():
     db = mock.MagicMock()
     device_ids = ["test_device1", "test_device2", "test_device3"]
+    # only the first device had data to delete
+    db.execute.return_value.fetchall.side_effect = [[("test_device1",)], []]
 
-    delete.delete_sql_data(db, *device_ids)
+    outcomes = delete.delete_sql_data(db, *device_ids, chunk_size=2)
 
-    # assert db.execute.call_count == 9 # remove this assert in case the code regarding sql in delete_sql_data further changed
+    assert outcomes == [True, False, False]
+    assert db.execute.call_args_list == [
+        mock.call(r"{CALL deleteforUUIDList (?)}", ("test_device1,test_device2",)),
+        mock.call(r"{CALL deleteforUUIDList (?)}", ("test_device3",)),
+    ]
+    # one commit per chunk
+    assert db.commit.call_count == 2
+
+
+@with_db(pooled=False)
+def test_delete_sql_data_failed_chunk():
+    db = mock.MagicMock()
+    device_ids = ["test_device1", "test_device2", "test_device3"]
+    error = RuntimeError("connection lost")
+    db.execute.return_value.fetchall.side_effect = [error, [("test_device3",)]]
+
+    outcomes = delete.delete_sql_data(db, *device_ids, chunk_size=2)
+
+    # the failed chunk is rolled back, the next chunk is still deleted
+    assert outcomes == [error, error, True]
+    assert db.rollback.call_count == 1
+    assert db.commit.call_count == 1
 
-    for device_id in device_ids:
-        db.execute.assert_called_with(r"{CALL latestActivityForUUID(?)}", (device_id,))
-        db.execute.assert_called_once_with(r"{CALL deleteforUUID (?)}", (device_id,))
+
+async def test_delete_with_retries():
+    calls = []
+    error = RuntimeError("deadlock")
+
+    async def delete_sql_data(*device_ids):
+        calls.append(device_ids)
+        if len(calls) == 1:
+            # the chunk with dev1 fails
+            return [error, error, True]
+        return [True] * len(device_ids)
+
+    deleter = delete.Deleter(batch_size=3, batch_seconds=1)
+    try:
+        with mock.patch("corona_delete.delete.delete_sql_data", delete_sql_data), mock.patch(
+            "corona_delete.delete.asyncio.sleep", new_callable=AsyncMock
+        ):
+            outcomes = await deleter.delete_with_retries(["dev0", "dev1", "dev2"])
+    finally:
+        await deleter.stop()
+
+    assert outcomes == [True, True, True]
+    # only devices in the failed chunk are retried
+    assert calls == [("dev0", "dev1", "dev2"), ("dev0", "dev1")]
 
 
 @with_db(ApplicationIntent="ReadOnly")
-def test_find_inactive_devices():
+def test_find_inactive_devices_page():
     db = mock.MagicMock()
     idle_cutoff = datetime.now(timezone.utc) - timedelta(days=10)
 
-    delete.find_inactive_devices(db, idle_cutoff)
+    delete.find_inactive_devices_page(db, idle_cutoff, "dev1", 10)
 
-    db.execute.assert_called_once_with(r"{CALL getLastActivityBefore(?)}", (idle_cutoff,))
+    db.execute.assert_called_once_with(
+        r"{CALL getLastActivityBeforePage(?,?,?)}", (idle_cutoff, "dev1", 10)
+    )
+
+
+async def test_find_inactive_devices():
+    idle_cutoff = datetime.now(timezone.utc) - timedelta(days=10)
+    inactive = [(f"dev{i:02}", idle_cutoff) for i in range(7)]
+    calls = []
+
+    async def find_inactive_devices_page(cutoff, after, page_size):
+        calls.append(after)
+        rows = [row for row in inactive if after is None or row[0] > after]
+        return rows[:page_size]
+
+    with mock.patch.object(
+        delete, "find_inactive_devices_page", find_inactive_devices_page
+    ):
+        found = [row async for row in delete.find_inactive_devices(idle_cutoff, page_size=3)]
+
+    assert found == inactive
+    # pages are requested after the last device id of the previous page
+    assert calls == [None, "dev02", "dev05"]
 
 
 @with_db(persistent=PERSISTENT_CHECK_DB, ApplicationIntent="ReadOnly")
@@ -205,6 +272,242 @@ def test_check_sql_data():
     db.execute.assert_called_once_with(r"{CALL latestActivityForUUID(?)}", (device_id,))
 
 
+def live_lookups(groups, iothub_devices, calls):
+    """Live graph.device_groups_for_user and devices.get_device
+
+    for the given groups (with members) and devices, recording calls
+    """
+
+    async def device_groups_for_user(user):
+        calls.append(("groups", user["id"]))
+        for group in groups:
+            if group["members"][0]["id"] == user["id"]:
+                yield {key: value for key, value in group.items() if key != "members"}
+
+    async def get_device(device_id):
+        calls.append(("device", device_id))
+        for device in iothub_devices:
+            if device["deviceId"] == device_id:
+                return device
+        raise HTTPError(404)
+
+    return device_groups_for_user, get_device
+
+
+async def test_find_users_to_delete_snapshot():
+    old = (delete.IDLE_CUTOFF - timedelta(days=1)).isoformat()
+    new = (delete.IDLE_CUTOFF + timedelta(days=1)).isoformat()
+    groups = [
+        # idle user with a single device
+        {"id": "g1", "displayName": "idle1", "createdDateTime": old,
+         "members": [{"id": "u1", "displayName": "+001"}]},
+        # user with a second device, active in IoTHub
+        {"id": "g2", "displayName": "idle2", "createdDateTime": old,
+         "members": [{"id": "u2", "displayName": "+002"}]},
+        {"id": "g3", "displayName": "active2", "createdDateTime": old,
+         "members": [{"id": "u2", "displayName": "+002"}]},
+    ]
+    iothub_devices = [
+        {"deviceId": "idle1", "lastActivityTime": old},
+        {"deviceId": "idle2", "lastActivityTime": old},
+        {"deviceId": "active2", "lastActivityTime": new},
+    ]
+
+    async def list_groups(**kwargs):
+        assert "members" in kwargs["expand"]
+        for group in groups:
+            yield dict(group)
+
+    async def get_devices():
+        for device in iothub_devices:
+            yield device
+
+    async def list_users(**kwargs):
+        for user in []:
+            yield user
+
+    async def find_inactive_devices():
+        for row in [("idle1", old), ("idle2", old)]:
+            yield row
+
+    async def remote_call(*args, **kwargs):
+        raise AssertionError("should be resolved from the snapshot")
+
+    live_calls = []
+    device_groups_for_user, get_device = live_lookups(groups, iothub_devices, live_calls)
+
+    with mock.patch.multiple(
+        graph,
+        list_groups=list_groups,
+        list_users=list_users,
+        get_group=remote_call,
+        user_for_device=remote_call,
+        device_groups_for_user=device_groups_for_user,
+    ), mock.patch.multiple(
+        delete.devices, get_devices=get_devices, get_device=get_device
+    ), mock.patch.multiple(
+        delete,
+        find_inactive_devices=find_inactive_devices,
+        check_sql_data=remote_call,
+    ):
+        users = [user async for user in delete.find_users_to_delete()]
+
+    assert [user["id"] for user in users] == ["u1"]
+    # only the idle user is checked again live
+    assert live_calls == [("groups", "u1"), ("device", "idle1")]
+
+
+async def test_find_users_to_delete_rechecks_live():
+    old = (delete.IDLE_CUTOFF - timedelta(days=1)).isoformat()
+    new = (delete.IDLE_CUTOFF + timedelta(days=1)).isoformat()
+    groups = [
+        {"id": f"g{i}", "displayName": f"idle{i}", "createdDateTime": old,
+         "members": [{"id": f"u{i}", "displayName": f"+00{i}"}]}
+        for i in range(1, 4)
+    ]
+    iothub_devices = [
+        {"deviceId": f"idle{i}", "lastActivityTime": old} for i in range(1, 4)
+    ]
+    # since the snapshot, u1 registered a new phone, and u2's device reported
+    live_groups = groups + [
+        {"id": "g4", "displayName": "new1", "createdDateTime": new,
+         "members": [{"id": "u1", "displayName": "+001"}]},
+    ]
+    live_devices = [
+        {"deviceId": "idle1", "lastActivityTime": old},
+        {"deviceId": "idle2", "lastActivityTime": new},
+        {"deviceId": "idle3", "lastActivityTime": old},
+        {"deviceId": "new1", "lastActivityTime": new},
+    ]
+
+    async def list_groups(**kwargs):
+        for group in groups:
+            yield dict(group)
+
+    async def get_devices():
+        for device in iothub_devices:
+            yield device
+
+    async def list_users(**kwargs):
+        for user in []:
+            yield user
+
+    async def find_inactive_devices():
+        for device in iothub_devices:
+            yield device["deviceId"], old
+
+    async def check_sql_data(device_id, activity_cutoff):
+        return False
+
+    device_groups_for_user, get_device = live_lookups(live_groups, live_devices, [])
+    with mock.patch.multiple(
+        graph,
+        list_groups=list_groups,
+        list_users=list_users,
+        device_groups_for_user=device_groups_for_user,
+    ), mock.patch.multiple(
+        delete.devices, get_devices=get_devices, get_device=get_device
+    ), mock.patch.multiple(
+        delete,
+        find_inactive_devices=find_inactive_devices,
+        check_sql_data=check_sql_data,
+    ):
+        users = [user async for user in delete.find_users_to_delete()]
+
+    assert [user["id"] for user in users] == ["u3"]
+
+
+async def test_find_users_to_delete_two_inactive_devices():
+    old = (delete.IDLE_CUTOFF - timedelta(days=1)).isoformat()
+    groups = [
+        {"id": "g1", "displayName": "idle1a", "createdDateTime": old,
+         "members": [{"id": "u1", "displayName": "+001"}]},
+        {"id": "g2", "displayName": "idle1b", "createdDateTime": old,
+         "members": [{"id": "u1", "displayName": "+001"}]},
+    ]
+
+    async def list_groups(**kwargs):
+        for group in groups:
+            yield dict(group)
+
+    async def get_devices():
+        for group in groups:
+            yield {"deviceId": group["displayName"], "lastActivityTime": old}
+
+    async def list_users(**kwargs):
+        for user in []:
+            yield user
+
+    async def find_inactive_devices():
+        for group in groups:
+            yield group["displayName"], old
+
+    async def check_sql_data(device_id, activity_cutoff):
+        return False
+
+    iothub_devices = [device async for device in get_devices()]
+    device_groups_for_user, get_device = live_lookups(groups, iothub_devices, [])
+    with mock.patch.multiple(
+        graph,
+        list_groups=list_groups,
+        list_users=list_users,
+        device_groups_for_user=device_groups_for_user,
+    ), mock.patch.multiple(
+        delete.devices, get_devices=get_devices, get_device=get_device
+    ), mock.patch.multiple(
+        delete,
+        find_inactive_devices=find_inactive_devices,
+        check_sql_data=check_sql_data,
+    ):
+        users = [user async for user in delete.find_users_to_delete()]
+
+    # the user is found once, not once per inactive device
+    assert [user["id"] for user in users] == ["u1"]
+
+
+def test_snapshot_add_inactive():
+    old = (delete.IDLE_CUTOFF - timedelta(days=1)).isoformat()
+    snapshot = delete.DirectorySnapshot()
+    for group_id, device_id, user_id in [
+        ("g1", "dev1", "u1"),
+        ("g2", "dev2", "u2"),
+        ("g3", "dev3", "u2"),
+    ]:
+        snapshot.add_group(
+            {"id": group_id, "displayName": device_id, "createdDateTime": old},
+            {"id": user_id, "displayName": "+00"},
+        )
+
+    for device_id in ["dev1", "dev2", "unknown"]:
+        snapshot.add_inactive(device_id)
+
+    # only devices that may be checked as another device of their user are kept
+    assert snapshot.inactive_device_ids == {"dev2"}
+
+
+
+async def test_snapshot_records():
+    created = "2020-04-16T12:00:00+00:00"
+    snapshot = delete.DirectorySnapshot()
+    snapshot.add_group(
+        {"id": "g1", "displayName": "dev1", "createdDateTime": created},
+        {"id": "u1", "displayName": "+001"},
+    )
+    snapshot.add_group(
+        {"id": "g2", "displayName": "dev2", "createdDateTime": created},
+        {"id": "u2", "displayName": "+002", delete.consent_revoked: True},
+    )
+
+    # groups and users are rebuilt from the compact records
+    group = await snapshot.get_group("dev1")
+    assert group == {"id": "g1", "displayName": "dev1", "createdDateTime": created}
+    user = await snapshot.user_for_device(group)
+    assert user["id"] == "u1"
+    assert user["logName"] == graph.wrap_user({"displayName": "+001"})["logName"]
+    assert await snapshot.device_groups_for_user(user) == [group]
+    assert await snapshot.user_for_device(await snapshot.get_group("dev2")) is None
+    assert not snapshot.misses
+
 class AsyncMock(mock.MagicMock):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -219,30 +522,32 @@ class AsyncMock(mock.MagicMock):
 
 @pytest.fixture
 def mock_delete():
+    async def delete_sql_data(*device_ids):
+        return [True] * len(device_ids)
+
     with mock.patch(
-            "corona_delete.delete.delete_sql_data", new_callable=AsyncMock
+            "corona_delete.delete.delete_sql_data", side_effect=delete_sql_data
     ) as m:
         yield m
 
 
 @pytest.fixture
-def deleter(mock_delete):
+async def deleter(mock_delete):
     deleter = delete.get_deleter()
     try:
         yield deleter
     finally:
         delete.get_deleter.cache_clear()
-        deleter.stop(block=True)
+        await deleter.stop()
 
 
-async def test_batch_delete(request, mock_delete):
+async def test_batch_delete(mock_delete):
     start = time.perf_counter()
     deleter = delete.Deleter(batch_size=3, batch_seconds=1)
-    request.addfinalizer(lambda: deleter.stop(block=True))
     device_id = "one"
     f = deleter.request_deletion(device_id)
     # wait for batch to process
-    time.sleep(0.2)
+    await asyncio.sleep(0.2)
     assert len(deleter.batch) == 1
     assert deleter.batch[0][0] == device_id
     await f
@@ -260,7 +565,7 @@ async def test_batch_delete(request, mock_delete):
     assert mock_delete.call_count == 2
     assert mock_delete.call_args == [tuple(device_ids[: deleter.batch_size])]
 
-    time.sleep(0.2)
+    await asyncio.sleep(0.2)
     assert len(deleter.batch) == 1
     assert deleter.batch[0][0] == device_ids[-1]
     await futures[-1]
@@ -270,8 +575,9 @@ async def test_batch_delete(request, mock_delete):
 
     device_id = "stop"
     f = deleter.request_deletion(device_id)
-    deleter.stop(block=True)
-    assert not deleter.thread.is_alive()
+    await deleter.stop()
+    assert deleter.task.done()
+    assert f.done()
     assert mock_delete.call_count == 4
     assert mock_delete.call_args == [(device_id,)]
 
@@ -332,7 +638,7 @@ async def test_delete_everything(user):
     with mock.patch("corona_delete.delete.check_and_delete_sql",
                     MagicMock(return_value=True)):  # db operation is mocked
         await delete.delete_everything(concurrency=10, max_failures=1)
-    await deleter.stop(block=False)
+    await deleter.stop()
 
     # Show the increase in peak object counts after the delete_everything call
     objgraph.show_growth()
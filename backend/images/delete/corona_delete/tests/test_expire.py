@@ -0,0 +1,146 @@
+import os
+import shutil
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from unittest import mock
+
+import azure.core.exceptions
+import pytest
+
+from corona_delete import delete, storage
+
+
+class LocalDirectoryClient:
+    def __init__(self, fs, path_name):
+        self.fs = fs
+        self.path_name = path_name
+        self.local_path = os.path.join(fs.root, path_name)
+
+    def get_directory_properties(self):
+        if not os.path.isdir(self.local_path):
+            raise azure.core.exceptions.ResourceNotFoundError(self.path_name)
+        self.fs.properties_calls.append(self.path_name)
+        return SimpleNamespace(last_modified=self.fs.mtime(self.local_path))
+
+    def delete_directory(self):
+        shutil.rmtree(self.local_path)
+
+
+class LocalFileSystemClient:
+    """Data Lake file system client stand-in, backed by a local directory
+
+    If listing_times is False, listings don't include last_modified.
+    """
+
+    def __init__(self, root, listing_times=True):
+        self.root = str(root)
+        self.listing_times = listing_times
+        self.properties_calls = []
+
+    @staticmethod
+    def mtime(local_path):
+        return datetime.fromtimestamp(os.stat(local_path).st_mtime, timezone.utc)
+
+    def get_directory_client(self, path_name):
+        return LocalDirectoryClient(self, path_name)
+
+    def get_paths(self, path, recursive=True):
+        assert not recursive
+        for name in sorted(os.listdir(os.path.join(self.root, path))):
+            path_name = f"{path}/{name}"
+            local_path = os.path.join(self.root, path_name)
+            yield SimpleNamespace(
+                name=path_name,
+                is_directory=os.path.isdir(local_path),
+                last_modified=self.mtime(local_path) if self.listing_times else None,
+            )
+
+
+@pytest.fixture
+def lake(tmp_path):
+    """Date-partitioned lake directories, modified late on their date"""
+    now = datetime.now(timezone.utc)
+    today = datetime(now.year, now.month, now.day, tzinfo=timezone.utc)
+    days = {}
+    for age in (1, 5, 10, 20):
+        day = today - timedelta(days=age)
+        path = tmp_path / "data" / day.strftime("%Y/%m/%d")
+        path.mkdir(parents=True)
+        (path / "00.json").write_text("{}")
+        mtime = (day + timedelta(hours=23)).timestamp()
+        os.utime(path, (mtime, mtime))
+        days[age] = day.strftime("data/%Y/%m")
+    return tmp_path, today, days
+
+
+def remaining(root, month_dir):
+    path = os.path.join(root, month_dir)
+    if not os.path.exists(path):
+        return set()
+    return {f"{month_dir}/{name}" for name in os.listdir(path)}
+
+
+@pytest.mark.parametrize("listing_times", [True, False])
+async def test_expire_directories(lake, listing_times):
+    root, today, days = lake
+    expiry = today - timedelta(days=7)
+    fs = LocalFileSystemClient(root, listing_times=listing_times)
+    key = (storage.storage_account, storage.fs_name)
+    before = set.union(*(remaining(root, d) for d in days.values()))
+
+    with mock.patch.dict(storage.fs_clients, {key: fs}):
+        for month_dir in sorted(set(days.values())):
+            await delete.expire_directories(month_dir, expiry)
+
+    after = set.union(*(remaining(root, d) for d in days.values()))
+    expected = {
+        f"{days[age]}/{(today - timedelta(days=age)).strftime('%d')}" for age in (1, 5)
+    }
+    assert after == expected
+    assert before - after == {
+        f"{days[age]}/{(today - timedelta(days=age)).strftime('%d')}"
+        for age in (10, 20)
+    }
+    # only the existence checks of the parent directories
+    assert set(fs.properties_calls) <= set(days.values())
+
+
+async def test_expire_directories_ambiguous(tmp_path):
+    now = datetime.now(timezone.utc)
+    today = datetime(now.year, now.month, now.day, tzinfo=timezone.utc)
+    expiry = today - timedelta(days=7)
+    # partition dated right before expiry, but still written to after it
+    day = expiry - timedelta(days=1)
+    late = tmp_path / "data" / day.strftime("%Y/%m/%d")
+    late.mkdir(parents=True)
+    # not date-partitioned
+    undelete = tmp_path / "data" / day.strftime("%Y/%m/undelete")
+    undelete.mkdir()
+    old = (expiry - timedelta(days=3)).timestamp()
+    os.utime(undelete, (old, old))
+    fs = LocalFileSystemClient(tmp_path, listing_times=False)
+    month_dir = day.strftime("data/%Y/%m")
+
+    with mock.patch.dict(
+        storage.fs_clients, {(storage.storage_account, storage.fs_name): fs}
+    ):
+        await delete.expire_directories(month_dir, expiry)
+
+    # properties are checked for both,
+    # the late partition was modified recently and is kept
+    assert sorted(fs.properties_calls) == sorted(
+        [month_dir, f"{month_dir}/{day.strftime('%d')}", f"{month_dir}/undelete"]
+    )
+    assert remaining(tmp_path, month_dir) == {f"{month_dir}/{day.strftime('%d')}"}
+
+
+def test_partition_date():
+    assert delete.partition_date("data/2020/06/15") == datetime(
+        2020, 6, 15, tzinfo=timezone.utc
+    )
+    assert delete.partition_date("data/2020/06/15/") == datetime(
+        2020, 6, 15, tzinfo=timezone.utc
+    )
+    assert delete.partition_date("data/2020/06/undelete") is None
+    assert delete.partition_date("data/2020/13/01") is None
+    assert delete.partition_date("undelete") is None
@@ -0,0 +1,220 @@
+import asyncio
+import json
+import random
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+import pytest
+
+from corona_delete import delete
+from corona_delete.journal import DELETED, FAILED, SKIPPED, Journal, open_journal
+
+
+def test_journal_resume(tmp_path):
+    journal = open_journal("test", journal_dir=str(tmp_path))
+    assert not journal.resumed
+    journal.record("dev1", "iot", DELETED)
+    journal.record("dev1", "sql", FAILED, "timeout")
+    journal.close()
+
+    # not finished, resume
+    journal = open_journal("test", journal_dir=str(tmp_path))
+    assert journal.resumed
+    assert journal.is_done("dev1", "iot")
+    assert journal.get("dev1", "sql") == FAILED
+    assert not journal.is_done("dev1", "sql")
+    journal.record("dev1", "sql", DELETED)
+    assert journal.summary() == {"iot": {DELETED: 1}, "sql": {DELETED: 1}}
+    journal.finish()
+
+    # finished, start over
+    journal = open_journal("test", journal_dir=str(tmp_path))
+    assert not journal.resumed
+    assert journal.summary() == {}
+    assert (tmp_path / "test.jsonl.prev").exists()
+
+
+def test_journal_partial_record(tmp_path):
+    path = tmp_path / "test.jsonl"
+    journal = Journal(str(path))
+    journal.record("dev1", "iot", DELETED)
+    journal.close()
+    # killed while writing a record
+    with path.open("a") as f:
+        f.write('{"key": "dev2", "stage": "io')
+
+    journal = Journal(str(path))
+    assert journal.status == {("dev1", "iot"): DELETED}
+    journal.record("dev2", "iot", SKIPPED)
+    journal.close()
+
+    # the partial record was truncated, not appended to
+    lines = path.read_text().splitlines()
+    assert [json.loads(line).get("key") for line in lines] == [
+        None,
+        "dev1",
+        None,
+        "dev2",
+    ]
+
+
+class Crash(Exception):
+    """The process was killed"""
+
+
+class World:
+    """Fake Graph, IoTHub and SQL, where the process may be killed at any step"""
+
+    def __init__(self, n, crash_rate, seed=0):
+        self.random = random.Random(seed)
+        self.crash_rate = crash_rate
+        self.dead = False
+        self.crashes = 0
+        self.sql_calls = 0
+        long_ago = (datetime.now(timezone.utc) - timedelta(days=60)).isoformat()
+        self.groups = {}
+        self.iot = set()
+        self.sql = set()
+        for i in range(n):
+            device_id = f"dev{i}"
+            group = {
+                "id": f"group{i}",
+                "displayName": device_id,
+                delete.to_delete: True,
+                delete.to_delete_date: long_ago,
+            }
+            if i % 2:
+                # deleted long ago, only the group remains
+                group[delete.iot_deleted_date] = long_ago
+                group[delete.sql_deleted_date] = long_ago
+            else:
+                self.iot.add(device_id)
+                self.sql.add(device_id)
+            self.groups[device_id] = group
+
+    def step(self):
+        """Called before and after every side effect"""
+        if self.dead:
+            raise Crash()
+        if self.random.random() < self.crash_rate:
+            self.dead = True
+            self.crashes += 1
+            raise Crash()
+
+    async def find_groups_to_delete(self):
+        for group in list(self.groups.values()):
+            await asyncio.sleep(0)
+            self.step()
+            yield dict(group)
+
+    async def delete_devices(self, device_id):
+        self.step()
+        self.iot.discard(device_id)
+        self.step()
+
+    async def mark_iot_deleted(self, group):
+        self.step()
+        group[delete.iot_deleted_date] = delete.isonow()
+        self.groups[group["displayName"]][delete.iot_deleted_date] = group[
+            delete.iot_deleted_date
+        ]
+        self.step()
+
+    async def check_and_delete_sql(self, group):
+        self.step()
+        self.sql_calls += 1
+        device_id = group["displayName"]
+        had_data = device_id in self.sql
+        self.sql.discard(device_id)
+        self.step()
+        return had_data
+
+    async def set_group_attr(self, group, **attrs):
+        self.step()
+
+    async def delete_group(self, group):
+        self.step()
+        self.groups.pop(group["displayName"], None)
+        self.step()
+
+
+class CrashingJournal(Journal):
+    def __init__(self, path, world):
+        self.world = world
+        super().__init__(path, fsync=False)
+
+    def _write(self, record):
+        if self.world.dead:
+            raise Crash()
+        if (
+            self._file is not None
+            and self.world.random.random() < self.world.crash_rate
+        ):
+            # killed halfway through writing the record
+            line = json.dumps(record) + "\n"
+            self._file.write(line[: len(line) // 2])
+            self._file.flush()
+            self.world.dead = True
+            self.world.crashes += 1
+            raise Crash()
+        super()._write(record)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_delete_everything_crashes(tmp_path, seed):
+    n = 40
+    concurrency = 4
+    world = World(n, crash_rate=0.02, seed=seed)
+    path = str(tmp_path / "delete-everything.jsonl")
+
+    with mock.patch.multiple(
+        delete,
+        find_groups_to_delete=world.find_groups_to_delete,
+        check_and_delete_sql=world.check_and_delete_sql,
+    ), mock.patch.multiple(
+        delete.graph,
+        mark_iot_deleted=world.mark_iot_deleted,
+        set_group_attr=world.set_group_attr,
+        delete_group=world.delete_group,
+    ), mock.patch.object(
+        delete.devices, "delete_devices", world.delete_devices
+    ):
+        for restart in range(200):
+            world.dead = False
+            try:
+                journal = CrashingJournal(path, world)
+                asyncio.run(
+                    delete.delete_everything(
+                        concurrency=concurrency, max_failures=1, journal=journal
+                    )
+                )
+            except Crash:
+                continue
+            else:
+                break
+        else:
+            pytest.fail("Deletion never completed")
+
+    assert world.crashes > 0
+    # everything is deleted, except groups with recently deleted devices
+    assert world.iot == set()
+    assert world.sql == set()
+    assert set(world.groups) == {f"dev{i}" for i in range(0, n, 2)}
+
+    records = [json.loads(line) for line in open(path).read().splitlines()]
+    summary = records[-1]["summary"]
+    completed = {r["key"] for r in records if r.get("stage") == "group"}
+    # every device is recorded as completed, except if it was killed
+    # after deleting the group, when the device is no longer listed
+    assert set(world.groups) <= completed
+    assert n - len(completed) <= world.crashes
+    for stage in ("iot", "sql", "group"):
+        counts = summary[stage]
+        assert counts.get(FAILED, 0) == 0
+        assert counts.get(DELETED, 0) + counts.get(SKIPPED, 0) <= n
+    # deletions are only missing from the summary
+    # if the process was killed before recording them
+    assert summary["iot"][DELETED] >= n // 2 - world.crashes
+    assert summary["group"][DELETED] >= n // 2 - world.crashes
+    # completed work is not repeated, except what was in flight when killed
+    assert world.sql_calls <= n // 2 + world.crashes * concurrency
@@ -0,0 +1,132 @@
+import asyncio
+from collections import defaultdict
+
+import pytest
+
+from corona_delete.pipeline import Pipeline, Stage
+
+
+class Tracker:
+    """Stage function tracking concurrency"""
+
+    def __init__(self, delay=0, fail=()):
+        self.delay = delay
+        self.fail = set(fail)
+        self.active = 0
+        self.max_active = 0
+        self.started = []
+
+    async def __call__(self, item):
+        self.started.append(item)
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.active -= 1
+        if item in self.fail:
+            raise ValueError(f"failed {item}")
+        return item
+
+
+async def test_pipeline_stages():
+    first = Tracker(delay=0.001)
+    second = Tracker(delay=0.01)
+    results = []
+
+    async def last(item):
+        results.append(item)
+
+    pipeline = Pipeline(
+        [Stage("first", first, 2), Stage("second", second, 3), Stage("last", last, 1)]
+    )
+    async with pipeline:
+        for i in range(20):
+            await pipeline.submit(i)
+        await pipeline.join()
+
+    assert sorted(results) == list(range(20))
+    assert first.max_active == 2
+    assert second.max_active == 3
+    stats = pipeline.stats()
+    assert list(stats) == ["first", "second", "last"]
+    for name, stage_stats in stats.items():
+        assert stage_stats["done"] == 20
+        assert stage_stats["failed"] == 0
+        assert stage_stats["queued"] == 0
+        assert stage_stats["rate"] > 0
+
+
+async def test_pipeline_skip_remaining_stages():
+    second = Tracker()
+
+    async def first(item):
+        if item % 2:
+            return item
+
+    pipeline = Pipeline([Stage("first", first, 2), Stage("second", second, 2)])
+    async with pipeline:
+        for i in range(10):
+            await pipeline.submit(i)
+        await pipeline.join()
+
+    assert sorted(second.started) == [1, 3, 5, 7, 9]
+    assert pipeline.stats()["first"]["done"] == 10
+
+
+async def test_pipeline_backpressure():
+    fast = Tracker()
+    slow = Tracker(delay=0.01)
+    slow_stage = Stage("slow", slow, 2, queue_size=3)
+    pipeline = Pipeline([Stage("fast", fast, 4, queue_size=1), slow_stage])
+    submitted = 0
+    async with pipeline:
+        for i in range(50):
+            await pipeline.submit(i)
+            submitted += 1
+            # submit blocks instead of running ahead of the slow stage:
+            # items not yet started by the slow stage are in the fast queue,
+            # held by fast workers, or in the slow queue
+            assert submitted - len(slow.started) <= 1 + 4 + slow_stage.queue_size
+        await pipeline.join()
+
+    assert len(slow.started) == 50
+    assert slow.max_active == 2
+    assert pipeline.stats()["fast"]["blocked"] > 0
+
+
+async def test_pipeline_failures():
+    counts = defaultdict(int)
+    second = Tracker(fail={3, 5})
+    third = Tracker()
+    pipeline = Pipeline(
+        [
+            Stage("first", Tracker(), 2),
+            Stage("second", second, 2),
+            Stage("third", third, 2),
+        ],
+        max_failures=3,
+        counts=counts,
+    )
+    async with pipeline:
+        for i in range(10):
+            await pipeline.submit(i)
+        await pipeline.join()
+
+    # failed items don't continue to the next stage
+    assert sorted(third.started) == [0, 1, 2, 4, 6, 7, 8, 9]
+    assert pipeline.stats()["second"]["failed"] == 2
+    assert counts["total"] == 10
+
+
+async def test_pipeline_abort():
+    stage = Tracker(fail={3})
+    pipeline = Pipeline([Stage("fail", stage, 1)], max_failures=1)
+    with pytest.raises(ValueError):
+        async with pipeline:
+            for i in range(10):
+                await pipeline.submit(i)
+            await pipeline.join()
+    # aborted before processing everything
+    assert 3 in stage.started
+    assert len(stage.started) < 10
@@ -114,9 +114,11 @@ grant select on getDeviceInformationSingle to coronapipeline;
 */
 GO
 grant execute on deleteforUUID to [FHI-Smittestopp-Sletteservice-Prod];
+grant execute on deleteforUUIDList to [FHI-Smittestopp-Sletteservice-Prod];
 grant execute on apploginsert to [FHI-Smittestopp-Sletteservice-Prod];
 grant execute on latestActivityForUUID to [FHI-Smittestopp-Sletteservice-Prod];
 grant execute on getLastActivityBefore to [FHI-Smittestopp-Sletteservice-Prod];
+grant execute on getLastActivityBeforePage to [FHI-Smittestopp-Sletteservice-Prod];
 
 GO
 grant execute on applogfetch to [FHI-Smittestopp-ServiceAPI-Prod];
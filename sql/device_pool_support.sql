@@ -0,0 +1,48 @@
+-- Create table to hold pre-provisioned IoTHub devices, waiting to be registered
+create table dbo.DevicePool(
+    uuid varchar(36) primary key,
+    primarykey varchar(64) not null,
+    created_at datetime2(0) not null default getdate()
+)
+
+
+-- Create procedure for adding a provisioned device to the pool
+create procedure dbo.addPooledDevice(
+    @uuid varchar(36),
+    @primarykey varchar(64)
+) as
+        insert into dbo.DevicePool(uuid, primarykey)
+        values(@uuid, @primarykey)
+
+-- Create procedure for claiming the oldest device in the pool
+-- the device is removed as it is returned, so each device is claimed at most once.
+-- readpast skips rows locked by concurrent claims instead of waiting for them.
+-- returns no rows if the pool is empty
+create procedure dbo.claimPooledDevice
+as
+        set nocount on;
+        with oldest as (
+            select top(1) uuid, primarykey from dbo.DevicePool with (rowlock, readpast, updlock)
+            order by created_at asc
+        )
+        delete from oldest
+        output deleted.uuid, deleted.primarykey
+
+-- Create function to get the number of devices in the pool
+create function dbo.getDevicePoolSize()
+returns table
+as
+return
+(select count(*) as poolsize from dbo.DevicePool)
+
+
+-- Grants:
+--dev
+grant execute on dbo.addPooledDevice to [FHI-Smittestopp-Registration-Dev];
+grant execute on dbo.claimPooledDevice to [FHI-Smittestopp-Registration-Dev];
+grant select on dbo.getDevicePoolSize to [FHI-Smittestopp-Registration-Dev];
+
+--prod
+grant execute on dbo.addPooledDevice to [FHI-Smittestopp-Registration-Prod];
+grant execute on dbo.claimPooledDevice to [FHI-Smittestopp-Registration-Prod];
+grant select on dbo.getDevicePoolSize to [FHI-Smittestopp-Registration-Prod];
@@ -523,3 +523,10 @@ create table dbo.BirthYear(
 
 
 			     
+GO
+
+create table dbo.DevicePool(
+    uuid varchar(36) primary key,
+    primarykey varchar(64) not null,
+    created_at datetime2(0) not null default getdate()
+)
@@ -1144,3 +1144,11 @@ returns table
 as
 return
 (select birthyear from dbo.birthyear where uuid = @uuid)
+
+GO
+
+create function dbo.getDevicePoolSize()
+returns table
+as
+return
+(select count(*) as poolsize from dbo.DevicePool)
@@ -532,12 +532,35 @@ REMEMBER TO RE-RUN THE PERMISSIONS GRANT STATEMETNS WHEN MAKING CHANGES
 
 go
 
+create procedure deleteforUUIDList (
+	@uuidlist varchar(max)) -- commaseparated list of uuids without quotation marks or spaces e.g. 'uuid,uuid'
+as
+	set nocount on;
+	-- only uuids with activity have data to delete, like latestActivityForUUID
+	declare @active table (uuid varchar(36) primary key);
+	insert into @active
+		select distinct u.uuid from uuid_id u
+		join uuid_activity a on a.id = u.id
+		where a.lastactivity is not null
+			and u.uuid in (select uuid from dbo.CSVToTable(@uuidlist));
+	delete a from uuid_activity a join uuid_id u on a.id = u.id join @active l on u.uuid = l.uuid;
+	delete u from uuid_id u join @active l on u.uuid = l.uuid;
+	-- report the uuids that had data to delete
+	select uuid from @active;
+/*
+REMEMBER TO RE-RUN THE PERMISSIONS GRANT STATEMETNS WHEN MAKING CHANGES
+Deleting an already deleted uuid is a no-op, so a failed list can be retried as a whole.
+*/
+
+go
+
 create procedure getdatabyUUIDList(
 	@uuidlist nvarchar(4000), -- commaseparated list of uuids without quotation marks or spaces e.g. 'uuid,uuid'
 	@timefrom datetime2(0),
 	@timeto datetime2(0),
 	@PageNumber INT = 1,
-	@PageSize   INT = 100
+	@PageSize   INT = 100,
+	@resumefrom datetime2(0) = null -- resume a stream of rows ordered by timefrom desc, at this timefrom
 )
 as
 declare @cleanstr nvarchar(4000);
@@ -552,6 +575,8 @@ platform, osversion, appversion, model,timefrom,timeto, latitude, longitude,
 				group by platform, osversion,model) t
 			join gpsevents with(nolock) on u.id = gpsevents.id
 			where (timefrom between @timefrom and @timeto or timeto between @timefrom and @timeto)
+		-- resume on the sort key: narrowing @timeto instead would drop rows matching only on timeto
+		and (@resumefrom is null or timefrom <= @resumefrom)
 		and u.uuid IN (SELECT * FROM dbo.CSVToTable(@uuidlist))
 ORDER BY timefrom desc
 OFFSET @PageSize * (@PageNumber - 1) ROWS
@@ -570,6 +595,30 @@ order by lastactivity asc
 
 go
 
+create procedure getLastActivityBeforePage(
+	@earliestdate datetime2(0),
+	@afteruuid varchar(36),
+	@pagesize int)
+as
+-- keyset paging of getLastActivityBefore by uuid,
+-- pass the last uuid of the previous page (or null) to get the next page.
+-- Separate queries for the first and next pages,
+-- so that the next pages get a plan seeking on uuid.
+if @afteruuid is null
+	select top (@pagesize) uuid, lastactivity from uuid_activity 
+		join uuid_id on uuid_activity.id = uuid_id.id
+	where lastactivity < @earliestdate
+	order by uuid asc
+else
+	select top (@pagesize) uuid, lastactivity from uuid_activity 
+		join uuid_id on uuid_activity.id = uuid_id.id
+	where lastactivity < @earliestdate
+		and uuid > @afteruuid
+	order by uuid asc
+;
+
+go
+
 /*
 create procedure gpsevents_aggregator (@daypart int)
 as
@@ -726,6 +775,27 @@ create procedure dbo.upsertBirthYear(
 
 GO
 
+create procedure dbo.addPooledDevice(
+    @uuid varchar(36),
+    @primarykey varchar(64)
+) as
+        insert into dbo.DevicePool(uuid, primarykey)
+        values(@uuid, @primarykey)
+
+GO
+
+create procedure dbo.claimPooledDevice
+as
+        set nocount on;
+        with oldest as (
+            select top(1) uuid, primarykey from dbo.DevicePool with (rowlock, readpast, updlock)
+            order by created_at asc
+        )
+        delete from oldest
+        output deleted.uuid, deleted.primarykey
+
+GO
+
 CREATE proc [dbo].[getnewuuids](@uuid varchar(36), @howmany int=100)
 as
 set nocount on
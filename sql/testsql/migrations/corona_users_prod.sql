@@ -78,9 +78,11 @@ go
 
 
 grant execute on deleteforUUID to [FHI-Smittestopp-Sletteservice-Prod];
+grant execute on deleteforUUIDList to [FHI-Smittestopp-Sletteservice-Prod];
 grant execute on apploginsert to [FHI-Smittestopp-Sletteservice-Prod];
 grant execute on latestActivityForUUID to [FHI-Smittestopp-Sletteservice-Prod];
 grant execute on getLastActivityBefore to [FHI-Smittestopp-Sletteservice-Prod];
+grant execute on getLastActivityBeforePage to [FHI-Smittestopp-Sletteservice-Prod];
 
 GO
 grant execute on applogfetch to [FHI-Smittestopp-ServiceAPI-Prod];
@@ -89,6 +91,9 @@ grant execute on getdatabyUUIDList to [FHI-Smittestopp-ServiceAPI-Prod];
 grant execute on dbo.insertPinCode to [FHI-Smittestopp-ServiceAPI-Prod];
 grant execute on dbo.getnewuuids to [FHI-Smittestopp-Registration-Prod]
 grant execute on dbo.upsertBirthYear to [FHI-Smittestopp-Registration-Prod];
+grant execute on dbo.addPooledDevice to [FHI-Smittestopp-Registration-Prod];
+grant execute on dbo.claimPooledDevice to [FHI-Smittestopp-Registration-Prod];
+grant select on dbo.getDevicePoolSize to [FHI-Smittestopp-Registration-Prod];
 grant select on dbo.getPinCodesByPhoneNumber to [FHI-Smittestopp-Registration-Prod];
 grant select on dbo.getPinCodeNewestEntryByThreshold to [FHI-Smittestopp-Registration-Prod];
 grant select on dbo.getPinCodesByPhoneNumber to [FHI-Smittestopp-ServiceAPI-Prod];